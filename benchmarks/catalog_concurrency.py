@@ -0,0 +1,95 @@
+"""Measures lookup latency on a catalog under mixed register/lookup load.
+
+Writer threads register and drop replicas, a snapshot thread serializes the
+whole catalog a few times, and reader threads time `get_file_nodes` until the
+writers and snapshots are done. Runs once per shard count, so one shard shows
+the single-lock baseline.
+
+    PYTHONPATH=. python benchmarks/catalog_concurrency.py --shards 1 64
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+
+from benchmarks.catalog_json import build_catalog
+from filetransfer.utils import FileCatalog, FileNode
+
+
+def run(catalog: FileCatalog, args: argparse.Namespace) -> dict:
+    stop = threading.Event()
+    latencies: list[float] = []
+    file_names = catalog.list_files()
+
+    def writer(seed: int):
+        rng = random.Random(seed)
+        for _ in range(args.registrations):
+            file_name = rng.choice(file_names)
+            url_port = 10_000 + seed
+            catalog.add_file_node(
+                file_node=FileNode(host="bench", port=url_port, blocks=range(4)),
+                file_name=file_name,
+            )
+            catalog.remove_file_node(file_name=file_name, url=f"bench:{url_port}")
+
+    def reader(seed: int):
+        rng = random.Random(seed)
+        local = []
+        while not stop.is_set():
+            file_name = rng.choice(file_names)
+            start = time.perf_counter()
+            catalog.get_file_nodes(file_name=file_name)
+            local.append(time.perf_counter() - start)
+        latencies.extend(local)
+
+    def snapshotter():
+        for _ in range(args.snapshots):
+            catalog.to_json()
+
+    workers = [threading.Thread(target=writer, args=(i,)) for i in range(args.writers)]
+    workers.append(threading.Thread(target=snapshotter))
+    readers = [threading.Thread(target=reader, args=(i,)) for i in range(args.readers)]
+    start = time.perf_counter()
+    for thread in workers + readers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    stop.set()
+    for thread in readers:
+        thread.join()
+
+    latencies.sort()
+    return {
+        "shards": len(catalog.shards),
+        "seconds": round(elapsed, 3),
+        "lookups": len(latencies),
+        "lookup_p50_ms": round(latencies[len(latencies) // 2] * 1000, 3),
+        "lookup_p99_ms": round(latencies[len(latencies) * 99 // 100] * 1000, 3),
+        "lookup_p999_ms": round(latencies[len(latencies) * 999 // 1000] * 1000, 3),
+        "lookup_max_ms": round(latencies[-1] * 1000, 3),
+        "lookups_over_10ms": sum(latency > 0.01 for latency in latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=2000)
+    parser.add_argument("--nodes", type=int, default=20)
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--registrations", type=int, default=20_000)
+    parser.add_argument("--snapshots", type=int, default=5)
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 64])
+    args = parser.parse_args()
+
+    files = build_catalog(args.files, args.nodes, 4).files
+    for n_shards in args.shards:
+        catalog = FileCatalog(files, n_shards=n_shards)
+        print(json.dumps(run(catalog, args)))
+
+
+if __name__ == "__main__":
+    main()
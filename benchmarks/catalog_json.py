@@ -0,0 +1,62 @@
+"""Times saving and loading a tracker catalog.
+
+    PYTHONPATH=. python benchmarks/catalog_json.py --files 10000 --nodes 100
+"""
+
+import argparse
+import json
+import tempfile
+import time
+from pathlib import Path
+
+from filetransfer.utils import HASH_SIZE, FileCatalog, FileNode
+
+
+def build_catalog(n_files: int, n_nodes: int, n_blocks: int) -> FileCatalog:
+    catalog = FileCatalog({})
+    hashes = ["ab" * HASH_SIZE] * n_blocks
+    for i in range(n_files):
+        for j in range(n_nodes):
+            catalog.add_file_node(
+                file_node=FileNode(
+                    host=f"pc{j}",
+                    port=9091,
+                    blocks=range(0, n_blocks, 1 + j % 3),
+                    size=n_blocks * 1024,
+                    block_size=1024,
+                ),
+                file_name=f"dir{i % 100}/file{i}.txt",
+                hashes=hashes,
+            )
+    return catalog
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=10_000)
+    parser.add_argument("--nodes", type=int, default=100)
+    parser.add_argument("--blocks", type=int, default=4)
+    args = parser.parse_args()
+
+    catalog = build_catalog(args.files, args.nodes, args.blocks)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = Path(tmpdir) / "FS_Data.json"
+        start = time.perf_counter()
+        catalog.save(path=path)
+        save_time = time.perf_counter() - start
+        start = time.perf_counter()
+        loaded = FileCatalog.load(path=path)
+        load_time = time.perf_counter() - start
+        size = path.stat().st_size
+    assert loaded == catalog
+    print(json.dumps({
+        "files": args.files,
+        "nodes": args.nodes,
+        "bytes": size,
+        "save_s": round(save_time, 3),
+        "load_s": round(load_time, 3),
+    }))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+"""UDP proxies that put loss, delay, reordering and a bandwidth cap between nodes
+on localhost.
+
+Clients talk to the front port of a proxy. Each client's datagrams are
+forwarded to the upstream port from a socket of its own, so the answers come
+back through the proxy and leave from the front port, as if the upstream had
+sent them. Both directions are impaired, each with its own random stream.
+"""
+
+import asyncio
+import random
+import socket
+from dataclasses import asdict, dataclass
+from multiprocessing import Pipe, Process
+from multiprocessing.connection import Connection
+from typing import Any, Optional
+
+HOST = "127.0.0.1"
+SOCKET_BUFFER_SIZE = 4 * 2**20
+
+
+@dataclass
+class Impairment:
+    """Times in seconds, `bandwidth` in bytes per second.
+
+    Packets held back by `reorder` arrive `reorder_delay` late, behind the ones
+    sent after them. Packets that would wait more than `queue` seconds for the
+    bandwidth cap are dropped, like in a full router buffer.
+    """
+
+    loss: float = 0.0
+    delay: float = 0.0
+    jitter: float = 0.0
+    reorder: float = 0.0
+    reorder_delay: float = 0.005
+    bandwidth: Optional[float] = None
+    queue: float = 0.2
+
+    def to_dict(self) -> dict[str, Any]:
+        return asdict(self)
+
+
+class Link:
+    """One direction of a proxied path."""
+
+    def __init__(
+        self,
+        *,
+        impairment: Impairment,
+        rng: random.Random,
+        loop: asyncio.AbstractEventLoop,
+    ):
+        self.impairment = impairment
+        self.rng = rng
+        self.loop = loop
+        self.free_at = 0.0
+        self.forwarded = 0
+        self.dropped = 0
+        self.reordered = 0
+
+    def send(
+        self,
+        transport: asyncio.DatagramTransport,
+        data: bytes,
+        address: Optional[tuple[str, int]] = None,
+    ) -> None:
+        impairment = self.impairment
+        if impairment.loss and self.rng.random() < impairment.loss:
+            self.dropped += 1
+            return
+        now = self.loop.time()
+        at = now
+        if impairment.bandwidth:
+            start = max(now, self.free_at)
+            if start - now > impairment.queue:
+                self.dropped += 1
+                return
+            at = self.free_at = start + len(data) / impairment.bandwidth
+        at += impairment.delay + self.rng.uniform(0, impairment.jitter)
+        if impairment.reorder and self.rng.random() < impairment.reorder:
+            at += impairment.reorder_delay
+            self.reordered += 1
+        self.forwarded += 1
+        if at <= now:
+            transport.sendto(data, address)
+        else:
+            self.loop.call_at(at, send_if_open, transport, data, address)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "forwarded": self.forwarded,
+            "dropped": self.dropped,
+            "reordered": self.reordered,
+        }
+
+
+def send_if_open(
+    transport: asyncio.DatagramTransport,
+    data: bytes,
+    address: Optional[tuple[str, int]],
+) -> None:
+    if not transport.is_closing():
+        transport.sendto(data, address)
+
+
+class FrontProtocol(asyncio.DatagramProtocol):
+    def __init__(self, proxy: "UdpProxy"):
+        self.proxy = proxy
+
+    def datagram_received(self, data: bytes, addr: tuple[str, int]) -> None:
+        self.proxy.forward(data, addr)
+
+
+class UpstreamProtocol(asyncio.DatagramProtocol):
+    def __init__(self, proxy: "UdpProxy", client: tuple[str, int]):
+        self.proxy = proxy
+        self.client = client
+
+    def datagram_received(self, data: bytes, addr: tuple[str, int]) -> None:
+        self.proxy.backward_link.send(self.proxy.front, data, self.client)
+
+
+class UdpProxy:
+    front: asyncio.DatagramTransport
+
+    def __init__(
+        self,
+        *,
+        port: int,
+        upstream: int,
+        impairment: Impairment,
+        seed: int,
+        loop: asyncio.AbstractEventLoop,
+    ):
+        self.port = port
+        self.upstream = upstream
+        self.loop = loop
+        self.forward_link = Link(
+            impairment=impairment, rng=random.Random(seed * 2 + 1), loop=loop
+        )
+        self.backward_link = Link(
+            impairment=impairment, rng=random.Random(seed * 2 + 2), loop=loop
+        )
+        self.upstreams: dict[tuple[str, int], asyncio.Task] = {}
+
+    async def start(self) -> None:
+        front = buffered_socket()
+        front.bind((HOST, self.port))
+        self.front, _ = await self.loop.create_datagram_endpoint(
+            lambda: FrontProtocol(self), sock=front
+        )
+
+    async def connect(self, client: tuple[str, int]) -> asyncio.DatagramTransport:
+        upstream = buffered_socket()
+        upstream.connect((HOST, self.upstream))
+        transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: UpstreamProtocol(self, client), sock=upstream
+        )
+        return transport
+
+    def forward(self, data: bytes, client: tuple[str, int]) -> None:
+        """Datagrams that arrive while the client's upstream socket is still
+        being opened are sent, in order, once it is."""
+        upstream = self.upstreams.get(client)
+        if upstream is None:
+            upstream = self.loop.create_task(self.connect(client))
+            self.upstreams[client] = upstream
+        if upstream.done():
+            self.forward_link.send(upstream.result(), data)
+        else:
+            upstream.add_done_callback(
+                lambda task: self.forward_link.send(task.result(), data)
+            )
+
+    def close(self) -> None:
+        self.front.close()
+        for upstream in self.upstreams.values():
+            if upstream.done():
+                upstream.result().close()
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        return {
+            "forward": self.forward_link.stats(),
+            "backward": self.backward_link.stats(),
+        }
+
+
+def buffered_socket() -> socket.socket:
+    """UDP socket with buffers as big as the nodes', so the proxy doesn't drop
+    packets the impairment let through."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+        sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER_SIZE)
+    sock.setblocking(False)
+    return sock
+
+
+def free_port(kind: int = socket.SOCK_DGRAM) -> int:
+    with socket.socket(socket.AF_INET, kind) as probe:
+        probe.bind((HOST, 0))
+        return probe.getsockname()[1]
+
+
+def serve(
+    routes: dict[int, int], impairment: Impairment, seed: int, control: Connection
+) -> None:
+    """Runs the proxies of `routes`, front port to upstream port, until told to
+    stop, then sends back their counters."""
+    loop = asyncio.new_event_loop()
+    proxies = [
+        UdpProxy(
+            port=port,
+            upstream=upstream,
+            impairment=impairment,
+            seed=seed + i,
+            loop=loop,
+        )
+        for i, (port, upstream) in enumerate(routes.items())
+    ]
+    for proxy in proxies:
+        loop.run_until_complete(proxy.start())
+    control.send("ready")
+    loop.run_until_complete(loop.run_in_executor(None, control.recv))
+    for proxy in proxies:
+        proxy.close()
+    control.send({proxy.port: proxy.stats() for proxy in proxies})
+    loop.close()
+
+
+class ImpairedNetwork:
+    """Proxies run in a process of their own, so they don't compete with the
+    nodes for the interpreter lock.
+
+    Every `route` gives a front port and an upstream port; the proxies start
+    with `start` and `stop` returns the totals of all their links.
+    """
+
+    def __init__(self, impairment: Impairment, seed: int = 0):
+        self.impairment = impairment
+        self.seed = seed
+        self.routes: dict[int, int] = {}
+        self.process: Optional[Process] = None
+        self.control: Optional[Connection] = None
+
+    def route(self) -> tuple[int, int]:
+        ports = set()
+        while len(ports) < 2:
+            port = free_port()
+            if port not in self.routes and port not in self.routes.values():
+                ports.add(port)
+        port, upstream = ports
+        self.routes[port] = upstream
+        return port, upstream
+
+    def start(self) -> None:
+        self.control, remote = Pipe()
+        self.process = Process(
+            target=serve,
+            args=(self.routes, self.impairment, self.seed, remote),
+            daemon=True,
+        )
+        self.process.start()
+        self.control.recv()
+
+    def stop(self) -> dict[str, int]:
+        self.control.send("stop")
+        stats = self.control.recv()
+        self.process.join()
+        totals = {"forwarded": 0, "dropped": 0, "reordered": 0}
+        for links in stats.values():
+            for link in links.values():
+                for name, value in link.items():
+                    totals[name] += value
+        return totals
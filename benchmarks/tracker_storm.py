@@ -0,0 +1,158 @@
+"""Times tracker requests while many nodes register at once.
+
+The tracker runs in a process of its own. Every client connects, waits for
+the others and sends a full registration of its files, then goes through
+rounds of a delta adding a block, a heartbeat and a batched lookup. Prints
+the latency of each kind of request as JSON.
+
+    PYTHONPATH=.:filetransfer python benchmarks/tracker_storm.py --clients 100
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import socket
+import tempfile
+import threading
+import time
+from multiprocessing import Event, Process
+from pathlib import Path
+
+from benchmarks.netem import HOST, free_port
+from filetransfer.tracker import Tracker
+from filetransfer.utils import Address, FrameBuffer, encode_frame
+
+
+def serve_tracker(port: int, store_path: str, ready) -> None:
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        tracker = Tracker(
+            address=Address(host=HOST, port=port), store_path=Path(store_path)
+        )
+        ready.set()
+        tracker.start()
+
+
+class Client:
+    def __init__(self, port: int):
+        self.socket = socket.create_connection((HOST, port))
+        self.frames = FrameBuffer()
+
+    def request(self, message: str) -> tuple[str, float]:
+        start = time.perf_counter()
+        self.socket.sendall(encode_frame(1, message.encode("utf-8")))
+        while not (responses := self.frames.feed(self.socket.recv(65536))):
+            pass
+        return responses[0][1].decode("utf-8"), time.perf_counter() - start
+
+
+def summarize(latencies: list[float]) -> dict[str, float]:
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 3),
+        "p99_ms": round(latencies[len(latencies) * 99 // 100] * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3),
+    }
+
+
+def run(args: argparse.Namespace) -> dict:
+    port = free_port(socket.SOCK_STREAM)
+    ready = Event()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tracker = Process(
+            target=serve_tracker,
+            args=(port, str(Path(tmpdir) / "FS_Data.json"), ready),
+            daemon=True,
+        )
+        tracker.start()
+        ready.wait()
+
+        latencies: dict[str, list[float]] = {
+            "register": [],
+            "delta": [],
+            "heartbeat": [],
+            "lookup": [],
+        }
+        errors = []
+        barrier = threading.Barrier(args.clients)
+        all_files = [
+            f"client{i}/file{j}.bin"
+            for i in range(args.clients)
+            for j in range(args.files)
+        ]
+
+        def client(index: int):
+            rng = random.Random(args.seed + index)
+            node = Client(port)
+            node_port = 20_000 + index
+            files = all_files[index * args.files : (index + 1) * args.files]
+            registration = "".join(
+                f"\n+;{name};{args.blocks * 1024};1024;;0-{args.blocks - 2}"
+                for name in files
+            )
+            local = {name: [] for name in latencies}
+            barrier.wait()
+            response, latency = node.request(f"5;{node_port};0{registration}")
+            local["register"].append(latency)
+            if not response.startswith("OK"):
+                errors.append(response)
+            version = 1
+            for _ in range(args.rounds):
+                name = rng.choice(files)
+                response, latency = node.request(
+                    f"5;{node_port};{version}\n*;{name};{args.blocks - 1}"
+                )
+                local["delta"].append(latency)
+                if response.startswith("OK"):
+                    version += 1
+                else:
+                    errors.append(response)
+                _, latency = node.request(f"6;{node_port}")
+                local["heartbeat"].append(latency)
+                lookup = "\n".join(["7", *rng.sample(all_files, args.lookups)])
+                _, latency = node.request(lookup)
+                local["lookup"].append(latency)
+            node.socket.close()
+            for name, values in local.items():
+                latencies[name].extend(values)
+
+        threads = [
+            threading.Thread(target=client, args=(i,)) for i in range(args.clients)
+        ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        tracker.terminate()
+        tracker.join()
+
+    requests = sum(len(values) for values in latencies.values())
+    return {
+        "clients": args.clients,
+        "files_per_client": args.files,
+        "seconds": round(elapsed, 3),
+        "requests_per_s": round(requests / elapsed, 1),
+        "errors": len(errors),
+        **{name: summarize(values) for name, values in latencies.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--blocks", type=int, default=8)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--lookups", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(json.dumps(run(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""Downloads one file from N seeders to M downloaders on localhost, with every
+node behind a proxy that adds loss, delay, reordering and a bandwidth cap.
+
+Prints throughput, block latency and the retransmit ratio as JSON.
+
+    PYTHONPATH=.:filetransfer python benchmarks/transfer.py --loss 0.05 --delay 10
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import random
+import socket
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from benchmarks.netem import HOST, ImpairedNetwork, Impairment
+from filetransfer.node import Node
+from filetransfer.tracker import Tracker
+from filetransfer.utils import Address
+
+FILE_NAME = "bench.bin"
+
+
+class ProxiedNode(Node):
+    """Node listening on `bind_port` while the tracker hands out the port of its
+    proxy, so all its traffic goes through the proxy. Times every block."""
+
+    def __init__(self, *, bind_port: int, **kwargs):
+        self.bind_port = bind_port
+        self.block_latencies: list[float] = []
+        super().__init__(**kwargs)
+
+    def bind_transfer_socket(self) -> socket.socket:
+        transfer_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        transfer_socket.bind((HOST, self.bind_port))
+        return transfer_socket
+
+    async def download(self, **kwargs) -> bool:
+        start = time.perf_counter()
+        completed = await super().download(**kwargs)
+        if completed:
+            self.block_latencies.append(time.perf_counter() - start)
+        return completed
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    return sorted(values)[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def run(args: argparse.Namespace) -> dict:
+    impairment = Impairment(
+        loss=args.loss,
+        delay=args.delay / 1000,
+        jitter=args.jitter / 1000,
+        reorder=args.reorder,
+        bandwidth=args.bandwidth * 1e6 if args.bandwidth else None,
+    )
+    network = ImpairedNetwork(impairment, seed=args.seed)
+    routes = [network.route() for _ in range(args.seeders + args.downloaders)]
+    network.start()
+    payload = random.Random(args.seed).randbytes(args.size)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = Path(tmpdir)
+        tracker = Tracker(
+            address=Address(host=HOST, port=0), store_path=root / "FS_Data.json"
+        )
+        threading.Thread(target=tracker.start, daemon=True).start()
+        server_address = Address(
+            host=HOST, port=tracker.server_socket.getsockname()[1]
+        )
+
+        nodes = []
+        for i, (port, bind_port) in enumerate(routes):
+            storage = root / f"node{i}"
+            storage.mkdir()
+            if i < args.seeders:
+                (storage / FILE_NAME).write_bytes(payload)
+            nodes.append(
+                ProxiedNode(
+                    bind_port=bind_port,
+                    storage_folder=str(storage),
+                    server_address=server_address,
+                    address=Address(host=HOST, port=port),
+                    block_size=args.block_size,
+                )
+            )
+        downloaders = nodes[args.seeders :]
+
+        durations: dict[int, float] = {}
+        barrier = threading.Barrier(len(downloaders))
+
+        def download(index: int, node: ProxiedNode):
+            file = node.get_file_info(file_name=FILE_NAME)
+            barrier.wait()
+            start = time.perf_counter()
+            if file is not None and node.run(node.download_file(file=file)):
+                durations[index] = time.perf_counter() - start
+
+        threads = [
+            threading.Thread(target=download, args=(i, node))
+            for i, node in enumerate(downloaders)
+        ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        ok = len(durations) == len(downloaders) and all(
+            (node.storage_path / FILE_NAME).read_bytes() == payload
+            for node in downloaders
+        )
+        latencies = [latency for node in nodes for latency in node.block_latencies]
+        peers = [peer for node in nodes for peer in node.stats().values()]
+        sent = sum(peer["sent"] for peer in peers)
+        retransmitted = sum(peer["retransmitted"] for peer in peers)
+        for node in nodes:
+            node.stop()
+    proxy = network.stop()
+
+    return {
+        "impairment": impairment.to_dict(),
+        "seeders": args.seeders,
+        "downloaders": args.downloaders,
+        "bytes": args.size,
+        "block_size": args.block_size,
+        "ok": ok,
+        "seconds": round(elapsed, 3),
+        "slowest_download_s": round(max(durations.values(), default=elapsed), 3),
+        "throughput_mb_s": round(args.size * len(durations) / elapsed / 1e6, 3),
+        "blocks": len(latencies),
+        "block_p50_ms": round(percentile(latencies, 0.5) * 1000, 3),
+        "block_p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "packets_sent": sent,
+        "packets_retransmitted": retransmitted,
+        "retransmit_ratio": round(retransmitted / sent, 4) if sent else 0.0,
+        "proxy": proxy,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seeders", type=int, default=3)
+    parser.add_argument("--downloaders", type=int, default=1)
+    parser.add_argument("--size", type=int, default=16 * 2**20)
+    parser.add_argument("--block-size", type=int, default=2**18)
+    parser.add_argument("--loss", type=float, default=0.0)
+    parser.add_argument("--delay", type=float, default=0.0, help="ms, each way")
+    parser.add_argument("--jitter", type=float, default=0.0, help="ms, each way")
+    parser.add_argument("--reorder", type=float, default=0.0)
+    parser.add_argument(
+        "--bandwidth", type=float, default=None, help="MB/s per node and direction"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = run(args)
+    print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
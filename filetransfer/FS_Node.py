@@ -1,7 +1,7 @@
 from argparse import ArgumentParser
 
-from node import Node
-from utils import Address
+from node import WINDOW_SIZE, Node
+from utils import BLOCK_SIZE, PACKET_SIZE, Address
 
 
 def main():
@@ -10,6 +10,30 @@ def main():
     parser.add_argument("storage_folder", type=str, help="File storage folder")
     parser.add_argument("server_host", type=str, help="Server host")
     parser.add_argument("server_port", type=int, help="Server port")
+    parser.add_argument(
+        "--window-size",
+        type=int,
+        default=WINDOW_SIZE,
+        help="Packets in flight per block",
+    )
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        default=BLOCK_SIZE,
+        help="Size in bytes of the blocks registered in the tracker",
+    )
+    parser.add_argument(
+        "--packet-size",
+        type=int,
+        default=PACKET_SIZE,
+        help="Payload bytes per UDP packet, keep below the path MTU",
+    )
+    parser.add_argument(
+        "--upload-limit",
+        type=float,
+        default=None,
+        help="Global upload cap in bytes per second",
+    )
     args = parser.parse_args()
 
     print(
@@ -19,20 +43,25 @@ def main():
     node = Node(
         storage_folder=args.storage_folder,
         server_address=Address(host=args.server_host, port=args.server_port),
+        window_size=args.window_size,
+        block_size=args.block_size,
+        packet_size=args.packet_size,
+        upload_limit=args.upload_limit,
     )
 
     try:
         while True:
             choice = input(
-                "Escolha uma operação:\n1 - Atualizar Node\n2 - Informação Ficheiros   "
-                "             \n3;(file_name) - Descarregar Ficheiro\n4 - Fechar\n"
+                "Escolha uma operação:\n1 - Atualizar Node\n2[;(glob)] - Informação"
+                " Ficheiros\n3;(file_name) - Descarregar Ficheiro\n4 - Fechar\n5 -"
+                " Estatísticas\n6;(glob) - Descarregar Ficheiros\n"
             )
             if choice == "1":
                 node.udp_stop()
                 node.regist()
 
-            elif choice == "2":
-                node.get_file_list()
+            elif choice[0] == "2":
+                node.get_file_list(glob=choice[2:] or None)
 
             elif choice[0] == "3":
                 node.get_file(file_name=choice[2:])
@@ -40,6 +69,13 @@ def main():
             elif choice == "4":
                 node.close()
                 break
+
+            elif choice == "5":
+                for peer, stats in node.stats().items():
+                    print(f"{peer}: {stats}")
+
+            elif choice[0] == "6":
+                node.get_files(glob=choice[2:] or None)
     except KeyboardInterrupt:
         pass
     finally:
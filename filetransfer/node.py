@@ -1,325 +1,1120 @@
+import asyncio
+import hashlib
+import json
 import os
 import socket
+import struct
 import traceback
-from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from dataclasses import dataclass, field
+from itertools import count
 from pathlib import Path
-from threading import Lock
-from time import sleep
-from typing import Optional
+from threading import Event, Lock, Thread
+from time import monotonic, sleep
+from typing import Any, Awaitable, Callable, Iterator, Optional, TypeVar, Union
 
 from utils import (
+    BLOCK_SIZE,
+    HASH_SIZE,
+    HEADER,
+    MAX_CWND,
+    OP_ACK,
+    OP_CANCEL,
+    OP_DATA,
+    OP_END,
+    OP_MISSING_BLOCK,
+    OP_REQUEST,
+    OP_UNKNOWN_FILE,
+    PACKET_SIZE,
     Address,
+    AimdController,
+    BlockHashCache,
+    BlockId,
+    BlockRanges,
+    BlockRequest,
+    BlockScheduler,
+    CongestionController,
+    DownloadState,
     File,
+    FileId,
+    FileInfoCache,
+    FileName,
     FilePeers,
+    FrameBuffer,
+    ManifestEntry,
+    MappedFileCache,
+    NodeManifest,
     PacketInfo,
+    PeerState,
+    ReceivedBlock,
+    RetransmitQueue,
+    RttEstimator,
     SentBlock,
     SentCatalog,
-    SentClient,
     SentPacket,
-    is_socket_alive,
+    TokenBucket,
+    count_blocks,
+    encode_frame,
+    is_relative_name,
+    preallocate,
 )
 
-BUFFER_SIZE = 1024
-BLOCK_SIZE = 16
-PACKET_SIZE = 4
-UDP_BUFFER_SIZE = PACKET_SIZE * 6 + 30
+BUFFER_SIZE = 65536
 RECONNECT_MAX_TRIES = 5
+WINDOW_SIZE = 32
+PART_SUFFIX = ".part"
+STATE_SUFFIX = ".state"
+TMP_STATE_SUFFIX = f"{STATE_SUFFIX}.tmp"
+PARTIAL_ANNOUNCE_INTERVAL = 5
+HASH_CACHE_NAME = ".block_hashes.json"
+MANIFEST_NAME = ".manifest.json"
+MAX_BLOCK_DOWNLOADS = 64
+MAX_PEER_DOWNLOADS = 16
+BLOCK_TIMEOUT = 2.0
+REQUEST_RETRIES = 3
+PACKET_RETRIES = 8
+SOCKET_BUFFER_SIZE = 4 * 2**20
+ENDGAME_BLOCKS = 8
+ENDGAME_COPIES = 3
+HEARTBEAT_INTERVAL = 10.0
+LIST_PAGE_SIZE = 1000
+LOOKUP_BATCH = 1000
+
+T = TypeVar("T")
+DownloadKey = tuple[tuple[str, int], FileId, BlockId]
+
+
+@dataclass
+class BlockDownload:
+    block: ReceivedBlock
+    fd: int
+    offset: int
+    done: asyncio.Future
+    hasher: "hashlib.blake2b" = field(
+        default_factory=lambda: hashlib.blake2b(digest_size=HASH_SIZE)
+    )
+    buffer: Optional[bytearray] = None
+    last_packet: float = field(default_factory=monotonic)
+    end: Optional[int] = None
+
+
+class TransferProtocol(asyncio.DatagramProtocol):
+    def __init__(self, node: "Node"):
+        self.node = node
+
+    def datagram_received(self, data: bytes, addr: tuple[str, int]) -> None:
+        self.node.udp_handler(
+            data=data, client_address=Address(host=addr[0], port=addr[1])
+        )
+
+    def error_received(self, exc: Exception) -> None:
+        print(f"Erro FS Transfer Protocol: {exc}")
+
+
+@dataclass
+class FileDownload:
+    file: File
+    peers: FilePeers
+    state: DownloadState
+    part_path: Path
+    state_path: Path
+    fd: Optional[int] = None
+
+    def open(self) -> None:
+        self.part_path.parent.mkdir(parents=True, exist_ok=True)
+        self.fd = os.open(self.part_path, os.O_RDWR | os.O_CREAT, 0o644)
+        preallocate(self.fd, self.peers.size)
+
+
+class TrackerConnection:
+    """Persistent connection to the tracker, shared by every request of a node.
+
+    Requests are framed with an id and may be pipelined from any thread. A reader
+    thread resolves the future of each request as its response arrives, in
+    whatever order that is. Requests lost with a dropped connection resolve to
+    None.
+    """
+
+    def __init__(self, address: Address):
+        self.address = address
+        self.socket: Optional[socket.socket] = None
+        self.pending: dict[int, Future] = {}
+        self.request_ids = count(1)
+        self.guard = Lock()
+
+    def connect(self) -> None:
+        self.socket = socket.create_connection(self.address.get())
+        self.pending = {}
+        Thread(
+            target=self.read_responses, args=(self.socket, self.pending), daemon=True
+        ).start()
+
+    def read_responses(
+        self, server_socket: socket.socket, pending: dict[int, Future]
+    ) -> None:
+        frames = FrameBuffer()
+        try:
+            while data := server_socket.recv(BUFFER_SIZE):
+                for request_id, response in frames.feed(data):
+                    if (future := pending.pop(request_id, None)) is not None:
+                        future.set_result(response.decode("utf-8"))
+        except (OSError, ValueError):
+            pass
+        with self.guard:
+            if self.socket is server_socket:
+                self.close()
+            while pending:
+                pending.popitem()[1].set_result(None)
+
+    def submit(self, message: str) -> Future:
+        """The lock is only held while trying to send, never while waiting to
+        reconnect, so other requests and the reader thread carry on."""
+        future = Future()
+        frame = message.encode("utf-8")
+        request_id = next(self.request_ids)
+        for retry_count in range(1, RECONNECT_MAX_TRIES + 2):
+            with self.guard:
+                try:
+                    if self.socket is None:
+                        self.connect()
+                    self.pending[request_id] = future
+                    self.socket.sendall(encode_frame(request_id, frame))
+                    return future
+                except OSError:
+                    self.pending.pop(request_id, None)
+                    self.close()
+            if retry_count > RECONNECT_MAX_TRIES:
+                break
+            print(
+                f"Servidor {self.address.to_string()} não disponível."
+                f"A tentar novamente em {retry_count} segundos"
+            )
+            sleep(retry_count)
+        future.set_result(None)
+        return future
+
+    def request(self, message: str) -> Optional[str]:
+        return self.submit(message).result()
+
+    def close(self) -> None:
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
 
 
 class Node:
-    server_socket: Optional[socket.socket] = None
+    transport: Optional[asyncio.DatagramTransport] = None
+    transfer_socket: Optional[socket.socket] = None
+    retry_handle: Optional[asyncio.TimerHandle] = None
+    throttle_handle: Optional[asyncio.TimerHandle] = None
+    max_window: int = MAX_CWND
 
     def __init__(
         self,
         *,
         storage_folder: str,
         server_address: Address,
-        address: Address = Address(port=9090),
-        n_threads: int = 10,
+        address: Optional[Address] = None,
+        max_downloads: int = MAX_BLOCK_DOWNLOADS,
+        max_peer_downloads: int = MAX_PEER_DOWNLOADS,
+        block_timeout: float = BLOCK_TIMEOUT,
+        window_size: int = WINDOW_SIZE,
+        block_size: int = BLOCK_SIZE,
+        packet_size: int = PACKET_SIZE,
+        congestion_control: Callable[[], CongestionController] = AimdController,
+        upload_limit: Optional[float] = None,
+        heartbeat_interval: float = HEARTBEAT_INTERVAL,
+        packet_retries: int = PACKET_RETRIES,
     ):
-        self.address = address
+        self.address = address if address is not None else Address(port=9090)
+        self.window_size = window_size
+        self.block_size = block_size
+        self.packet_size = packet_size
         self.server_address = server_address
-        self.transfer_socket = socket.socket(
-            family=socket.AF_INET, type=socket.SOCK_DGRAM
-        )
-        self.transfer_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.transfer_socket.bind(self.address.get())
+        self.tracker = TrackerConnection(server_address)
         self.storage_path = (
             Path(__file__).parents[1] / "assets" / "file_system" / storage_folder
         )
-        self.thread_pool = ThreadPoolExecutor(max_workers=n_threads)
+        self.max_downloads = max_downloads
+        self.max_peer_downloads = max_peer_downloads
+        self.block_timeout = block_timeout
+        self.packet_retries = packet_retries
         self.running = False
         self.sent_packets = SentCatalog({})
-        self.packet_guard = Lock()
+        self.retransmits = RetransmitQueue()
+        self.congestion_control = congestion_control
+        self.peers: dict[Address, PeerState] = {}
+        self.upload_bucket = (
+            TokenBucket(rate=upload_limit, burst=max(upload_limit / 10, packet_size))
+            if upload_limit
+            else None
+        )
+        self.throttled: set[Address] = set()
+        self.downloads: dict[DownloadKey, BlockDownload] = {}
+        self.file_names: dict[tuple[Address, FileId], FileName] = {}
+        self.mapped_files = MappedFileCache()
+        self.partial: dict[FileName, DownloadState] = {}
+        self.file_cache = FileInfoCache()
+        self.hash_pool = ThreadPoolExecutor(max_workers=os.cpu_count())
+        self.block_hashes = BlockHashCache(
+            path=self.storage_path / HASH_CACHE_NAME, executor=self.hash_pool
+        )
+        self.announced_files: set[tuple[Address, FileId]] = set()
+        self.registration_guard = Lock()
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_stop = Event()
+        self.heartbeat_thread: Optional[Thread] = None
+        try:
+            self.manifest = NodeManifest.load(path=self.storage_path / MANIFEST_NAME)
+        except (FileNotFoundError, ValueError, KeyError, TypeError):
+            self.manifest = NodeManifest()
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = Thread(target=self.loop.run_forever, daemon=True)
+        self.loop_thread.start()
         self.regist()
 
-    def connect(self):
-        self.server_socket = socket.socket(
-            family=socket.AF_INET, type=socket.SOCK_STREAM
-        )
-        self.server_socket.connect(self.server_address.get())
+    def get_peer(self, client_address: Address) -> PeerState:
+        if client_address not in self.peers:
+            congestion = self.congestion_control()
+            congestion.max_cwnd = min(congestion.max_cwnd, self.max_window)
+            self.peers[client_address] = PeerState(
+                rtt=RttEstimator(), congestion=congestion
+            )
+        return self.peers[client_address]
 
-    def send_to_server(self, message: str, retry_count: int = 1) -> None:
-        try:
-            if self.server_socket is None or not is_socket_alive(self.server_socket):
-                self.connect()
-            self.server_socket.sendall(message.encode("utf-8"))
-        except Exception as e:
-            self.disconnect_server()
-            if retry_count <= RECONNECT_MAX_TRIES:
-                print(
-                    f"Servidor {self.server_address.to_string()} não disponível."
-                    f"A tentar novamente em {retry_count} segundos"
-                )
-                sleep(retry_count)
-                self.send_to_server(message=message, retry_count=retry_count + 1)
+    def stats(self) -> dict[str, dict[str, float]]:
+        return {
+            f"{address.host}:{address.port}": peer.stats()
+            for address, peer in self.peers.items()
+        }
 
-    def udp_packet_retry_one_client(self, *, client: SentClient):
-        for file in client.files.values():
-            for block in file.blocks.values():
-                if not block.packets:
-                    continue
-                packet = list(block.packets.values())[0]
-                if packet.should_resend():
-                    print("A reenviar pacote...")
-                    self.send_packet(
-                        packet=packet,
-                        client_address=client.client_address,
-                    )
-                    packet.update()
+    def pump(self, client_address: Address) -> None:
+        """Sends new packets to a peer, round-robin over its blocks, while its
+        congestion window, the per-block window and the upload cap allow it."""
+        peer = self.get_peer(client_address)
+        stalled = 0
+        while (
+            peer.blocks
+            and stalled < len(peer.blocks)
+            and peer.in_flight < peer.congestion.window()
+        ):
+            block = peer.blocks[0]
+            if not block.has_unsent():
+                peer.blocks.popleft()
+                stalled = 0
+                continue
+            peer.blocks.rotate(-1)
+            if block.n_in_flight() >= self.window_size:
+                stalled += 1
+                continue
+            stalled = 0
+            if self.upload_bucket is not None:
+                size = len(block.packets[block.next_packet_id].data)
+                delay = self.upload_bucket.wait_time(size, monotonic())
+                if delay > 0:
+                    self.throttle(client_address, delay)
+                    return
+            for packet in block.next_packets(count=1):
+                peer.in_flight += 1
+                self.send_packet(packet=packet, client_address=client_address)
 
-    def udp_packet_retry(self):
-        try:
-            print("A verificar pacotes...")
-            while self.running:
-                sleep(5)
-                print("FR", self.sent_packets)
-                with self.packet_guard:
-                    for client in self.sent_packets.clients.values():
-                        self.udp_packet_retry_one_client(client=client)
-        except Exception as e:
-            traceback.print_exc()
-            print(e)
-            os._exit(1)
+    def throttle(self, client_address: Address, delay: float) -> None:
+        self.throttled.add(client_address)
+        if self.throttle_handle is None:
+            self.throttle_handle = self.loop.call_later(delay, self.resume_throttled)
 
-    def udp_start(self):
-        try:
-            self.thread_pool.submit(self.udp_packet_retry)
-            self.running = True
-            while self.running:
-                print(f"FS Transfer Protocol: à escuta UDP em {self.address.get()}")
-                data, address = self.transfer_socket.recvfrom(UDP_BUFFER_SIZE)
-                self.thread_pool.submit(
-                    self.udp_handler,
-                    data=data,
-                    client_address=Address(host=address[0], port=address[1]),
-                )
-        except Exception as e:
-            import os
-            import traceback
+    def resume_throttled(self) -> None:
+        self.throttle_handle = None
+        throttled, self.throttled = self.throttled, set()
+        for client_address in throttled:
+            self.pump(client_address)
 
-            traceback.print_exc()
-            print(e)
-            os._exit(1)
+    def schedule_retransmit(self) -> None:
+        deadline = self.retransmits.next_deadline()
+        if deadline is None:
+            return
+        if self.retry_handle is not None:
+            if self.retry_handle.when() <= deadline:
+                return
+            self.retry_handle.cancel()
+        self.retry_handle = self.loop.call_at(deadline, self.retransmit_expired)
 
-    def udp_stop(self):
+    def retransmit_expired(self) -> None:
+        """A block whose packet went unacknowledged `packet_retries` times is
+        dropped, as the peer is gone or lost interest in it."""
+        self.retry_handle = None
+        for client_address, packet in self.retransmits.pop_expired(monotonic()):
+            packet_info = PacketInfo(file_id=packet.file_id, block_id=packet.block_id)
+            block = self.sent_packets.get_block(
+                packet_info=packet_info, client=client_address
+            )
+            if block is None or block.packets.get(packet.packet_id) is not packet:
+                continue
+            if packet.retries >= self.packet_retries:
+                print(f"Bloco {packet.block_id} sem ACK de {client_address.get()}")
+                self.drop_block(packet_info=packet_info, client_address=client_address)
+                continue
+            peer = self.get_peer(client_address)
+            peer.rtt.backoff(sent_at=packet.sent_at)
+            peer.congestion.on_loss(sent_at=packet.sent_at)
+            packet.retries += 1
+            peer.retransmitted += 1
+            self.send_packet(packet=packet, client_address=client_address)
+        self.schedule_retransmit()
+
+    async def start_transfer(self):
+        """Blocks still being sent when the transfer last stopped are picked up
+        where they were left."""
+        self.transfer_socket = self.bind_transfer_socket()
+        self.max_window = self.size_socket_buffers(self.transfer_socket)
+        self.transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: TransferProtocol(self), sock=self.transfer_socket
+        )
+        self.running = True
+        self.schedule_retransmit()
+        self.resume_throttled()
+        print(f"FS Transfer Protocol: à escuta UDP em {self.address.get()}")
+
+    async def stop_transfer(self):
         self.running = False
+        if self.retry_handle is not None:
+            self.retry_handle.cancel()
+            self.retry_handle = None
+        if self.throttle_handle is not None:
+            self.throttle_handle.cancel()
+            self.throttle_handle = None
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    def udp_start(self):
+        if self.transport is None:
+            self.run(self.start_transfer())
+
+    def udp_stop(self):
+        self.run(self.stop_transfer())
+
+    def run(self, coroutine: Awaitable[T]) -> T:
+        """Runs a coroutine on the transfer loop and waits for its result."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def bind_transfer_socket(self) -> socket.socket:
+        transfer_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        transfer_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        transfer_socket.bind(self.address.get())
+        return transfer_socket
+
+    def size_socket_buffers(self, transfer_socket: socket.socket) -> int:
+        """Raises the socket buffers, as far as the kernel allows, and returns how
+        many packets the receive buffer holds. Linux reports double the size set,
+        for its bookkeeping, and a datagram takes about twice its length of it."""
+        for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+            transfer_socket.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER_SIZE)
+        size = transfer_socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        return max(size // (2 * (self.packet_size + HEADER.size)), 1)
 
     def disconnect_server(self):
-        self.server_socket.close()
-        self.server_socket = None
+        with self.tracker.guard:
+            self.tracker.close()
 
-    def disconnect_transfer(self):
-        self.transfer_socket.close()
-        self.transfer_socket = None
+    def deregister(self):
+        """Tells the tracker to drop this node's replicas now instead of
+        waiting for them to expire."""
+        self.heartbeat_stop.set()
+        if self.tracker.socket is None:
+            return
+        try:
+            self.tracker.submit(f"4;{self.address.port}").result(
+                timeout=self.heartbeat_interval
+            )
+        except FutureTimeoutError:
+            pass
 
-    def close(self):
+    def stop(self):
         self.udp_stop()
+        self.deregister()
         self.disconnect_server()
-        self.disconnect_transfer()
-        self.thread_pool.shutdown(wait=False, cancel_futures=True)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.hash_pool.shutdown(wait=False, cancel_futures=True)
+
+    def close(self):
+        self.stop()
         os._exit(0)
 
+    def sendto(self, data: bytes, address: Address) -> None:
+        self.transport.sendto(data, address.get())
+
+    def send_scattered(self, header: bytes, payload: memoryview, address: Address):
+        """Sends header and payload as one datagram without joining them first."""
+        try:
+            self.transfer_socket.sendmsg([header, payload], [], 0, address.get())
+        except BlockingIOError:
+            self.sendto(header + payload, address)
+
     def udp_handler(self, *, data: bytes, client_address: Address):
+        """Datagrams that are too short, have an unknown opcode or fields that
+        make no sense are dropped, as is one a handler fails on, so no peer can
+        bring the node down."""
+        if len(data) < HEADER.size:
+            print(f"Pacote inválido de {client_address}")
+            return
         try:
-            packet_info = PacketInfo.from_bytes(data[1:])
-            if data[0] == b"1"[0]:
+            if data[0] == OP_REQUEST:
                 self.file_request_handler(
-                    packet_info=packet_info,
+                    request=BlockRequest.from_bytes(data),
                     client_address=client_address,
                 )
-            elif data[0] == b"2"[0]:
+            elif data[0] == OP_ACK:
                 self.packet_ack_handler(
-                    packet_info=packet_info,
+                    packet_info=PacketInfo.from_bytes(data),
+                    client_address=client_address,
+                )
+            elif data[0] in (OP_DATA, OP_END, OP_UNKNOWN_FILE, OP_MISSING_BLOCK):
+                self.download_handler(data=data, peer_address=client_address)
+            elif data[0] == OP_CANCEL:
+                self.cancel_handler(
+                    packet_info=PacketInfo.from_bytes(data),
                     client_address=client_address,
                 )
             else:
-                print("Error", data)
-        except Exception as e:
-            import os
-            import traceback
-
+                print(f"Pacote inválido de {client_address}")
+        except (struct.error, ValueError) as e:
+            print(f"Pacote inválido de {client_address}: {e!r}")
+        except Exception:
             traceback.print_exc()
-            print(e)
-            os._exit(1)
 
-    def file_request_handler(self, *, packet_info: PacketInfo, client_address: Address):
+    def file_request_handler(self, *, request: BlockRequest, client_address: Address):
+        """File ids are the tracker's, but a peer names the file it means and only
+        maps the id to that name for its own requests, so it can never change
+        what another peer is served."""
         print("A enviar ficheiro...")
-        file_path = self.storage_path / f"{packet_info.file_name}"
-        with open(file_path, mode="rb") as fp:
-            fp.seek(packet_info.block_id * BLOCK_SIZE)
-            packet_count = 0
-            block = SentBlock(block_id=packet_info.block_id, packets={})
-            while (packet := fp.read(PACKET_SIZE)) and packet_count < (
-                BLOCK_SIZE // PACKET_SIZE
-            ):
-                block.add_packet(packet=SentPacket(packet_id=packet_count, data=packet))
-                packet_count += 1
-            with self.packet_guard:
-                self.sent_packets.add_block(
-                    client=client_address,
-                    file_name=packet_info.file_name,
-                    block=block,
+        packet_info = PacketInfo(file_id=request.file_id, block_id=request.block_id)
+        key = (client_address, request.file_id)
+        if request.file_name is not None and is_relative_name(request.file_name):
+            self.file_names[key] = request.file_name
+        if key not in self.file_names:
+            self.sendto(packet_info.to_bytes(OP_UNKNOWN_FILE), client_address)
+            return
+        if self.sent_packets.get_block(packet_info=packet_info, client=client_address):
+            return
+        file_path = self.shared_file_path(self.file_names[key], request)
+        if file_path is None:
+            self.sendto(packet_info.to_bytes(OP_MISSING_BLOCK), client_address)
+            return
+        packet_size = min(request.packet_size, self.packet_size)
+        mapped = self.mapped_files.get(file_path)
+        start = request.block_id * request.block_size
+        end = min(start + request.block_size, len(mapped))
+        block = SentBlock(block_id=request.block_id, packets={})
+        for packet_id, offset in enumerate(range(start, end, packet_size)):
+            block.add_packet(
+                packet=SentPacket(
+                    packet_id=packet_id,
+                    data=mapped[offset : min(offset + packet_size, end)],
+                    file_id=request.file_id,
+                    block_id=request.block_id,
                 )
-        self.send_packet(
-            packet=self.sent_packets.get_next_packet(
-                packet_info=packet_info, client=client_address
-            ),
-            client_address=client_address,
+            )
+        if not block.packets:
+            self.sendto(packet_info.to_bytes(OP_END), client_address)
+            return
+        self.sent_packets.add_block(
+            client=client_address,
+            file_id=request.file_id,
+            block=block,
         )
+        self.get_peer(client_address).blocks.append(block)
+        self.pump(client_address)
 
     def packet_ack_handler(self, *, packet_info: PacketInfo, client_address: Address):
-        with self.packet_guard:
-            self.sent_packets.remove_packet(
-                packet_info=packet_info, client=client_address
-            )
-        next_packet = self.sent_packets.get_next_packet(
+        block = self.sent_packets.get_block(
             packet_info=packet_info, client=client_address
         )
-        if next_packet:
-            self.send_packet(packet=next_packet, client_address=client_address)
-        else:
-            self.transfer_socket.sendto(b"", client_address.get())
+        if block is None or packet_info.packet_id not in block.packets:
+            return
+        packet = block.packets[packet_info.packet_id]
+        peer = self.get_peer(client_address)
+        now = monotonic()
+        if packet.retries == 0:
+            peer.rtt.sample(now - packet.sent_at)
+        peer.congestion.on_ack()
+        peer.rate.add(len(packet.data), now)
+        peer.in_flight -= 1
+        self.sent_packets.remove_packet(packet_info=packet_info, client=client_address)
+        if not block.packets:
+            self.sendto(packet_info.to_bytes(OP_END), client_address)
+        self.pump(client_address)
+
+    def cancel_handler(self, *, packet_info: PacketInfo, client_address: Address):
+        """Drops a block the peer no longer wants, usually an endgame loser."""
+        self.drop_block(packet_info=packet_info, client_address=client_address)
+
+    def drop_block(self, *, packet_info: PacketInfo, client_address: Address):
+        block = self.sent_packets.get_block(
+            packet_info=packet_info, client=client_address
+        )
+        if block is None:
+            return
+        peer = self.get_peer(client_address)
+        peer.in_flight -= block.n_in_flight()
+        peer.blocks = deque(queued for queued in peer.blocks if queued is not block)
+        self.sent_packets.remove_block(packet_info=packet_info, client=client_address)
+        self.pump(client_address)
 
     def send_packet(self, *, packet: SentPacket, client_address: Address) -> None:
-        def fail_packet() -> bool:
-            import random
+        peer = self.get_peer(client_address)
+        self.send_scattered(packet.header(), packet.data, client_address)
+        peer.sent += 1
+        if self.upload_bucket is not None:
+            self.upload_bucket.consume(len(packet.data), monotonic())
+        packet.update(timeout=peer.rtt.rto)
+        self.retransmits.push(client=client_address, packet=packet)
+        self.schedule_retransmit()
 
-            if random.random() < 0.1:
-                return True
-            return False
+    def download_handler(self, *, data: bytes, peer_address: Address) -> None:
+        packet = SentPacket.from_bytes(data=data)
+        download = self.downloads.get(
+            (peer_address.get(), packet.file_id, packet.block_id)
+        )
+        if download is None or download.done.done():
+            if data[0] == OP_DATA:
+                self.sendto(
+                    PacketInfo(
+                        file_id=packet.file_id, block_id=packet.block_id
+                    ).to_bytes(OP_CANCEL),
+                    peer_address,
+                )
+            return
+        download.last_packet = monotonic()
+        if data[0] == OP_UNKNOWN_FILE:
+            download.done.set_result(OP_UNKNOWN_FILE)
+            return
+        self.announced_files.add((peer_address, packet.file_id))
+        if data[0] in (OP_END, OP_MISSING_BLOCK):
+            download.done.set_result(data[0])
+            return
+        self.get_peer(peer_address).received.add(len(packet.data), monotonic())
+        ack = PacketInfo(
+            file_id=packet.file_id,
+            block_id=packet.block_id,
+            packet_id=packet.packet_id,
+        ).to_bytes()
+        self.sendto(ack, peer_address)
+        for chunk in download.block.add_packet(packet=packet):
+            if download.buffer is None:
+                os.pwrite(download.fd, chunk, download.offset)
+            else:
+                download.buffer += chunk
+            download.offset += len(chunk)
+            download.hasher.update(chunk)
+        if download.end is not None and download.offset >= download.end:
+            download.done.set_result(OP_END)
 
-        if not fail_packet():
-            self.transfer_socket.sendto(packet.to_bytes(), client_address.get())
-            print("Pacote enviado")
-        else:
-            print("Pacote falhou")
+    def request_block(
+        self, *, file: File, address: Address, block: int, block_size: int
+    ) -> None:
+        """The file name only travels until the peer has mapped it to the file id."""
+        announced = (address, file.file_id) in self.announced_files
+        request = BlockRequest(
+            file_id=file.file_id,
+            block_id=block,
+            block_size=block_size,
+            packet_size=self.packet_size,
+            file_name=None if announced else file.name,
+        )
+        self.sendto(request.to_bytes(), address)
 
-    def download(self, *, file_name: str, address: Address, block: int) -> None:
-        try:
-            client_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
-            packet_info = PacketInfo(file_name=file_name, block_id=block, packet_id=-1)
-            message = b"1" + packet_info.to_bytes()
-
-            client_socket.sendto(message, address.get())
-            file_path = self.storage_path / f"{block}_{file_name}"
-            with open(file_path, mode="wb") as fp:
-                expected_packet = 0
-                while True:
-                    data, address = client_socket.recvfrom(UDP_BUFFER_SIZE)
-                    if not data:
-                        break
-                    packet = SentPacket.from_bytes(data=data)
-                    packet_info = PacketInfo(
-                        file_name=file_name,
-                        block_id=block,
-                        packet_id=packet.packet_id,
-                    )
-                    ack = b"2" + packet_info.to_bytes()
-                    def fail_packet() -> bool:
-                        import random
+    async def download(
+        self,
+        *,
+        file: File,
+        address: Address,
+        block: int,
+        block_size: int,
+        fd: int,
+        expected_hash: Optional[str] = None,
+        buffered: bool = False,
+        length: Optional[int] = None,
+    ) -> bool:
+        """Returns True once the block is on disk and matches its expected hash.
 
-                        if random.random() < 0.1:
-                            return True
+        The request is repeated when the peer goes quiet for `block_timeout` and
+        the block is given up after `REQUEST_RETRIES` repeats. Buffered downloads
+        only write the block once it is verified, so a redundant endgame fetch
+        never overwrites data another peer is writing. A block of known `length`
+        ends with its last byte, without waiting for the peer's `OP_END`.
+        """
+        key = (address.get(), file.file_id, block)
+        download = BlockDownload(
+            block=ReceivedBlock(file_id=file.file_id, block_id=block),
+            fd=fd,
+            offset=block * block_size,
+            done=self.loop.create_future(),
+            buffer=bytearray() if buffered else None,
+            end=None if length is None else block * block_size + length,
+        )
+        self.downloads[key] = download
+        try:
+            self.request_block(
+                file=file, address=address, block=block, block_size=block_size
+            )
+            retries = 0
+            while True:
+                await asyncio.wait({download.done}, timeout=self.block_timeout)
+                if not download.done.done():
+                    if monotonic() - download.last_packet < self.block_timeout:
+                        continue
+                    if retries == REQUEST_RETRIES:
+                        print(f"Bloco {block} sem resposta de {address.get()}")
+                        self.abort_download(
+                            file_id=file.file_id, address=address, block=block
+                        )
                         return False
+                    retries += 1
+                elif download.done.result() == OP_UNKNOWN_FILE:
+                    self.announced_files.discard((address, file.file_id))
+                    download.done = self.loop.create_future()
+                else:
+                    break
+                self.request_block(
+                    file=file, address=address, block=block, block_size=block_size
+                )
+            if download.done.result() != OP_END:
+                return False
+            if expected_hash and download.hasher.hexdigest() != expected_hash:
+                print(f"Bloco {block} corrompido vindo de {address.get()}")
+                return False
+            if download.buffer is not None:
+                os.pwrite(fd, download.buffer, block * block_size)
+            return True
+        except asyncio.CancelledError:
+            self.abort_download(file_id=file.file_id, address=address, block=block)
+            raise
+        finally:
+            self.downloads.pop(key, None)
 
-                    if not fail_packet():
-                        client_socket.sendto(ack, address)
-                    if packet and packet.packet_id == expected_packet:
-                        fp.write(packet.data)
-                        expected_packet += 1
-        except Exception as e:
-            import os
-            import traceback
+    def abort_download(self, *, file_id: FileId, address: Address, block: int):
+        """Stops accepting packets for a block and tells the peer to stop sending."""
+        if self.downloads.pop((address.get(), file_id, block), None) is not None:
+            self.sendto(
+                PacketInfo(file_id=file_id, block_id=block).to_bytes(OP_CANCEL),
+                address,
+            )
 
-            traceback.print_exc()
-            print(e)
-            os._exit(1)
+    def download_rates(self) -> dict[Address, float]:
+        return {
+            address: peer.received.rate
+            for address, peer in self.peers.items()
+            if peer.received.rate
+        }
+
+    def partial_paths(self, file_name: FileName) -> tuple[Path, Path]:
+        part_path = self.storage_path / f"{file_name}{PART_SUFFIX}"
+        return part_path, part_path.with_name(f"{part_path.name}{STATE_SUFFIX}")
+
+    def load_partial(self, file_name: FileName) -> Optional[DownloadState]:
+        """An unreadable sidecar counts as no partial download, so the file is
+        downloaded afresh."""
+        if file_name not in self.partial:
+            part_path, state_path = self.partial_paths(file_name)
+            if not part_path.exists() or not state_path.exists():
+                return None
+            try:
+                self.partial[file_name] = DownloadState.load(path=state_path)
+            except (OSError, ValueError, KeyError, TypeError):
+                print(f"Estado de {file_name} ilegível, a descarregar de novo")
+                return None
+        return self.partial[file_name]
 
-    def regist_file(self, file_path: Path) -> str:
-        message = f"{file_path.name};"
+    def shared_file_path(
+        self, file_name: FileName, request: BlockRequest
+    ) -> Optional[Path]:
+        """Complete files serve any block; partial ones only their finished blocks."""
+        file_path = self.storage_path / file_name
+        if file_path.exists():
+            return file_path
+        state = self.load_partial(file_name)
+        if (
+            state is None
+            or state.block_size != request.block_size
+            or request.block_id >= state.completed.n_blocks
+            or request.block_id not in state.completed
+        ):
+            return None
+        return self.partial_paths(file_name)[0]
+
+    async def announce_partial(self) -> None:
+        while True:
+            await asyncio.sleep(PARTIAL_ANNOUNCE_INTERVAL)
+            await self.loop.run_in_executor(None, self.send_registration)
+
+    async def download_file(self, *, file: File) -> bool:
+        return (await self.download_files(files=[file]))[file.name]
+
+    async def download_files(self, *, files: list[File]) -> dict[FileName, bool]:
+        """Downloads every missing block of the files straight into preallocated
+        `.part` files.
+
+        All blocks go through one scheduler, so the files share the peers and
+        the download slots, and smaller files are fetched first. A `.part` file
+        is only opened once its first block starts. Finished blocks are
+        recorded in a `.part.state` sidecar, so an interrupted download resumes
+        where it stopped, and are announced to the tracker while the download
+        runs. Each file is renamed once its last block lands.
+        """
+        results = {file.name: False for file in files}
+        downloads = sorted(
+            (self.file_download(file) for file in files if is_relative_name(file.name)),
+            key=lambda download: download.peers.size,
+        )
+        replicas = {
+            (index, block): addresses
+            for index, download in enumerate(downloads)
+            for block, addresses in download.peers.replicas.items()
+        }
+        scheduler = BlockScheduler(
+            replicas=replicas,
+            blocks=[
+                (index, block)
+                for index, download in enumerate(downloads)
+                for block in download.peers.info
+                if block not in download.state.completed
+            ],
+            peer_limit=self.max_peer_downloads,
+            endgame_blocks=ENDGAME_BLOCKS,
+            endgame_copies=ENDGAME_COPIES,
+            priority=lambda key: key[0],
+        )
+        tasks: dict[tuple[tuple[int, BlockId], Address], asyncio.Task] = {}
+
+        def finish(download: FileDownload):
+            if download.fd is None:
+                download.open()
+            os.close(download.fd)
+            download.fd = None
+            os.replace(download.part_path, self.storage_path / download.file.name)
+            download.state_path.unlink(missing_ok=True)
+            self.partial.pop(download.file.name, None)
+            results[download.file.name] = True
+
+        async def download_block(
+            key: tuple[int, BlockId], address: Address, buffered: bool
+        ):
+            """A failed or corrupt block goes back to the scheduler for another peer;
+            a completed one cancels the endgame fetches still racing for it."""
+            index, block = key
+            download = downloads[index]
+            if download.fd is None:
+                download.open()
+            completed = await self.download(
+                file=download.file,
+                address=address,
+                block=block,
+                block_size=download.peers.block_size,
+                fd=download.fd,
+                expected_hash=download.peers.block_hash(block),
+                buffered=buffered,
+                length=min(
+                    download.peers.block_size,
+                    download.peers.size - block * download.peers.block_size,
+                ),
+            )
+            if completed:
+                for loser in scheduler.complete(key, address):
+                    self.abort_download(
+                        file_id=download.file.file_id, address=loser, block=block
+                    )
+                    tasks[(key, loser)].cancel()
+                download.state.completed.add(block)
+                if download.state.completed.is_complete():
+                    finish(download)
+                else:
+                    download.state.save(path=download.state_path)
+            else:
+                scheduler.fail(key, address)
+
+        for download in downloads:
+            if download.state.completed.is_complete():
+                finish(download)
+        announcer = self.loop.create_task(self.announce_partial())
+        try:
+            while True:
+                for key, address in scheduler.assign(
+                    rates=self.download_rates(),
+                    limit=self.max_downloads - len(tasks),
+                ):
+                    buffered = len(scheduler.fetching[key]) > 1
+                    tasks[(key, address)] = self.loop.create_task(
+                        download_block(key, address, buffered)
+                    )
+                if not tasks:
+                    break
+                done, _ = await asyncio.wait(
+                    tasks.values(), return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if not task.cancelled():
+                        task.result()
+                tasks = {key: task for key, task in tasks.items() if not task.done()}
+        finally:
+            announcer.cancel()
+            for task in tasks.values():
+                task.cancel()
+            for download in downloads:
+                if download.fd is not None:
+                    os.close(download.fd)
+                    download.fd = None
+        for download in downloads:
+            if not results[download.file.name]:
+                print(
+                    f"Ficheiro {download.file.name} incompleto, faltam os blocos"
+                    f" {download.state.completed.missing()}"
+                )
+        return results
+
+    def file_download(self, file: File) -> "FileDownload":
+        """Sets up a file's download, resuming its `.part` file when the peers
+        still describe the same content."""
+        file_peers = FilePeers.from_file(file=file)
+        part_path, state_path = self.partial_paths(file.name)
+        state = self.load_partial(file.name)
+        if state is None or (state.size, state.block_size, state.hashes) != (
+            file_peers.size,
+            file_peers.block_size,
+            file_peers.hashes,
+        ):
+            state = DownloadState.new(
+                size=file_peers.size,
+                block_size=file_peers.block_size,
+                hashes=file_peers.hashes,
+            )
+            self.partial[file.name] = state
+        return FileDownload(
+            file=file,
+            peers=file_peers,
+            state=state,
+            part_path=part_path,
+            state_path=state_path,
+        )
+
+    def file_entry(self, file_path: Path, hashes: list[str]) -> ManifestEntry:
         file_size_bytes = file_path.stat().st_size
-        n_full_blocks = file_size_bytes // BLOCK_SIZE
-        size_last_block = file_size_bytes % BLOCK_SIZE
-        n_blocks = n_full_blocks + 1 if size_last_block > 0 else n_full_blocks
-        message += ",".join(map(str, range(n_blocks)))
-        return message
+        n_blocks = count_blocks(file_size_bytes, self.block_size)
+        return ManifestEntry(
+            size=file_size_bytes,
+            block_size=self.block_size,
+            hashes=hashes,
+            blocks=BlockRanges([(0, n_blocks)]),
+        )
+
+    def partial_entry(self, state: DownloadState) -> ManifestEntry:
+        return ManifestEntry(
+            size=state.size,
+            block_size=state.block_size,
+            hashes=state.hashes,
+            blocks=state.completed.to_ranges(),
+        )
+
+    def partial_entries(self) -> dict[FileName, ManifestEntry]:
+        """Entries of the partial downloads with finished blocks.
+
+        The sidecars are globbed here but loaded and read on the loop, the only
+        thread that touches `partial` while downloads update it.
+        """
+        file_names = [
+            state_path.relative_to(self.storage_path).as_posix()[
+                : -len(PART_SUFFIX + STATE_SUFFIX)
+            ]
+            for state_path in self.storage_path.glob(f"**/*{PART_SUFFIX}{STATE_SUFFIX}")
+        ]
+
+        async def snapshot() -> dict[FileName, ManifestEntry]:
+            for file_name in file_names:
+                self.load_partial(file_name)
+            return {
+                file_name: self.partial_entry(state)
+                for file_name, state in self.partial.items()
+                if len(state.completed)
+            }
+
+        return self.run(snapshot())
+
+    def local_files(self) -> dict[FileName, ManifestEntry]:
+        """Files are named by their path under the storage folder, with `/`
+        between folders. Files removed while they are being listed or hashed are
+        left out."""
+        files = [
+            file
+            for file in self.storage_path.glob("**/*")
+            if file.is_file()
+            and not file.name.endswith((PART_SUFFIX, STATE_SUFFIX, TMP_STATE_SUFFIX))
+            and not file.name.startswith((HASH_CACHE_NAME, MANIFEST_NAME))
+        ]
+        hashes = self.block_hashes.get_many(files, self.block_size)
+        self.block_hashes.save()
+        entries = {}
+        for file, file_hashes in zip(files, hashes):
+            if file_hashes is None:
+                continue
+            try:
+                entries[file.relative_to(self.storage_path).as_posix()] = (
+                    self.file_entry(file, file_hashes)
+                )
+            except FileNotFoundError:
+                continue
+        entries.update(self.partial_entries())
+        return entries
+
+    def send_registration(self):
+        """Sends the tracker only what changed since the last registration it
+        acknowledged, or everything when it asks for a resync."""
+        with self.registration_guard:
+            current = self.local_files()
+            for _ in range(2):
+                changes = self.manifest.diff(current)
+                if self.manifest.version and not changes:
+                    print("Sem alterações a registar")
+                    return
+                received = self.tracker.request(
+                    f"5;{self.address.port};{self.manifest.version}\n"
+                    + "\n".join(changes)
+                )
+                if received != "RESYNC":
+                    break
+                self.manifest = NodeManifest()
+            if received and received.startswith("OK"):
+                print(f"Resposta {received}")
+                replace = not self.manifest.version
+                self.manifest = NodeManifest(
+                    version=int(received.rsplit(" ", 1)[1]), entries=current
+                )
+                path = self.storage_path / MANIFEST_NAME
+                if replace:
+                    self.manifest.save(path=path)
+                else:
+                    self.manifest.save_changes(path=path, changes=changes)
+            else:
+                print("Erro ao registar")
+
+    def heartbeat(self):
+        """Keeps the tracker from expiring this node, and registers everything
+        again if it already has."""
+        while not self.heartbeat_stop.wait(self.heartbeat_interval):
+            if self.tracker.request(f"6;{self.address.port}") == "RESYNC":
+                with self.registration_guard:
+                    self.manifest = NodeManifest()
+                self.send_registration()
 
     def regist(self):
-        files = self.storage_path.glob("**/*")
-        message = f"1;{self.address.port};" + ";".join([
-            self.regist_file(file) for file in files
-        ])
-        self.send_to_server(message=message)
-        data = self.server_socket.recv(BUFFER_SIZE)
-        if data:
-            received = data.decode("utf-8")
-            print(f"Resposta {received}")
-        else:
-            print("Erro ao registar")
-        self.thread_pool.submit(self.udp_start)
-
-    def get_file_list(self) -> None:
-        message = "2"
-        self.send_to_server(message=message)
-        data = self.server_socket.recv(BUFFER_SIZE)
-        if data:
-            received = data.decode("utf-8")
-            print(f"Resposta {received}")
-
-    def get_file_info(self, *, file_name: str) -> File:
-        message = f"3;{file_name}"
-        self.send_to_server(message=message)
-        data = self.server_socket.recv(BUFFER_SIZE)
-        if data:
-            return File.from_json(data.decode("utf-8"), mode="address")
-        print("Ficheiro não encontrado")
-
-    def merge_blocks(self, *, file_name: str, block_ids: list[int]) -> None:
-        file_path = self.storage_path / f"{file_name}"
-        with open(file_path, mode="wb") as fp:
-            for block_id in block_ids:
-                path = self.storage_path / f"{block_id}_{file_name}"
-                with open(path, mode="rb") as fp2:
-                    fp.write(fp2.read())
-                path.unlink()
+        self.send_registration()
+        self.udp_start()
+        if self.heartbeat_thread is None:
+            self.heartbeat_thread = Thread(target=self.heartbeat, daemon=True)
+            self.heartbeat_thread.start()
+
+    def iter_files(
+        self,
+        *,
+        prefix: str = "",
+        glob: Optional[str] = None,
+        details: bool = False,
+        page_size: int = LIST_PAGE_SIZE,
+    ) -> Iterator[Union[FileName, dict[str, Any]]]:
+        """Walks the tracker's listing page by page, so names can be used while
+        later pages are still to be asked for. With details each file is a dict
+        with its name, size and live replica count."""
+        query = {"limit": page_size, "prefix": prefix, "details": details}
+        if glob is not None:
+            query["glob"] = glob
+        while True:
+            received = self.tracker.request(f"2;{json.dumps(query)}")
+            if not received or received == "ERROR":
+                return
+            page = json.loads(received)
+            yield from page["files"]
+            if page["next"] is None:
+                return
+            query["after"] = page["next"]
+
+    def get_file_list(self, *, glob: Optional[str] = None) -> None:
+        for file in self.iter_files(glob=glob, details=True):
+            print(f"{file['name']} {file['size']} bytes, {file['replicas']} nós")
+
+    def get_file_info(self, *, file_name: str) -> Optional[File]:
+        file = self.get_files_info(file_names=[file_name])[file_name]
+        if file is None:
+            print("Ficheiro não encontrado")
+        return file
+
+    def get_files_info(self, *, file_names: list[str]) -> dict[str, Optional[File]]:
+        """Looks files up `LOOKUP_BATCH` at a time, with the batches pipelined
+        on the tracker connection.
+
+        Records in `file_cache` checked recently are used without asking the
+        tracker, and older ones are sent with their tag so that the tracker
+        only sends back the records that changed.
+        """
+        now = monotonic()
+        files: dict[str, Optional[File]] = dict.fromkeys(file_names)
+        lines = []
+        for file_name in file_names:
+            entry = self.file_cache.get(file_name)
+            if entry is None:
+                lines.append(file_name)
+            elif self.file_cache.is_fresh(entry, now):
+                files[file_name] = entry.file
+            else:
+                lines.append(f"{file_name}\t{entry.tag}")
+        requests = [
+            self.tracker.submit("\n".join(["7", *lines[i : i + LOOKUP_BATCH]]))
+            for i in range(0, len(lines), LOOKUP_BATCH)
+        ]
+        for request in requests:
+            received = request.result()
+            if not received or received == "ERROR":
+                continue
+            for file_name, record in json.loads(received).items():
+                if record is None:
+                    self.file_cache.discard(file_name)
+                    continue
+                entry = self.file_cache.get(file_name)
+                if "file" in record:
+                    file = File.from_dict(record["file"], mode="address")
+                elif entry is not None and entry.tag == record["tag"]:
+                    file = entry.file
+                else:
+                    continue
+                self.file_cache.put(file_name, tag=record["tag"], file=file, now=now)
+                files[file_name] = file
+        return files
+
+    def get_files(self, *, prefix: str = "", glob: Optional[str] = None) -> None:
+        """Downloads every file the tracker lists under the prefix and glob in
+        one go, with one lookup per `LOOKUP_BATCH` files."""
+        file_names = list(self.iter_files(prefix=prefix, glob=glob))
+        files = [
+            file
+            for file in self.get_files_info(file_names=file_names).values()
+            if file is not None
+        ]
+        print(f"A descarregar {len(files)} ficheiros...")
+        results = self.run(self.download_files(files=files))
+        for file_name, done in results.items():
+            if not done:
+                self.file_cache.discard(file_name)
+        print(f"{sum(results.values())} de {len(file_names)} ficheiros descarregados")
+        if any(results.values()):
+            self.send_registration()
 
     def get_file(self, *, file_name: str) -> None:
         print("A descarregar ficheiro...")
         file = self.get_file_info(file_name=file_name)
         if file is None:
             return
-        file_peers = FilePeers.from_file(file=file)
-
-        futures = [
-            self.thread_pool.submit(
-                self.download,
-                file_name=file_name,
-                address=file_peers[block],
-                block=block,
-            )
-            for block in file_peers.info
-        ]
-        for future in futures:
-            future.result()
-        self.merge_blocks(file_name=file_name, block_ids=file_peers.info.keys())
+        if self.run(self.download_file(file=file)):
+            print(f"Ficheiro {file_name} descarregado")
+            self.send_registration()
+        else:
+            self.file_cache.discard(file_name)
@@ -1,12 +1,39 @@
+import asyncio
+import json
 import os
 import socket
 from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from threading import Lock
+from time import monotonic
+from typing import Any, Optional
 
-from utils import Address, FileCatalog, FileName, FileNode, address_to_dns_host
+from utils import (
+    DNS_CACHE,
+    FRAME_HEADER,
+    MAX_FRAME_SIZE,
+    Address,
+    BlockRanges,
+    CatalogJournal,
+    ExpiryIndex,
+    File,
+    FileCatalog,
+    FileId,
+    FileName,
+    FileNode,
+    Url,
+    address_to_dns_host,
+    dump_json,
+    encode_frame,
+    split_hashes,
+)
 
-BUFFER_SIZE = 1024
+REQUEST_TIMEOUT = 10.0
+JOURNAL_SUFFIX = ".wal"
+SNAPSHOT_RECORDS = 10_000
+SNAPSHOT_INTERVAL = 300.0
+NODE_TTL = 30.0
+LIST_PAGE_SIZE = 1000
+MAX_LIST_PAGE_SIZE = 10_000
 
 
 def get_store_path():
@@ -14,42 +41,90 @@ def get_store_path():
 
 
 class Tracker:
+    """Serves every node connection from one asyncio loop, keeping the catalog
+    in a snapshot and a journal of the changes made since."""
+
     server_socket: socket.socket
     store_path: Path
     store: FileCatalog
-    disk_guard: Lock
-    memory_guard: Lock
+    journal: CatalogJournal
     thread_pool: ThreadPoolExecutor
+    loop: Optional[asyncio.AbstractEventLoop]
+    server: Optional[asyncio.AbstractServer]
+    seq: int
+    snapshot_seq: int
+    snapshot_at: float
+    pending_records: list[bytes]
+    commit_waiters: list[asyncio.Future]
+    commit_task: Optional[asyncio.Task]
+    node_files: dict[Url, set[FileName]]
+    node_versions: dict[Url, int]
+    expiry: ExpiryIndex
+    epoch: str
+    expiry_task: Optional[asyncio.Task]
     running: bool
 
     def __init__(
         self,
         *,
-        address: Address = Address(port=9090),
+        address: Optional[Address] = None,
         store_path: Path = get_store_path(),
         n_threads: int = 10,
+        request_timeout: float = REQUEST_TIMEOUT,
+        snapshot_records: int = SNAPSHOT_RECORDS,
+        snapshot_interval: float = SNAPSHOT_INTERVAL,
+        node_ttl: float = NODE_TTL,
     ) -> None:
+        if address is None:
+            address = Address(port=9090)
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server_socket.bind(address.get())
+        self.server_socket.listen(socket.SOMAXCONN)
         self.store_path = store_path
-        self.memory_guard = Lock()
-        self.disk_guard = Lock()
+        self.journal = CatalogJournal(
+            path=store_path.with_name(f"{store_path.name}{JOURNAL_SUFFIX}")
+        )
         self.thread_pool = ThreadPoolExecutor(max_workers=n_threads)
+        self.request_timeout = request_timeout
+        self.snapshot_records = snapshot_records
+        self.snapshot_interval = snapshot_interval
+        self.expiry = ExpiryIndex(ttl=node_ttl)
+        self.epoch = os.urandom(4).hex()
+        self.expiry_task = None
+        self.loop = None
+        self.server = None
+        self.pending_records = []
+        self.commit_waiters = []
+        self.commit_task = None
         self.running = False
+        self.node_versions = {}
         self.load()
 
     def start(self):
         self.running = True
-        while self.running:
-            print(f"Servidor ativo em {self.server_socket.getsockname()}")
-            self.server_socket.listen()
-            client_socket, client_address = self.server_socket.accept()
-            print(f"Conexão de {client_address}")
-            self.thread_pool.submit(self.handle_client, client_socket, client_address)
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop.set_default_executor(self.thread_pool)
+        self.server = await asyncio.start_server(
+            self.handle_client, sock=self.server_socket, backlog=socket.SOMAXCONN
+        )
+        self.expiry_task = self.loop.create_task(self.expire_nodes())
+        print(f"Servidor ativo em {self.server_socket.getsockname()}")
+        try:
+            await self.server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        self.expiry_task.cancel()
+        if self.commit_task is not None:
+            await self.commit_task
 
     def stop(self):
         self.running = False
+        if self.loop is not None and self.server is not None:
+            self.loop.call_soon_threadsafe(self.server.close)
 
     def close(self):
         self.stop()
@@ -60,63 +135,501 @@ class Tracker:
     def save(self):
         self.store.save(path=self.store_path)
 
+    def log_changes(
+        self,
+        *,
+        host: str,
+        port: str,
+        replace: bool,
+        lines: list[str],
+        file_ids: Optional[list[FileId]] = None,
+    ):
+        """`file_ids` are the ids of the files of the `+` lines, in order, so
+        replaying them hands out the same ids."""
+        self.seq += 1
+        self.pending_records.append(
+            CatalogJournal.encode({
+                "seq": self.seq,
+                "host": host,
+                "port": port,
+                "replace": replace,
+                "changes": lines,
+                "file_ids": file_ids or [],
+            })
+        )
+
+    async def commit(self):
+        """Waits until every change logged so far is on disk."""
+        if not self.pending_records:
+            return
+        waiter = self.loop.create_future()
+        self.commit_waiters.append(waiter)
+        if self.commit_task is None:
+            self.commit_task = self.loop.create_task(self.commit_pending())
+        await waiter
+
+    async def commit_pending(self):
+        """Writes the pending records in batches until there are none left, so
+        changes logged while a write is in progress share the next fsync. After
+        `snapshot_records` changes, or `snapshot_interval` seconds, the catalog
+        is snapshotted and the journal restarts.
+
+        Waiters whose request already timed out are skipped. A failed write
+        fails the requests waiting on it, and a failed snapshot is retried on
+        the next batch, so the task always ends and later commits start anew.
+        """
+        try:
+            while self.pending_records:
+                records, self.pending_records = self.pending_records, []
+                waiters, self.commit_waiters = self.commit_waiters, []
+                try:
+                    await self.loop.run_in_executor(
+                        None, self.journal.write, b"".join(records)
+                    )
+                except Exception as e:
+                    print(f"Erro ao escrever o journal: {e!r}")
+                    for waiter in waiters:
+                        if not waiter.done():
+                            waiter.set_exception(e)
+                    continue
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_result(None)
+                if self.seq - self.snapshot_seq >= self.snapshot_records or (
+                    self.seq > self.snapshot_seq
+                    and monotonic() - self.snapshot_at >= self.snapshot_interval
+                ):
+                    try:
+                        await self.snapshot()
+                    except Exception as e:
+                        print(f"Erro ao escrever o snapshot: {e!r}")
+        finally:
+            self.commit_task = None
+
+    async def snapshot(self):
+        """The catalog is serialized off the loop, one shard at a time, while
+        requests keep changing it. Shards serialized late may already hold
+        changes logged after `seq`, which are replayed again from the fresh
+        journal. See `replay_record` for why that ends in the same catalog."""
+        seq = self.seq
+        await self.loop.run_in_executor(None, self.write_snapshot, seq)
+        self.snapshot_seq = seq
+        self.snapshot_at = monotonic()
+
+    def write_snapshot(self, seq: int):
+        data = self.store.to_json()
+        tmp_path = self.store_path.with_name(f"{self.store_path.name}.tmp")
+        with open(tmp_path, mode="w", encoding="utf-8") as fp:
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, self.store_path)
+        self.journal.reset(snapshot_seq=seq)
+
     def load(self):
+        """Replays the journal on top of the snapshot."""
         try:
             self.store = FileCatalog.load(path=self.store_path)
         except FileNotFoundError:
             self.store = FileCatalog({})
+        self.node_files = {}
+        for file_name, file in self.store.files.items():
+            for url in file.nodes:
+                self.node_files.setdefault(url, set()).add(file_name)
+        self.snapshot_seq, records = self.journal.replay()
+        self.seq = self.snapshot_seq
+        for record in records:
+            if record["seq"] <= self.snapshot_seq:
+                continue
+            self.replay_record(record)
+            self.seq = record["seq"]
+        self.snapshot_at = monotonic()
+        self.journal.open(snapshot_seq=self.snapshot_seq)
+        for url in self.node_files:
+            self.expiry.touch(url, self.snapshot_at)
 
-    def handle_client(self, client_socket: socket.socket, client_address: str):
-        while data := client_socket.recv(BUFFER_SIZE).decode("utf-8"):
-            response = self.callback(
-                client_address=client_address[0],
-                data=data,
+    def replay_record(self, record: dict[str, Any]):
+        """Applies a journal record line by line.
+
+        The snapshot may already hold later changes than the record, so a `*` may
+        name a file the node has since removed. That line is skipped and the
+        rest of the record still applies. The `-` that removed the file is later
+        in the journal, so the catalog still ends up the same.
+        """
+        host, port = record["host"], record["port"]
+        if record["replace"]:
+            self.apply_changes(host=host, port=port, replace=True, changes=[])
+        file_ids = iter(record.get("file_ids", []))
+        for line in record["changes"]:
+            changes = self.parse_changes(
+                host=host, port=port, replace=False, lines=[line]
             )
-            print(f"Sending {response}")
-            client_socket.sendall(response.encode("utf-8"))
+            ids = [next(file_ids, None)] if line.startswith("+") else []
+            if changes is not None:
+                self.apply_changes(
+                    host=host, port=port, replace=False, changes=changes, file_ids=ids
+                )
+
+    async def handle_client(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        """Answers each framed request with a frame carrying the same id.
+
+        Requests of a connection are answered in order, so a node may pipeline
+        a registration and the lookups that depend on it. While a response
+        cannot be flushed the connection is not read, which pushes back on the
+        node through TCP. A frame started but not finished, a request not
+        answered or a response not flushed within the request timeout closes
+        the connection. Idle connections cost one parked coroutine.
+        """
+        client_address = writer.get_extra_info("peername")
+        nodes: set[Url] = set()
+        print(f"Conexão de {client_address}")
+        try:
+            while header := await reader.read(FRAME_HEADER.size):
+                header += await asyncio.wait_for(
+                    reader.readexactly(FRAME_HEADER.size - len(header)),
+                    self.request_timeout,
+                )
+                request_id, length = FRAME_HEADER.unpack(header)
+                if length > MAX_FRAME_SIZE:
+                    raise ValueError(f"Frame of {length} bytes is too large")
+                data = await asyncio.wait_for(
+                    reader.readexactly(length), self.request_timeout
+                )
+                response = await asyncio.wait_for(
+                    self.callback(
+                        client_address=client_address[0],
+                        data=data.decode("utf-8"),
+                        nodes=nodes,
+                    ),
+                    self.request_timeout,
+                )
+                now = monotonic()
+                for url in nodes:
+                    if url in self.expiry:
+                        self.expiry.touch(url, now)
+                payload = response.encode("utf-8")
+                print(f"Sending response {request_id} ({len(payload)} bytes)")
+                writer.write(encode_frame(request_id, payload))
+                await asyncio.wait_for(writer.drain(), self.request_timeout)
+        except (OSError, ValueError, EOFError, asyncio.TimeoutError) as e:
+            print(f"Erro na conexão de {client_address}: {e!r}")
+        finally:
+            writer.close()
         print(f"Conexão de {client_address} fechada")
-        client_socket.close()
 
-    def callback(self, *, client_address: str, data: str) -> str:
+    async def callback(
+        self, *, client_address: str, data: str, nodes: set[Url]
+    ) -> str:
+        """Handles one request. Nodes registering, refreshing or deregistering
+        themselves are added to or removed from `nodes`, the ones whose
+        liveness follows the connection."""
+        if not data:
+            return "ERROR"
         if data[0] == "1":
-            return self.regist_node(client_address=client_address, node_raw_info=data)
-        if data[0] == "2":
+            host = await self.resolve_host(client_address)
+            response = self.regist_node(
+                client_address=client_address, host=host, node_raw_info=data
+            )
+            if response.startswith("OK"):
+                nodes.add(f"{host}:{data.split(';')[1]}")
+            await self.commit()
+            return response
+        if data[0] == "5":
+            host = await self.resolve_host(client_address)
+            response = self.update_node(
+                client_address=client_address, host=host, node_changes=data
+            )
+            if response.startswith("OK"):
+                nodes.add(f"{host}:{data.split(';')[1]}")
+            await self.commit()
+            return response
+        if data == "2":
             return self.list_files()
+        if data[0] == "2":
+            return self.list_page(query=data[2:])
         if data[0] == "3":
             return self.file_info(file_name=data[2:])
+        if data[0] == "7":
+            return self.files_info(lines=data.split("\n")[1:])
         if data[0] == "4":
-            self.close_node(client_address=client_address)
+            host = await self.resolve_host(client_address)
+            url = f"{host}:{data[2:]}"
+            nodes.discard(url)
+            if url not in self.expiry:
+                return "ERROR"
+            self.close_node(url=url)
+            print(f"Nodo {client_address} saiu")
+            await self.commit()
+            return "OK"
+        if data[0] == "6":
+            host = await self.resolve_host(client_address)
+            url = f"{host}:{data[2:]}"
+            if url not in self.expiry:
+                return "RESYNC"
+            self.expiry.touch(url, monotonic())
+            nodes.add(url)
+            return "OK"
         return "ERROR"
 
-    def regist_node(self, *, client_address: str, node_raw_info: str) -> str:
+    async def resolve_host(self, client_address: str) -> str:
+        """Looks the node up in the shared DNS cache, going to the thread pool
+        only on a miss. Nodes without a reverse record go by their address."""
+        try:
+            host = DNS_CACHE.cached(("host", client_address))
+            if host is None:
+                host = await self.loop.run_in_executor(
+                    None, address_to_dns_host, client_address
+                )
+        except OSError:
+            return client_address
+        return host.split(".", 1)[0]
+
+    async def expire_nodes(self):
+        """Removes nodes silent for `node_ttl` seconds from the catalog.
+
+        Sleeps until the earliest node deadline. Nodes registered later never
+        have an earlier one."""
+        while True:
+            deadline = self.expiry.next_deadline()
+            await asyncio.sleep(
+                self.expiry.ttl if deadline is None else deadline - monotonic()
+            )
+            for url in self.expiry.pop_expired(monotonic()):
+                self.close_node(url=url)
+                print(f"Nodo {url} expirou")
+            await self.commit()
+
+    def close_node(self, *, url: Url):
+        """Removes every replica of a node from the catalog."""
+        host, port = url.rsplit(":", 1)
+        self.apply_changes(host=host, port=port, replace=True, changes=[])
+        self.log_changes(host=host, port=port, replace=True, lines=[])
+        self.node_versions.pop(url, None)
+        self.expiry.discard(url)
+
+    def regist_node(self, *, client_address: str, host: str, node_raw_info: str) -> str:
         split_data = node_raw_info.split(";")
         port = split_data[1]
         n_splits = len(split_data)
-        if n_splits > 2:
-            for i in range(2, n_splits, 2):
-                file_name = split_data[i]
-                if not split_data[i + 1]:
-                    continue
-                blocks = [int(b) for b in split_data[i + 1].split(",")]
-                host = address_to_dns_host(client_address).split(".",1)[0]
-                file_node = FileNode(host=host, port=int(port), blocks=blocks)
-                with self.memory_guard:
-                    self.store.add_file_node(file_node=file_node, file_name=file_name)
-            with self.disk_guard:
-                self.save()
+        if n_splits > 6:
+            lines = [
+                "+;" + ";".join(split_data[i : i + 5])
+                for i in range(2, n_splits - 4, 5)
+                if split_data[i + 4]
+            ]
+            try:
+                changes = self.parse_changes(
+                    host=host, port=port, replace=False, lines=lines
+                )
+            except ValueError:
+                return "ERROR"
+            file_ids = self.apply_changes(
+                host=host, port=port, replace=False, changes=changes
+            )
+            self.log_changes(
+                host=host, port=port, replace=False, lines=lines, file_ids=file_ids
+            )
+            self.node_versions.pop(f"{host}:{port}", None)
+            self.expiry.touch(f"{host}:{port}", monotonic())
             print(f"Nodo {client_address} registado")
             return f"OK {client_address}"
         return "No files"
 
+    def update_node(self, *, client_address: str, host: str, node_changes: str) -> str:
+        """Applies the changes a node made since its last registration.
+
+        Every change is parsed and checked before the catalog is touched, and
+        they are then applied without yielding to the loop, so other requests
+        see all of them or none. A node whose base version does not match ours
+        is asked to resync with its full manifest.
+        """
+        header, *lines = node_changes.split("\n")
+        _, port, base = header.split(";")
+        url = f"{host}:{port}"
+        base = int(base)
+        if base and self.node_versions.get(url) != base:
+            return "RESYNC"
+        lines = [line for line in lines if line]
+        try:
+            changes = self.parse_changes(
+                host=host, port=port, replace=not base, lines=lines
+            )
+        except ValueError:
+            return "ERROR"
+        if changes is None:
+            return "RESYNC"
+        file_ids = self.apply_changes(
+            host=host, port=port, replace=not base, changes=changes
+        )
+        self.log_changes(
+            host=host, port=port, replace=not base, lines=lines, file_ids=file_ids
+        )
+        self.node_versions[url] = base + 1
+        self.expiry.touch(url, monotonic())
+        print(f"Nodo {client_address} atualizado com {len(changes)} alterações")
+        return f"OK {client_address} {base + 1}"
+
+    def parse_changes(
+        self, *, host: str, port: str, replace: bool, lines: list[str]
+    ) -> Optional[list[tuple[str, FileName, Any]]]:
+        """Returns None when a change refers to a file the node is not known to
+        have. Lines are split from the right, like the node builds them, so
+        file names may hold `;`."""
+        known = set() if replace else set(self.node_files.get(f"{host}:{port}", ()))
+        changes = []
+        for line in lines:
+            kind, _, fields = line.partition(";")
+            if kind == "+":
+                file_name, size, block_size, hashes, blocks = fields.rsplit(";", 4)
+                changes.append((
+                    kind,
+                    file_name,
+                    (
+                        FileNode(
+                            host=host,
+                            port=int(port),
+                            blocks=BlockRanges.from_string(blocks),
+                            block_size=int(block_size),
+                            size=int(size),
+                        ),
+                        split_hashes(hashes),
+                    ),
+                ))
+                known.add(file_name)
+            elif kind == "*":
+                file_name, blocks = fields.rsplit(";", 1)
+                if file_name not in known:
+                    return None
+                changes.append((kind, file_name, BlockRanges.from_string(blocks)))
+            elif kind == "-":
+                changes.append((kind, fields, None))
+                known.discard(fields)
+            else:
+                return None
+        return changes
+
+    def apply_changes(
+        self,
+        *,
+        host: str,
+        port: str,
+        replace: bool,
+        changes: list[tuple[str, FileName, Any]],
+        file_ids: Optional[list[Optional[FileId]]] = None,
+    ) -> list[FileId]:
+        """Files new to the catalog take the id of their `+` change from
+        `file_ids`, when given. Returns the ids of the files of every `+`."""
+        url = f"{host}:{port}"
+        if replace:
+            for file_name in self.node_files.pop(url, set()):
+                self.store.remove_file_node(file_name=file_name, url=url)
+        files = self.node_files.setdefault(url, set())
+        given_ids = iter(file_ids or [])
+        assigned_ids = []
+        for kind, file_name, change in changes:
+            if kind == "+":
+                file_node, hashes = change
+                self.store.add_file_node(
+                    file_node=file_node,
+                    file_name=file_name,
+                    hashes=hashes,
+                    file_id=next(given_ids, None),
+                )
+                assigned_ids.append(self.store[file_name].file_id)
+                files.add(file_name)
+            elif kind == "*":
+                self.store.add_file_blocks(file_name=file_name, url=url, blocks=change)
+            else:
+                self.store.remove_file_node(file_name=file_name, url=url)
+                files.discard(file_name)
+        if not files:
+            self.node_files.pop(url)
+        return assigned_ids
+
     def list_files(self) -> str:
         print("Lista de ficheiros")
-        with self.memory_guard:
-            return str(self.store.list_files())
+        return str(self.store.list_files())
 
-    def file_info(self, *, file_name: FileName) -> str:
-        print(f"Informação de {file_name}")
+    def list_page(self, *, query: str) -> str:
+        """Answers `2;{"limit": .., "after": .., "prefix": .., "glob": ..,
+        "details": ..}`, every key optional, with one page of the listing and
+        the cursor of the next one. With details each file comes with its size
+        and how many live nodes have it."""
+        try:
+            query = json.loads(query)
+            names, cursor = self.store.list_page(
+                limit=min(
+                    max(int(query.get("limit", LIST_PAGE_SIZE)), 1), MAX_LIST_PAGE_SIZE
+                ),
+                after=query.get("after"),
+                prefix=query.get("prefix", ""),
+                pattern=query.get("glob"),
+            )
+        except (ValueError, TypeError, AttributeError):
+            return "ERROR"
+        if not query.get("details"):
+            return dump_json({"files": names, "next": cursor})
+        files = []
+        now = monotonic()
+        for file_name in names:
+            try:
+                nodes = self.store.get_file(file_name=file_name)[0].nodes
+            except KeyError:
+                continue
+            live = [
+                node for url, node in nodes.items() if self.expiry.is_live(url, now)
+            ]
+            files.append({
+                "name": file_name,
+                "size": max((node.size for node in live), default=0),
+                "replicas": len(live),
+            })
+        return dump_json({"files": files, "next": cursor})
+
+    def live_file(self, *, file_name: FileName) -> Optional[File]:
+        """The file with only the replicas of live nodes, most recently seen
+        first, or None when no live node has it."""
         try:
-            with self.memory_guard:
-                return self.store[file_name].to_json()
+            file, _ = self.store.get_file(file_name=file_name)
         except KeyError:
-            return ""
+            return None
+        now = monotonic()
+        live = sorted(
+            (url for url in file.nodes if self.expiry.is_live(url, now)),
+            key=self.expiry.last_seen.__getitem__,
+            reverse=True,
+        )
+        if not live:
+            return None
+        file.nodes = {url: file.nodes[url] for url in live}
+        return file
+
+    def file_info(self, *, file_name: FileName) -> str:
+        print(f"Informação de {file_name}")
+        file = self.live_file(file_name=file_name)
+        return "" if file is None else file.to_json()
+
+    def files_info(self, *, lines: list[str]) -> str:
+        """Answers `7` followed by one file name per line with all the files at
+        once, each with the tag of its current version, or null when unknown.
+
+        A name may be followed by a tab and the tag of the record the node
+        already holds. While it is still current, only the tag is sent back.
+        Tags carry an epoch drawn at startup, so none survives a restart.
+        """
+        print(f"Informação de {len(lines)} ficheiros")
+        files = {}
+        for line in lines:
+            file_name, _, tag = line.partition("\t")
+            version = self.store.file_version(file_name=file_name)
+            current = f"{self.epoch}.{version}"
+            if version is not None and tag == current:
+                files[file_name] = {"tag": current}
+                continue
+            file = self.live_file(file_name=file_name)
+            files[file_name] = (
+                None if file is None else {"tag": current, "file": file.to_dict()}
+            )
+        return dump_json(files)
@@ -1,21 +1,78 @@
+import fnmatch
+import hashlib
+import heapq
 import json
+import mmap
+import os
+import re
 import socket
-from dataclasses import dataclass
-from datetime import datetime, timedelta
-from typing import Optional
-
-PACKET_ACK_TIMEOUT = 5
+import struct
+from abc import ABC, abstractmethod
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from itertools import count
+from pathlib import Path, PurePosixPath
+from threading import Lock
+from time import monotonic
+from typing import Any, Callable, Iterable, Iterator, Optional
+
+PACKET_ACK_TIMEOUT = 1.0
+RTO_MIN = 0.2
+RTO_MAX = 60.0
+INITIAL_CWND = 10
+MIN_CWND = 2
+MAX_CWND = 4096
+RATE_INTERVAL = 0.5
+MAPPED_FILES = 64
+HASH_SIZE = 32
+CATALOG_SHARDS = 64
+SORTED_LOAD = 1000
+LIST_SCAN_LIMIT = 10_000
+FILE_CACHE_SIZE = 10_000
+FILE_CACHE_MAX_AGE = 2.0
+MANIFEST_LOG_SUFFIX = ".log"
+BLOCK_SIZE = 1024 * 1024
+PACKET_SIZE = 1400
+DNS_TTL = 300.0
+DNS_NEGATIVE_TTL = 30.0
 
 FileName = str
+FileId = int
 Url = str
 PacketId = int
 BlockId = int
 
+OP_REQUEST = 1
+OP_ACK = 2
+OP_DATA = 3
+OP_END = 4
+OP_UNKNOWN_FILE = 5
+OP_MISSING_BLOCK = 6
+OP_CANCEL = 7
+
+FRAME_HEADER = struct.Struct("!II")
+MAX_FRAME_SIZE = 256 * 1024 * 1024
+
+JSON_ENCODER = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+FLAG_FILE_NAME = 1
+
+# opcode, flags, file id, block id, packet id, payload length
+HEADER = struct.Struct("!BBQIIH")
+# block size, packet size
+REQUEST_BODY = struct.Struct("!IH")
+
+
+def local_address() -> str:
+    return DNS_CACHE.host_to_address(socket.gethostname())
+
 
 @dataclass
 class Address:
     port: int
-    host: str = socket.gethostbyname(socket.gethostname())
+    host: str = field(default_factory=local_address)
 
     def to_string(self) -> str:
         return f'"{self.host}:{self.port}"'
@@ -34,135 +91,592 @@ class Address:
         return self.host, self.port
 
 
-@dataclass
-class FileNode:
-    host: str
-    port: int
-    blocks: list[int]
+class BlockRanges:
+    """Set of blocks kept as sorted, disjoint, non-adjacent `[start, end)` ranges.
 
-    def to_json(self) -> str:
+    Written as inclusive ranges, like "0-99,120,130-131", so a complete file of
+    any size is a single range. Unions and differences merge ranges and cost
+    O(ranges), not O(blocks).
+    """
+
+    __slots__ = ("ranges",)
+
+    def __init__(self, ranges: Iterable[tuple[int, int]] = ()):
+        self.ranges = self.merge(ranges)
+
+    @staticmethod
+    def merge(ranges: Iterable[tuple[int, int]]) -> list[tuple[int, int]]:
+        merged: list[tuple[int, int]] = []
+        for start, end in sorted(ranges):
+            if start >= end:
+                continue
+            if merged and start <= merged[-1][1]:
+                if end > merged[-1][1]:
+                    merged[-1] = (merged[-1][0], end)
+            else:
+                merged.append((start, end))
+        return merged
+
+    @classmethod
+    def from_blocks(cls, blocks: Iterable[BlockId]) -> "BlockRanges":
+        return cls((block, block + 1) for block in blocks)
+
+    @classmethod
+    def from_string(cls, ranges_string: str) -> "BlockRanges":
+        """Strings we wrote ourselves are already merged and skip the sort."""
+        ranges = []
+        merged = True
+        last = -1
+        for part in filter(None, ranges_string.split(",")):
+            start, _, end = part.partition("-")
+            start, end = int(start), int(end or start) + 1
+            merged = merged and last < start < end
+            ranges.append((start, end))
+            last = end
+        block_ranges = cls.__new__(cls)
+        block_ranges.ranges = ranges if merged else cls.merge(ranges)
+        return block_ranges
+
+    def __str__(self) -> str:
+        return ",".join(
+            str(start) if end == start + 1 else f"{start}-{end - 1}"
+            for start, end in self.ranges
+        )
+
+    def __repr__(self) -> str:
+        return f"BlockRanges({str(self)!r})"
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, BlockRanges) and self.ranges == other.ranges
+
+    def __len__(self) -> int:
+        return sum(end - start for start, end in self.ranges)
+
+    def __iter__(self) -> Iterator[BlockId]:
+        for start, end in self.ranges:
+            yield from range(start, end)
+
+    def __contains__(self, block: BlockId) -> bool:
+        index = bisect_right(self.ranges, (block, float("inf"))) - 1
+        return index >= 0 and block < self.ranges[index][1]
+
+    def union(self, other: "BlockRanges") -> "BlockRanges":
+        return BlockRanges(self.ranges + other.ranges)
+
+    def difference(self, other: "BlockRanges") -> "BlockRanges":
+        result = []
+        others = iter(other.ranges)
+        cut = next(others, None)
+        for start, end in self.ranges:
+            while cut is not None and cut[1] <= start:
+                cut = next(others, None)
+            while cut is not None and cut[0] < end:
+                if cut[0] > start:
+                    result.append((start, cut[0]))
+                start = max(start, cut[1])
+                if cut[1] >= end:
+                    break
+                cut = next(others, None)
+            if start < end:
+                result.append((start, end))
+        return BlockRanges(result)
+
+    def issubset(self, other: "BlockRanges") -> bool:
+        return not self.difference(other).ranges
+
+
+class FileNode:
+    """One node's replica of a file.
+
+    A big catalog holds millions of these, so they have `__slots__` instead of
+    being dataclasses, which only get them from Python 3.10 on.
+    """
+
+    __slots__ = ("host", "port", "blocks", "block_size", "size")
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        blocks: Iterable[BlockId],
+        block_size: int = BLOCK_SIZE,
+        size: int = 0,
+    ):
+        self.host = host
+        self.port = port
+        if not isinstance(blocks, BlockRanges):
+            blocks = BlockRanges.from_blocks(blocks)
+        self.blocks = blocks
+        self.block_size = block_size
+        self.size = size
+
+    def __repr__(self) -> str:
         return (
-            "{"
-            + f'"host":"{self.host}","port":{self.port},"blocks":{json.dumps(self.blocks)}'
-            + "}"
+            f"FileNode(host={self.host!r}, port={self.port}, blocks={self.blocks!r}, "
+            f"block_size={self.block_size}, size={self.size})"
         )
 
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, FileNode) and (
+            self.host,
+            self.port,
+            self.blocks,
+            self.block_size,
+            self.size,
+        ) == (other.host, other.port, other.blocks, other.block_size, other.size)
+
+    def hash_key(self) -> tuple[int, int]:
+        return self.size, self.block_size
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "host": self.host,
+            "port": self.port,
+            "block_size": self.block_size,
+            "size": self.size,
+            "blocks": str(self.blocks),
+        }
+
     @classmethod
-    def from_json(cls, node_string: str, mode: str) -> "FileNode":
-        parts = node_string[1:-1].split(",", 2)
+    def from_dict(
+        cls,
+        node: dict[str, Any],
+        mode: str,
+        parsed: Optional[dict[str, BlockRanges]] = None,
+    ) -> "FileNode":
+        """Replicas passing the same `parsed` share the block ranges of equal
+        strings, which is safe as `BlockRanges` are never changed in place."""
+        host = node["host"]
         if mode == "address":
-            host = dns_host_to_address(parts[0].split(":")[1][1:-1])
-        elif mode == "host":
-            host = parts[0].split(":")[1][1:-1]
+            host = dns_host_to_address(host)
+        ranges = node["blocks"]
+        if not isinstance(ranges, str):
+            blocks = BlockRanges.from_blocks(ranges)
+        elif parsed is None:
+            blocks = BlockRanges.from_string(ranges)
+        elif ranges in parsed:
+            blocks = parsed[ranges]
+        else:
+            blocks = parsed[ranges] = BlockRanges.from_string(ranges)
         return cls(
             host=host,
-            port=int(parts[1].split(":")[1]),
-            blocks=json.loads(parts[2].split(":")[1]),
+            port=node["port"],
+            block_size=node["block_size"],
+            size=node["size"],
+            blocks=blocks,
         )
 
+    def to_json(self) -> str:
+        return dump_json(self.to_dict())
 
-@dataclass
-class File:
-    name: str
-    nodes: dict[Url, FileNode]
+    @classmethod
+    def from_json(cls, node_string: str, mode: str) -> "FileNode":
+        return cls.from_dict(json.loads(node_string), mode)
 
-    def add_node(self, *, node: FileNode) -> "File":
-        self.nodes[f"{node.host}:{node.port}"] = node
-        return self
 
-    def to_json(self) -> str:
+class File:
+    """Replicas of the same size and block size have the same block hashes, so
+    `hashes` keeps one list for each, shared by all of them."""
+
+    __slots__ = ("name", "nodes", "file_id", "hashes")
+
+    def __init__(
+        self,
+        name: str,
+        nodes: dict[Url, FileNode],
+        file_id: Optional[FileId] = None,
+        hashes: Optional[dict[tuple[int, int], list[str]]] = None,
+    ):
+        self.name = name
+        self.nodes = nodes
+        self.file_id = file_id
+        self.hashes = {} if hashes is None else hashes
+
+    def __repr__(self) -> str:
         return (
-            "{"
-            + f'"name":"{self.name}","nodes":'
-            + "{"
-            + ",".join([
-                f"\"{url}\":{node.to_json()}" for url, node in self.nodes.items()
-            ])
-            + "}}"
+            f"File(name={self.name!r}, nodes={self.nodes!r}, "
+            f"file_id={self.file_id!r}, hashes={self.hashes!r})"
         )
 
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, File) and (
+            self.name,
+            self.nodes,
+            self.file_id,
+            self.hashes,
+        ) == (other.name, other.nodes, other.file_id, other.hashes)
+
+    def add_node(self, *, node: FileNode, hashes: Optional[list[str]] = None) -> "File":
+        """The first hashes given for a size and block size are kept as long as
+        a replica of that size and block size is."""
+        url = f"{node.host}:{node.port}"
+        self.remove_node(url=url)
+        self.nodes[url] = node
+        if hashes:
+            self.hashes.setdefault(node.hash_key(), hashes)
+        return self
+
+    def remove_node(self, *, url: Url) -> "File":
+        node = self.nodes.pop(url, None)
+        if node is not None and not any(
+            other.hash_key() == node.hash_key() for other in self.nodes.values()
+        ):
+            self.hashes.pop(node.hash_key(), None)
+        return self
+
+    def to_dict(self) -> dict[str, Any]:
+        keys = {node.hash_key() for node in self.nodes.values()}
+        return {
+            "name": self.name,
+            "id": self.file_id,
+            "hashes": {
+                f"{size}:{block_size}": "".join(hashes)
+                for (size, block_size), hashes in self.hashes.items()
+                if (size, block_size) in keys
+            },
+            "nodes": {url: node.to_dict() for url, node in self.nodes.items()},
+        }
+
     @classmethod
-    def from_json(cls, file_string: str, mode: str) -> "File":
-        parts = file_string.split(",", 1)
-        nodes = parts[1].split(":", 1)[1][:-2].split("}")
+    def from_dict(cls, file: dict[str, Any], mode: str) -> "File":
+        """Also reads catalogs saved when every replica had its own hashes.
 
+        In `address` mode replicas whose host does not resolve are left out.
+        """
+        nodes = file["nodes"]
+        if mode == "address":
+            addresses = DNS_CACHE.hosts_to_addresses(
+                node["host"] for node in nodes.values()
+            )
+            nodes = {
+                url: node for url, node in nodes.items() if node["host"] in addresses
+            }
+        hashes = {}
+        for key, hash_string in file.get("hashes", {}).items():
+            size, block_size = key.split(":")
+            hashes[int(size), int(block_size)] = split_hashes(hash_string)
+        for node in nodes.values():
+            if node.get("hashes"):
+                hashes.setdefault(
+                    (node["size"], node["block_size"]), split_hashes(node["hashes"])
+                )
+        parsed: dict[str, BlockRanges] = {}
         return cls(
-            name=parts[0].split(":")[1][1:-1],
+            name=file["name"],
+            file_id=file["id"],
             nodes={
-                node[1:].split(":", 2)[0][1:]
-                + ":"
-                + node.split(":", 2)[1][:-1]: FileNode.from_json(
-                    node.split(":", 2)[2] + "}", mode
-                )
-                for node in nodes
-                if node
+                url: FileNode.from_dict(node, mode, parsed)
+                for url, node in nodes.items()
             },
+            hashes=hashes,
         )
 
+    def to_json(self) -> str:
+        return dump_json(self.to_dict())
+
+    @classmethod
+    def from_json(cls, file_string: str, mode: str) -> "File":
+        return cls.from_dict(json.loads(file_string), mode)
+
+
+class SortedNames:
+    """Sorted set of names kept in chunks of at most `load` names.
+
+    Adding or removing a name bisects to its chunk and shifts only that chunk,
+    and walking from any name onwards starts with two bisects.
+    """
+
+    def __init__(self, names: Iterable[str] = (), *, load: int = SORTED_LOAD):
+        self.load = load
+        names = sorted(set(names))
+        self.chunks = [names[i : i + load] for i in range(0, len(names), load)]
+        self.maxes = [chunk[-1] for chunk in self.chunks]
+        self.size = len(names)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __iter__(self) -> Iterator[str]:
+        for chunk in self.chunks:
+            yield from chunk
+
+    def __contains__(self, name: str) -> bool:
+        i = bisect_left(self.maxes, name)
+        if i == len(self.maxes):
+            return False
+        chunk = self.chunks[i]
+        return chunk[bisect_left(chunk, name)] == name
+
+    def add(self, name: str) -> None:
+        if not self.chunks:
+            self.chunks.append([name])
+            self.maxes.append(name)
+            self.size = 1
+            return
+        i = min(bisect_left(self.maxes, name), len(self.maxes) - 1)
+        chunk = self.chunks[i]
+        j = bisect_left(chunk, name)
+        if j < len(chunk) and chunk[j] == name:
+            return
+        chunk.insert(j, name)
+        self.maxes[i] = chunk[-1]
+        self.size += 1
+        if len(chunk) > 2 * self.load:
+            head, tail = chunk[: self.load], chunk[self.load :]
+            self.chunks[i : i + 1] = [head, tail]
+            self.maxes[i : i + 1] = [head[-1], tail[-1]]
+
+    def discard(self, name: str) -> None:
+        i = bisect_left(self.maxes, name)
+        if i == len(self.maxes):
+            return
+        chunk = self.chunks[i]
+        j = bisect_left(chunk, name)
+        if chunk[j] != name:
+            return
+        del chunk[j]
+        self.size -= 1
+        if chunk:
+            self.maxes[i] = chunk[-1]
+        else:
+            del self.chunks[i]
+            del self.maxes[i]
+
+    def iter_from(self, name: str, *, inclusive: bool = True) -> Iterator[str]:
+        """Names from `name` onwards, in order."""
+        find = bisect_left if inclusive else bisect_right
+        i = find(self.maxes, name)
+        if i == len(self.maxes):
+            return
+        chunk = self.chunks[i]
+        yield from chunk[find(chunk, name) :]
+        for i in range(i + 1, len(self.chunks)):
+            yield from self.chunks[i]
+
 
 @dataclass
+class CatalogShard:
+    files: dict[FileName, File] = field(default_factory=dict)
+    versions: dict[FileName, int] = field(default_factory=dict)
+    lock: Lock = field(default_factory=Lock, compare=False, repr=False)
+
+
 class FileCatalog:
-    files: dict[FileName, File]
+    """Files spread over shards by name, each behind its own lock.
+
+    Threads working on files in different shards never wait for each other,
+    and serializing the catalog locks one shard at a time, so lookups and
+    registrations go on while a snapshot is written. A sorted index of the
+    names, behind its own lock, serves listings page by page.
+
+    Every change to a file gives it a new version, never reused for any file,
+    so clients can tell whether a record they hold is still current.
+    """
+
+    shards: list[CatalogShard]
+    names: SortedNames
+    next_file_id: FileId
+
+    def __init__(
+        self,
+        files: dict[FileName, File],
+        next_file_id: FileId = 0,
+        *,
+        n_shards: int = CATALOG_SHARDS,
+    ) -> None:
+        self.shards = [CatalogShard() for _ in range(n_shards)]
+        self.names = SortedNames(files)
+        self.names_guard = Lock()
+        self.id_guard = Lock()
+        self.version_counter = count(1)
+        self.next_file_id = max([
+            next_file_id,
+            *(file.file_id + 1 for file in files.values() if file.file_id is not None),
+        ])
+        for file_name, file in files.items():
+            shard = self.shard(file_name)
+            shard.files[file_name] = file
+            shard.versions[file_name] = next(self.version_counter)
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, FileCatalog) and self.files == other.files
 
     def __getitem__(self, file_name: FileName) -> File:
-        return self.files[file_name]
+        shard = self.shard(file_name)
+        with shard.lock:
+            return shard.files[file_name]
+
+    def __contains__(self, file_name: FileName) -> bool:
+        return file_name in self.shard(file_name).files
+
+    def shard(self, file_name: FileName) -> CatalogShard:
+        return self.shards[hash(file_name) % len(self.shards)]
+
+    @property
+    def files(self) -> dict[FileName, File]:
+        files = {}
+        for shard in self.shards:
+            with shard.lock:
+                files.update(shard.files)
+        return files
+
+    def assign_file_id(self, *, file: File) -> None:
+        with self.id_guard:
+            if file.file_id is None:
+                file.file_id = self.next_file_id
+            self.next_file_id = max(self.next_file_id, file.file_id + 1)
 
     def add_file(self, *, file: File) -> "FileCatalog":
-        self.files[file.name] = file
+        self.assign_file_id(file=file)
+        shard = self.shard(file.name)
+        with shard.lock:
+            shard.files[file.name] = file
+            shard.versions[file.name] = next(self.version_counter)
+            with self.names_guard:
+                self.names.add(file.name)
+        return self
+
+    def add_file_node(
+        self,
+        *,
+        file_node: FileNode,
+        file_name: str,
+        hashes: Optional[list[str]] = None,
+        file_id: Optional[FileId] = None,
+    ) -> "FileCatalog":
+        """A new file takes `file_id` when given, else the next free id."""
+        shard = self.shard(file_name)
+        with shard.lock:
+            if file_name not in shard.files:
+                file = File(name=file_name, nodes={}, file_id=file_id)
+                self.assign_file_id(file=file)
+                shard.files[file_name] = file
+                with self.names_guard:
+                    self.names.add(file_name)
+            shard.files[file_name].add_node(node=file_node, hashes=hashes)
+            shard.versions[file_name] = next(self.version_counter)
         return self
 
-    def add_file_node(self, *, file_node: FileNode, file_name: str) -> "FileCatalog":
-        if file_name not in self.files:
-            self.add_file(file=File(name=file_name, nodes={}))
-        self.files[file_name].add_node(node=file_node)
+    def add_file_blocks(
+        self, *, file_name: FileName, url: Url, blocks: BlockRanges
+    ) -> "FileCatalog":
+        shard = self.shard(file_name)
+        with shard.lock:
+            file_node = shard.files[file_name].nodes[url]
+            file_node.blocks = file_node.blocks.union(blocks)
+            shard.versions[file_name] = next(self.version_counter)
+        return self
+
+    def remove_file_node(self, *, file_name: FileName, url: Url) -> "FileCatalog":
+        """Files left without nodes are dropped from the catalog."""
+        shard = self.shard(file_name)
+        with shard.lock:
+            if file_name in shard.files:
+                shard.files[file_name].remove_node(url=url)
+                shard.versions[file_name] = next(self.version_counter)
+                if not shard.files[file_name].nodes:
+                    shard.files.pop(file_name)
+                    shard.versions.pop(file_name)
+                    with self.names_guard:
+                        self.names.discard(file_name)
         return self
 
     def list_files(self) -> list[FileName]:
-        return list(self.files.keys())
+        with self.names_guard:
+            return list(self.names)
+
+    def list_page(
+        self,
+        *,
+        limit: int,
+        after: Optional[FileName] = None,
+        prefix: str = "",
+        pattern: Optional[str] = None,
+        scan_limit: int = LIST_SCAN_LIMIT,
+    ) -> tuple[list[FileName], Optional[FileName]]:
+        """Up to `limit` names, in order, after the cursor `after`, starting
+        with `prefix` and matching the glob `pattern`.
+
+        The walk starts at the pattern's literal prefix and looks at no more
+        than `scan_limit` names, so a sparse pattern may give a short page.
+        Also returns the cursor of the next page, None once there is none.
+        """
+        if pattern is not None:
+            literal = re.split(r"[*?\[]", pattern, maxsplit=1)[0]
+            if literal.startswith(prefix):
+                prefix = literal
+            elif not prefix.startswith(literal):
+                return [], None
+            match = re.compile(fnmatch.translate(pattern)).match
+        page: list[FileName] = []
+        with self.names_guard:
+            if after is not None and after >= prefix:
+                names = self.names.iter_from(after, inclusive=False)
+            else:
+                names = self.names.iter_from(prefix)
+            for scanned, name in enumerate(names, start=1):
+                if not name.startswith(prefix):
+                    return page, None
+                if pattern is None or match(name):
+                    page.append(name)
+                if len(page) == limit or scanned == scan_limit:
+                    return page, name
+        return page, None
 
     def get_file_nodes(self, *, file_name: FileName) -> list[FileNode]:
-        return list(self.files[file_name].nodes.values())
+        shard = self.shard(file_name)
+        with shard.lock:
+            return list(shard.files[file_name].nodes.values())
+
+    def get_file(self, *, file_name: FileName) -> tuple[File, int]:
+        """A copy of the file entry that later changes to the catalog leave
+        alone, and its version."""
+        shard = self.shard(file_name)
+        with shard.lock:
+            file = shard.files[file_name]
+            return (
+                File(
+                    name=file.name,
+                    nodes=dict(file.nodes),
+                    file_id=file.file_id,
+                    hashes=dict(file.hashes),
+                ),
+                shard.versions[file_name],
+            )
+
+    def file_version(self, *, file_name: FileName) -> Optional[int]:
+        return self.shard(file_name).versions.get(file_name)
 
     def to_json(self) -> str:
-        return (
-            "{"
-            + f'"files":'
-            + "{"
-            + ",".join([
-                f'"{file_name}":{file.to_json()}'
-                for file_name, file in self.files.items()
-            ])
-            + "}}"
-        )
+        """`next_file_id` is read last, so no id handed out before it was
+        read is ever handed out again by a catalog loaded from this."""
+        files = {}
+        for shard in self.shards:
+            with shard.lock:
+                files.update(
+                    (file_name, file.to_dict())
+                    for file_name, file in shard.files.items()
+                )
+        with self.id_guard:
+            next_file_id = self.next_file_id
+        return dump_json({"files": files, "next_file_id": next_file_id})
 
     @classmethod
     def from_json(cls, catalog_string: str) -> "FileCatalog":
-        content = catalog_string[1:-2].split(":", 1)[1]
-        split = content.split("}")[:-3]
-        file_names = []
-        files = []
-        j = i = c = 0
-        max = len(split)
-        while i < max:
-            file_names.append(split[i].split(":", 1)[0][2:-1])
-            files.append(split[i].split(":", 1)[1])
-            j = i + 1
-            while j < max and split[j]:
-                files[c] += "}" + split[j]
-                j += 1
-            files[c] += "}}}"
-            i = j + 2
-            c += 1
+        catalog = json.loads(catalog_string)
         return cls(
             files={
-                file_names[i]: File.from_json(files[i], mode="host")
-                for i in range(len(files))
-            }
+                file_name: File.from_dict(file, mode="host")
+                for file_name, file in catalog["files"].items()
+            },
+            next_file_id=catalog.get("next_file_id", 0),
         )
 
-    def save(self, *, path: str) -> None:
-        with open(path, mode="w", encoding="utf-8") as fp:
+    def save(self, *, path: Path) -> None:
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        with open(tmp_path, mode="w", encoding="utf-8") as fp:
             fp.write(self.to_json())
+        os.replace(tmp_path, path)
 
     @classmethod
     def load(cls, *, path: str) -> "FileCatalog":
@@ -173,71 +687,160 @@ class FileCatalog:
 @dataclass
 class FilePeers:
     info: dict[int, Address]
+    block_size: int = BLOCK_SIZE
+    size: int = 0
+    hashes: list[str] = field(default_factory=list)
+    replicas: dict[int, list[Address]] = field(default_factory=dict, compare=False)
 
     def __getitem__(self, block: int) -> Address:
         return self.info[block]
 
+    def block_hash(self, block: int) -> Optional[str]:
+        return self.hashes[block] if block < len(self.hashes) else None
+
+    def n_blocks(self) -> int:
+        return count_blocks(self.size, self.block_size)
+
     @classmethod
     def from_file(cls, file: File) -> "FilePeers":
-        file_peers = cls(info={})
+        """Block ids only line up between nodes that split the file the same way,
+        so peers are picked among the nodes using the most common block size.
+        Nodes whose host does not resolve are left out."""
+        if not file.nodes:
+            return cls(info={})
+        block_sizes = Counter(node.block_size for node in file.nodes.values())
+        file_peers = cls(info={}, block_size=block_sizes.most_common(1)[0][0])
+        hashes = Counter()
+        addresses = DNS_CACHE.hosts_to_addresses(
+            node.host for node in file.nodes.values()
+        )
         for node in file.nodes.values():
+            if node.block_size != file_peers.block_size or node.host not in addresses:
+                continue
+            file_peers.size = max(file_peers.size, node.size)
+            if node.hash_key() in file.hashes:
+                hashes[node.hash_key()] += 1
+            address = Address(host=addresses[node.host], port=node.port)
             for block in node.blocks:
+                file_peers.replicas.setdefault(block, []).append(address)
                 if block not in file_peers.info:
-                    file_peers.info[block] = Address(
-                        host=dns_host_to_address(node.host), port=node.port
-                    )
+                    file_peers.info[block] = address
+        if hashes:
+            file_peers.hashes = file.hashes[hashes.most_common(1)[0][0]]
         return file_peers
 
 
 @dataclass
-class PacketInfo:
-    file_name: FileName
+class BlockRequest:
+    file_id: FileId
     block_id: BlockId
-    packet_id: PacketId = 0
+    block_size: int = BLOCK_SIZE
+    packet_size: int = PACKET_SIZE
+    file_name: Optional[FileName] = None
 
     def to_bytes(self) -> bytes:
-        return f"{self.file_name};{self.block_id};{self.packet_id}".encode("utf-8")
+        name = self.file_name.encode("utf-8") if self.file_name is not None else b""
+        flags = FLAG_FILE_NAME if self.file_name is not None else 0
+        return (
+            HEADER.pack(OP_REQUEST, flags, self.file_id, self.block_id, 0, len(name))
+            + REQUEST_BODY.pack(self.block_size, self.packet_size)
+            + name
+        )
 
     @classmethod
-    def from_bytes(cls, data: bytes) -> "PacketInfo":
-        file_name, block_id, packet_id = data.decode("utf-8").split(";")
+    def from_bytes(cls, data: bytes) -> "BlockRequest":
+        """Raises `ValueError` or `struct.error` for requests that make no sense."""
+        _, flags, file_id, block_id, _, length = HEADER.unpack_from(data)
+        block_size, packet_size = REQUEST_BODY.unpack_from(data, HEADER.size)
+        if not block_size or not packet_size:
+            raise ValueError("Block and packet sizes must be positive")
+        file_name = None
+        if flags & FLAG_FILE_NAME:
+            start = HEADER.size + REQUEST_BODY.size
+            file_name = data[start : start + length].decode("utf-8")
         return cls(
-            file_name=file_name, block_id=int(block_id), packet_id=int(packet_id)
+            file_id=file_id,
+            block_id=block_id,
+            block_size=block_size,
+            packet_size=packet_size,
+            file_name=file_name,
         )
 
 
+@dataclass
+class PacketInfo:
+    file_id: FileId
+    block_id: BlockId
+    packet_id: PacketId = 0
+
+    def to_bytes(self, opcode: int = OP_ACK) -> bytes:
+        return HEADER.pack(opcode, 0, self.file_id, self.block_id, self.packet_id, 0)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "PacketInfo":
+        _, _, file_id, block_id, packet_id, _ = HEADER.unpack_from(data)
+        return cls(file_id=file_id, block_id=block_id, packet_id=packet_id)
+
+
 class SentPacket:
     packet_id: PacketId
-    data: bytes
-    sent_at: datetime
+    data: memoryview
+    sent_at: float
+    deadline: float
+    retries: int
+    file_id: FileId
+    block_id: BlockId
 
-    def __init__(self, *, packet_id: PacketId, data: bytes):
+    def __init__(
+        self,
+        *,
+        packet_id: PacketId,
+        data: memoryview,
+        file_id: FileId = 0,
+        block_id: BlockId = 0,
+    ):
         self.packet_id = packet_id
         self.data = data
-        self.sent_at = datetime.now()
+        self.file_id = file_id
+        self.block_id = block_id
+        self.sent_at = monotonic()
+        self.deadline = self.sent_at + PACKET_ACK_TIMEOUT
+        self.retries = 0
+
+    def header(self) -> bytes:
+        return HEADER.pack(
+            OP_DATA, 0, self.file_id, self.block_id, self.packet_id, len(self.data)
+        )
 
     def to_bytes(self) -> bytes:
-        return f"{self.packet_id};".encode("utf-8") + self.data
+        return self.header() + self.data
 
     @classmethod
     def from_bytes(cls, data: bytes) -> "SentPacket":
-        packet_id, data = data.split(b";", 1)
-        return cls(packet_id=int(packet_id), data=data)
+        _, _, file_id, block_id, packet_id, length = HEADER.unpack_from(data)
+        if len(data) < HEADER.size + length:
+            raise ValueError("Packet shorter than its header says")
+        return cls(
+            packet_id=packet_id,
+            data=memoryview(data)[HEADER.size : HEADER.size + length],
+            file_id=file_id,
+            block_id=block_id,
+        )
 
     def __eq__(self, other: "SentPacket") -> bool:
         return self.packet_id == other.packet_id and self.data == other.data
 
-    def should_resend(self) -> bool:
-        return self.sent_at + timedelta(seconds=PACKET_ACK_TIMEOUT) < datetime.now()
-
-    def update(self) -> None:
-        self.sent_at = datetime.now()
+    def update(self, *, timeout: float = PACKET_ACK_TIMEOUT) -> None:
+        self.sent_at = monotonic()
+        self.deadline = self.sent_at + timeout
 
 
 @dataclass
 class SentBlock:
     block_id: BlockId
     packets: dict[PacketId, SentPacket]
+    next_packet_id: PacketId = 0
+    n_acked: int = 0
 
     def add_packet(self, *, packet: SentPacket) -> "SentBlock":
         self.packets[packet.packet_id] = packet
@@ -246,12 +849,864 @@ class SentBlock:
     def remove_packet(self, *, packet_id: PacketId) -> "SentBlock":
         if packet_id in self.packets:
             self.packets.pop(packet_id)
+            if packet_id < self.next_packet_id:
+                self.n_acked += 1
         return self
 
+    def n_in_flight(self) -> int:
+        return self.next_packet_id - self.n_acked
+
+    def has_unsent(self) -> bool:
+        return self.next_packet_id in self.packets
+
+    def next_packets(self, *, count: int) -> list[SentPacket]:
+        """Takes up to `count` packets that were never sent, advancing the window."""
+        packets = []
+        while len(packets) < count and self.next_packet_id in self.packets:
+            packets.append(self.packets[self.next_packet_id])
+            self.next_packet_id += 1
+        return packets
+
+
+@dataclass
+class RttEstimator:
+    """Retransmission timeout from RTT samples, as in RFC 6298 (Jacobson/Karels)."""
+
+    srtt: Optional[float] = None
+    rttvar: float = 0.0
+    rto: float = PACKET_ACK_TIMEOUT
+    backoff_at: float = 0.0
+
+    def sample(self, rtt: float) -> None:
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, RTO_MIN), RTO_MAX)
+
+    def backoff(self, *, sent_at: float) -> None:
+        """Doubles the RTO once per loss event: packets sent before the last backoff
+        expire with the old timeout and must not double it again."""
+        if sent_at >= self.backoff_at:
+            self.rto = min(self.rto * 2, RTO_MAX)
+            self.backoff_at = monotonic()
+
+
+class CongestionController(ABC):
+    """Per-peer congestion window, in packets, driven by ACK and loss signals.
+
+    `max_cwnd` is lowered by the node to what the peer's receive buffer can hold,
+    as packets past it are dropped by the kernel before anyone reads them.
+    """
+
+    cwnd: float
+    max_cwnd: float = MAX_CWND
+
+    @abstractmethod
+    def on_ack(self) -> None: ...
+
+    @abstractmethod
+    def on_loss(self, *, sent_at: float) -> None: ...
+
+    def window(self) -> int:
+        return max(int(min(self.cwnd, self.max_cwnd)), 1)
+
+
+@dataclass
+class AimdController(CongestionController):
+    """Slow start up to ssthresh, then additive increase of one packet per RTT and
+    multiplicative decrease on loss, like TCP Reno without fast recovery."""
+
+    cwnd: float = INITIAL_CWND
+    ssthresh: float = MAX_CWND
+    loss_at: float = 0.0
+
+    def on_ack(self) -> None:
+        if self.cwnd < self.ssthresh:
+            self.cwnd += 1
+        else:
+            self.cwnd += 1 / self.cwnd
+        self.cwnd = min(self.cwnd, self.max_cwnd)
+
+    def on_loss(self, *, sent_at: float) -> None:
+        if sent_at >= self.loss_at:
+            self.ssthresh = max(self.cwnd / 2, MIN_CWND)
+            self.cwnd = self.ssthresh
+            self.loss_at = monotonic()
+
+
+@dataclass
+class FixedWindowController(CongestionController):
+    cwnd: float = MAX_CWND
+
+    def on_ack(self) -> None:
+        pass
+
+    def on_loss(self, *, sent_at: float) -> None:
+        pass
+
+
+@dataclass
+class TokenBucket:
+    """Upload cap in bytes per second. Tokens may go negative so that traffic that
+    cannot wait, like retransmissions, is still charged against the cap."""
+
+    rate: float
+    burst: float
+    tokens: float = 0.0
+    updated_at: float = field(default_factory=monotonic)
+
+    def refill(self, now: float) -> None:
+        self.tokens += (now - self.updated_at) * self.rate
+        self.tokens = min(self.tokens, self.burst)
+        self.updated_at = now
+
+    def wait_time(self, size: int, now: float) -> float:
+        self.refill(now)
+        if self.tokens >= size:
+            return 0.0
+        return (size - self.tokens) / self.rate
+
+    def consume(self, size: int, now: float) -> None:
+        self.refill(now)
+        self.tokens -= size
+
+
+@dataclass
+class RateEstimator:
+    rate: float = 0.0
+    interval_bytes: int = 0
+    interval_start: float = field(default_factory=monotonic)
+
+    def add(self, size: int, now: float) -> None:
+        self.interval_bytes += size
+        elapsed = now - self.interval_start
+        if elapsed >= RATE_INTERVAL:
+            self.rate = self.interval_bytes / elapsed
+            self.interval_bytes = 0
+            self.interval_start = now
+
+
+class RetransmitQueue:
+    """Min-heap of retransmission deadlines.
+
+    Entries are never removed when a packet is acknowledged; `pop_expired` skips
+    them lazily, so scheduling and acking are O(log n) and O(1).
+    """
+
+    def __init__(self):
+        self.heap: list[tuple[float, int, Any, SentPacket]] = []
+        self.sequence = count()
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+    def push(self, *, client: Any, packet: SentPacket) -> None:
+        heapq.heappush(
+            self.heap, (packet.deadline, next(self.sequence), client, packet)
+        )
+
+    def next_deadline(self) -> Optional[float]:
+        return self.heap[0][0] if self.heap else None
+
+    def pop_expired(self, now: float) -> list[tuple[Any, SentPacket]]:
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, _, client, packet = heapq.heappop(self.heap)
+            if packet.deadline == deadline:
+                expired.append((client, packet))
+        return expired
+
+
+class ExpiryIndex:
+    """When each key was last seen, with a min-heap of deadlines to find the
+    expired ones without scanning every key.
+
+    Touching a key only updates its time. Its heap entry is moved to the real
+    deadline when it is popped early, so the heap holds one entry per key.
+    """
+
+    def __init__(self, *, ttl: float):
+        self.ttl = ttl
+        self.last_seen: dict[Url, float] = {}
+        self.heap: list[tuple[float, Url]] = []
+        self.queued: set[Url] = set()
+
+    def __contains__(self, key: Url) -> bool:
+        return key in self.last_seen
+
+    def __len__(self) -> int:
+        return len(self.last_seen)
+
+    def touch(self, key: Url, now: float) -> None:
+        self.last_seen[key] = now
+        if key not in self.queued:
+            self.queued.add(key)
+            heapq.heappush(self.heap, (now + self.ttl, key))
+
+    def discard(self, key: Url) -> None:
+        self.last_seen.pop(key, None)
+
+    def is_live(self, key: Url, now: float) -> bool:
+        last_seen = self.last_seen.get(key)
+        return last_seen is not None and now - last_seen < self.ttl
+
+    def next_deadline(self) -> Optional[float]:
+        return self.heap[0][0] if self.heap else None
+
+    def pop_expired(self, now: float) -> list[Url]:
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            _, key = heapq.heappop(self.heap)
+            last_seen = self.last_seen.get(key)
+            if last_seen is not None and last_seen + self.ttl > now:
+                heapq.heappush(self.heap, (last_seen + self.ttl, key))
+                continue
+            self.queued.discard(key)
+            if last_seen is not None:
+                del self.last_seen[key]
+                expired.append(key)
+        return expired
+
+
+@dataclass
+class CachedFile:
+    tag: str
+    file: File
+    checked_at: float
+
+
+class FileInfoCache:
+    """LRU cache of the file records a node got from the tracker, each with the
+    tag the tracker gave it.
+
+    Records checked less than `max_age` seconds ago are used as they are. Older
+    ones are revalidated by sending their tag back, and the tracker answers
+    with just the tag while the record is unchanged.
+    """
+
+    def __init__(
+        self, *, capacity: int = FILE_CACHE_SIZE, max_age: float = FILE_CACHE_MAX_AGE
+    ):
+        self.capacity = capacity
+        self.max_age = max_age
+        self.entries: OrderedDict[FileName, CachedFile] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, file_name: FileName) -> Optional[CachedFile]:
+        entry = self.entries.get(file_name)
+        if entry is not None:
+            self.entries.move_to_end(file_name)
+        return entry
+
+    def is_fresh(self, entry: CachedFile, now: float) -> bool:
+        return now - entry.checked_at < self.max_age
+
+    def put(self, file_name: FileName, *, tag: str, file: File, now: float) -> None:
+        self.entries[file_name] = CachedFile(tag=tag, file=file, checked_at=now)
+        self.entries.move_to_end(file_name)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def discard(self, file_name: FileName) -> None:
+        self.entries.pop(file_name, None)
+
+
+class MappedFileCache:
+    """LRU cache of read-only memory maps of shared files.
+
+    Evicted maps are not closed: packets still waiting for an ACK may hold slices
+    of them, and the map is released once the last slice is gone.
+    """
+
+    def __init__(self, capacity: int = MAPPED_FILES):
+        self.capacity = capacity
+        self.maps: OrderedDict[Path, tuple[tuple[int, int], memoryview]] = (
+            OrderedDict()
+        )
+
+    def get(self, path: Path) -> memoryview:
+        stat = os.stat(path)
+        version = (stat.st_size, stat.st_mtime_ns)
+        cached = self.maps.get(path)
+        if cached is not None and cached[0] == version:
+            self.maps.move_to_end(path)
+            return cached[1]
+        if stat.st_size == 0:
+            view = memoryview(b"")
+        else:
+            with open(path, mode="rb") as fp:
+                view = memoryview(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ))
+        self.maps[path] = (version, view)
+        self.maps.move_to_end(path)
+        while len(self.maps) > self.capacity:
+            self.maps.popitem(last=False)
+        return view
+
+
+class BlockBitmap:
+    """Set of completed blocks of a file, one bit per block."""
+
+    def __init__(self, n_blocks: int, bits: Optional[bytes] = None):
+        self.n_blocks = n_blocks
+        self.bits = bytearray(bits if bits is not None else (n_blocks + 7) // 8)
+        self.n_set = sum(bin(byte).count("1") for byte in self.bits)
+
+    def __contains__(self, block: BlockId) -> bool:
+        return bool(self.bits[block >> 3] & (1 << (block & 7)))
+
+    def __len__(self) -> int:
+        return self.n_set
+
+    def __eq__(self, other: "BlockBitmap") -> bool:
+        return self.n_blocks == other.n_blocks and self.bits == other.bits
+
+    def add(self, block: BlockId) -> None:
+        if block not in self:
+            self.bits[block >> 3] |= 1 << (block & 7)
+            self.n_set += 1
+
+    def is_complete(self) -> bool:
+        return self.n_set == self.n_blocks
+
+    def missing(self) -> list[BlockId]:
+        return [block for block in range(self.n_blocks) if block not in self]
+
+    def blocks(self) -> list[BlockId]:
+        return [block for block in range(self.n_blocks) if block in self]
+
+    def to_ranges(self) -> BlockRanges:
+        return BlockRanges.from_blocks(self.blocks())
+
+    def to_bytes(self) -> bytes:
+        return bytes(self.bits)
+
+
+class BlockScheduler:
+    """Hands out the blocks of a download to the peers that hold them.
+
+    Blocks are handed out rarest first, so copies held by a single peer are
+    fetched while that peer is still around. Each block goes to the replica
+    expected to finish it soonest, given its measured download rate and the
+    blocks already in flight there, and no peer holds more than `peer_limit`
+    blocks at once. Blocks stay unassigned until a peer has a free slot, so
+    idle fast peers take the work slow ones would otherwise queue.
+
+    Once every block has been handed out and at most `endgame_blocks` are still
+    in flight, those are also handed to other replicas, up to `endgame_copies`
+    fetches each, so the tail of a download is bounded by the fastest replica
+    rather than the slowest.
+
+    A `priority` key, lowest first, takes precedence over rarity, e.g. to finish
+    small files before large ones when several are downloaded together.
+    """
+
+    def __init__(
+        self,
+        *,
+        replicas: dict[BlockId, list[Address]],
+        blocks: list[BlockId],
+        peer_limit: int,
+        endgame_blocks: int = 0,
+        endgame_copies: int = 1,
+        priority: Callable[[Any], Any] = lambda block: 0,
+    ):
+        self.replicas = replicas
+        self.peer_limit = peer_limit
+        self.endgame_blocks = endgame_blocks
+        self.endgame_copies = endgame_copies
+        self.pending = sorted(
+            blocks, key=lambda block: (priority(block), len(replicas[block]), block)
+        )
+        self.peers = {address for block in blocks for address in replicas[block]}
+        self.in_flight: dict[Address, set[BlockId]] = {}
+        self.fetching: dict[BlockId, set[Address]] = {}
+        self.failed: dict[BlockId, set[Address]] = {}
+
+    def __len__(self) -> int:
+        return len(self.pending) + len(self.fetching)
+
+    def load(self, address: Address) -> int:
+        return len(self.in_flight.get(address, ()))
+
+    def has_free_peer(self) -> bool:
+        return any(self.load(address) < self.peer_limit for address in self.peers)
+
+    def assign(
+        self, *, rates: dict[Address, float], limit: int
+    ) -> list[tuple[BlockId, Address]]:
+        """Picks up to `limit` blocks and the peer to fetch each one from.
+
+        Peers without a measured rate are assumed to be as fast as the fastest
+        known one, so new peers get probed instead of starved.
+        """
+        default_rate = max(rates.values(), default=0.0) or 1.0
+        assignments = []
+        remaining = []
+        for index, block in enumerate(self.pending):
+            if len(assignments) >= limit or not self.has_free_peer():
+                remaining.extend(self.pending[index:])
+                break
+            address = self.pick_peer(block, rates, default_rate)
+            if address is None:
+                remaining.append(block)
+                continue
+            self.start(block, address)
+            assignments.append((block, address))
+        self.pending = remaining
+        if not self.pending and len(self.fetching) <= self.endgame_blocks:
+            for block in sorted(self.fetching, key=lambda b: len(self.fetching[b])):
+                if len(assignments) >= limit or not self.has_free_peer():
+                    break
+                if len(self.fetching[block]) >= self.endgame_copies:
+                    continue
+                address = self.pick_peer(block, rates, default_rate)
+                if address is not None:
+                    self.start(block, address)
+                    assignments.append((block, address))
+        return assignments
+
+    def pick_peer(
+        self, block: BlockId, rates: dict[Address, float], default_rate: float
+    ) -> Optional[Address]:
+        candidates = [
+            address
+            for address in self.replicas[block]
+            if self.load(address) < self.peer_limit
+            and address not in self.failed.get(block, ())
+            and address not in self.fetching.get(block, ())
+        ]
+        return min(
+            candidates,
+            key=lambda address: (self.load(address) + 1)
+            / (rates.get(address) or default_rate),
+            default=None,
+        )
+
+    def start(self, block: BlockId, address: Address) -> None:
+        self.in_flight.setdefault(address, set()).add(block)
+        self.fetching.setdefault(block, set()).add(address)
+
+    def stop(self, block: BlockId, address: Address) -> None:
+        self.in_flight.get(address, set()).discard(block)
+        fetching = self.fetching.get(block, set())
+        fetching.discard(address)
+        if not fetching:
+            self.fetching.pop(block, None)
+
+    def complete(self, block: BlockId, address: Address) -> list[Address]:
+        """Returns the other peers still fetching the block, which should be
+        cancelled."""
+        losers = [loser for loser in self.fetching.get(block, ()) if loser != address]
+        for peer in [address, *losers]:
+            self.stop(block, peer)
+        return losers
+
+    def fail(self, block: BlockId, address: Address) -> bool:
+        """Puts the block back in the queue unless no other replica is left.
+
+        Nothing is queued while another peer is still fetching the block.
+        """
+        self.stop(block, address)
+        failed = self.failed.setdefault(block, set())
+        failed.add(address)
+        if block in self.fetching:
+            return True
+        if failed.issuperset(self.replicas[block]):
+            return False
+        self.pending.insert(0, block)
+        return True
+
+
+class BlockHashCache:
+    """Block digests of shared files, persisted and keyed by path, size, mtime and
+    block size, so unchanged files are not hashed again on every registration.
+
+    Files are hashed concurrently on the executor: hashlib releases the GIL while
+    digesting large buffers, so a thread pool scales across cores.
+    """
+
+    def __init__(self, *, path: Path, executor: Executor):
+        self.path = path
+        self.executor = executor
+        self.entries: dict[str, dict[str, Any]] = {}
+        self.dirty = False
+        try:
+            with open(path, mode="r", encoding="utf-8") as fp:
+                self.entries = json.load(fp)
+        except (FileNotFoundError, ValueError):
+            pass
+
+    def get(self, file_path: Path, block_size: int) -> Optional[list[str]]:
+        return self.get_many([file_path], block_size)[0]
+
+    def get_many(
+        self, file_paths: list[Path], block_size: int
+    ) -> list[Optional[list[str]]]:
+        """Hashes the blocks of every stale file in one batch on the executor.
+        Files that are gone by the time they are read get None."""
+        versions = {}
+        missing = set()
+        for file_path in file_paths:
+            try:
+                stat = file_path.stat()
+            except FileNotFoundError:
+                missing.add(file_path)
+                self.dirty |= self.entries.pop(str(file_path), None) is not None
+                continue
+            version = [stat.st_size, stat.st_mtime_ns, block_size]
+            entry = self.entries.get(str(file_path))
+            if entry is None or entry["version"] != version:
+                versions[file_path] = version
+        digests = {
+            file_path: [
+                self.executor.submit(hash_block, file_path, offset, block_size)
+                for offset in range(0, version[0], block_size)
+            ]
+            for file_path, version in versions.items()
+        }
+        for file_path, version in versions.items():
+            try:
+                hashes = "".join(digest.result() for digest in digests[file_path])
+            except FileNotFoundError:
+                missing.add(file_path)
+                self.dirty |= self.entries.pop(str(file_path), None) is not None
+                continue
+            self.entries[str(file_path)] = {"version": version, "hashes": hashes}
+            self.dirty = True
+        return [
+            None if path in missing else split_hashes(self.entries[str(path)]["hashes"])
+            for path in file_paths
+        ]
+
+    def save(self) -> None:
+        """Only writes the cache when a file was hashed or dropped since the
+        last save."""
+        if not self.dirty:
+            return
+        tmp_path = self.path.with_name(f"{self.path.name}.tmp")
+        with open(tmp_path, mode="w", encoding="utf-8") as fp:
+            json.dump(self.entries, fp)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+
+@dataclass
+class DownloadState:
+    """Progress of a partial download, kept in a sidecar file next to it."""
+
+    size: int
+    block_size: int
+    completed: BlockBitmap
+    hashes: list[str] = field(default_factory=list)
+
+    @classmethod
+    def new(
+        cls, *, size: int, block_size: int, hashes: Optional[list[str]] = None
+    ) -> "DownloadState":
+        return cls(
+            size=size,
+            block_size=block_size,
+            completed=BlockBitmap(count_blocks(size, block_size)),
+            hashes=hashes or [],
+        )
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "size": self.size,
+            "block_size": self.block_size,
+            "completed": self.completed.to_bytes().hex(),
+            "hashes": self.hashes,
+        })
+
+    @classmethod
+    def from_json(cls, state_string: str) -> "DownloadState":
+        state = json.loads(state_string)
+        return cls(
+            size=state["size"],
+            block_size=state["block_size"],
+            completed=BlockBitmap(
+                count_blocks(state["size"], state["block_size"]),
+                bytes.fromhex(state["completed"]),
+            ),
+            hashes=state.get("hashes", []),
+        )
+
+    def save(self, *, path: Path) -> None:
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        with open(tmp_path, mode="w", encoding="utf-8") as fp:
+            fp.write(self.to_json())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, *, path: Path) -> "DownloadState":
+        with open(path, mode="r", encoding="utf-8") as fp:
+            return cls.from_json(fp.read())
+
+
+class CatalogJournal:
+    """Append-only log of tracker catalog changes, one JSON record per line.
+
+    The first line records the sequence number of the snapshot the log was
+    started after. A torn last line, from a crash mid-write, ends the replay
+    and is cut off when the log is reopened.
+    """
+
+    def __init__(self, *, path: Path):
+        self.path = path
+        self.fp = None
+        self.size = 0
+
+    @staticmethod
+    def encode(record: dict[str, Any]) -> bytes:
+        return json.dumps(record, separators=(",", ":")).encode("utf-8") + b"\n"
+
+    def replay(self) -> tuple[int, list[dict[str, Any]]]:
+        try:
+            with open(self.path, mode="rb") as fp:
+                lines = fp.read().split(b"\n")
+        except FileNotFoundError:
+            return 0, []
+        records = []
+        self.size = 0
+        for line in lines[:-1]:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                break
+            self.size += len(line) + 1
+        if not records:
+            return 0, []
+        return records[0].get("snapshot", 0), records[1:]
+
+    def open(self, *, snapshot_seq: int) -> None:
+        if not self.path.exists():
+            self.reset(snapshot_seq=snapshot_seq)
+        else:
+            self.fp = open(self.path, mode="ab")
+            self.fp.truncate(self.size)
+
+    def write(self, data: bytes) -> None:
+        self.fp.write(data)
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+
+    def reset(self, *, snapshot_seq: int) -> None:
+        """Starts an empty log after a snapshot, swapped in atomically."""
+        tmp_path = self.path.with_name(f"{self.path.name}.tmp")
+        with open(tmp_path, mode="wb") as fp:
+            fp.write(self.encode({"snapshot": snapshot_seq}))
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, self.path)
+        if self.fp is not None:
+            self.fp.close()
+        self.fp = open(self.path, mode="ab")
+
+
+@dataclass
+class ManifestEntry:
+    size: int
+    block_size: int
+    hashes: list[str]
+    blocks: BlockRanges
+
+    def __post_init__(self) -> None:
+        if not isinstance(self.blocks, BlockRanges):
+            self.blocks = BlockRanges.from_blocks(self.blocks)
+
+    def to_message(self, file_name: FileName) -> str:
+        return (
+            f"+;{file_name};{self.size};{self.block_size};{''.join(self.hashes)};"
+            + str(self.blocks)
+        )
+
+    @classmethod
+    def from_message(cls, message: str) -> tuple[FileName, "ManifestEntry"]:
+        file_name, size, block_size, hashes, blocks = message[2:].rsplit(";", 4)
+        return file_name, cls(
+            size=int(size),
+            block_size=int(block_size),
+            hashes=split_hashes(hashes),
+            blocks=BlockRanges.from_string(blocks),
+        )
+
+
+@dataclass
+class NodeManifest:
+    """What the tracker was last told about a node's files.
+
+    Registrations only carry the changes against it, one per line: `+` adds or
+    replaces a file, `*` adds blocks to a file and `-` removes one. `version`
+    is the tracker's count of registrations it applied for this node; 0 means
+    the tracker knows nothing and the changes replace everything it had.
+
+    On disk, the changes of each registration are appended to a log next to
+    the saved manifest, which is only rewritten once the log outgrows it.
+    """
+
+    version: int = 0
+    entries: dict[FileName, ManifestEntry] = field(default_factory=dict)
+
+    def diff(self, current: dict[FileName, ManifestEntry]) -> list[str]:
+        changes = []
+        for file_name, entry in current.items():
+            old = self.entries.get(file_name)
+            if old == entry:
+                continue
+            if (
+                old is not None
+                and (old.size, old.block_size, old.hashes)
+                == (entry.size, entry.block_size, entry.hashes)
+                and old.blocks.issubset(entry.blocks)
+            ):
+                added = entry.blocks.difference(old.blocks)
+                changes.append(f"*;{file_name};{added}")
+            else:
+                changes.append(entry.to_message(file_name))
+        changes.extend(
+            f"-;{file_name}" for file_name in self.entries.keys() - current.keys()
+        )
+        return changes
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "version": self.version,
+            "entries": {
+                file_name: [
+                    entry.size,
+                    entry.block_size,
+                    entry.hashes,
+                    str(entry.blocks),
+                ]
+                for file_name, entry in self.entries.items()
+            },
+        })
+
+    @classmethod
+    def from_json(cls, manifest_string: str) -> "NodeManifest":
+        manifest = json.loads(manifest_string)
+        return cls(
+            version=manifest["version"],
+            entries={
+                file_name: ManifestEntry(
+                    size=size,
+                    block_size=block_size,
+                    hashes=hashes,
+                    blocks=BlockRanges.from_string(blocks),
+                )
+                for file_name, (size, block_size, hashes, blocks) in manifest[
+                    "entries"
+                ].items()
+            },
+        )
+
+    def apply(self, changes: list[str]) -> None:
+        for change in changes:
+            if change[0] == "+":
+                file_name, entry = ManifestEntry.from_message(change)
+                self.entries[file_name] = entry
+            elif change[0] == "*":
+                file_name, blocks = change[2:].rsplit(";", 1)
+                entry = self.entries[file_name]
+                entry.blocks = entry.blocks.union(BlockRanges.from_string(blocks))
+            else:
+                self.entries.pop(change[2:], None)
+
+    @staticmethod
+    def log_path(path: Path) -> Path:
+        return path.with_name(f"{path.name}{MANIFEST_LOG_SUFFIX}")
+
+    def save(self, *, path: Path) -> None:
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        with open(tmp_path, mode="w", encoding="utf-8") as fp:
+            fp.write(self.to_json())
+        os.replace(tmp_path, path)
+        self.log_path(path).unlink(missing_ok=True)
+
+    def save_changes(self, *, path: Path, changes: list[str]) -> None:
+        """Records the changes that brought the manifest to `version`."""
+        record = json.dumps({"version": self.version, "changes": changes}) + "\n"
+        log_path = self.log_path(path)
+        try:
+            log_size = log_path.stat().st_size if log_path.exists() else 0
+            if log_size + len(record) <= path.stat().st_size:
+                with open(log_path, mode="a", encoding="utf-8") as fp:
+                    fp.write(record)
+                return
+        except FileNotFoundError:
+            pass
+        self.save(path=path)
+
+    @classmethod
+    def load(cls, *, path: Path) -> "NodeManifest":
+        """Replays the logged changes newer than the saved manifest, up to a
+        torn last line."""
+        with open(path, mode="r", encoding="utf-8") as fp:
+            manifest = cls.from_json(fp.read())
+        try:
+            with open(cls.log_path(path), mode="r", encoding="utf-8") as fp:
+                for line in fp:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    if record["version"] > manifest.version:
+                        manifest.apply(record["changes"])
+                        manifest.version = record["version"]
+        except FileNotFoundError:
+            pass
+        return manifest
+
+
+@dataclass
+class ReceivedBlock:
+    file_id: FileId
+    block_id: BlockId
+    expected_packet: PacketId = 0
+    pending: dict[PacketId, memoryview] = field(default_factory=dict)
+
+    def add_packet(self, *, packet: SentPacket) -> list[memoryview]:
+        """Buffers out-of-order packets and returns the data that became contiguous."""
+        if packet.packet_id >= self.expected_packet:
+            self.pending[packet.packet_id] = packet.data
+        ready = []
+        while self.expected_packet in self.pending:
+            ready.append(self.pending.pop(self.expected_packet))
+            self.expected_packet += 1
+        return ready
+
+
+@dataclass
+class PeerState:
+    rtt: RttEstimator
+    congestion: CongestionController
+    in_flight: int = 0
+    rate: RateEstimator = field(default_factory=RateEstimator)
+    received: RateEstimator = field(default_factory=RateEstimator)
+    blocks: deque[SentBlock] = field(default_factory=deque)
+    sent: int = 0
+    retransmitted: int = 0
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "cwnd": self.congestion.cwnd,
+            "in_flight": self.in_flight,
+            "rate": self.rate.rate,
+            "download_rate": self.received.rate,
+            "rto": self.rtt.rto,
+            "sent": self.sent,
+            "retransmitted": self.retransmitted,
+        }
+
 
 @dataclass
 class SentFile:
-    file_name: FileName
+    file_id: FileId
     blocks: dict[BlockId, SentBlock]
 
     def add_block(self, *, block: SentBlock) -> "SentFile":
@@ -261,27 +1716,38 @@ class SentFile:
     def remove_packet(self, *, block_id: BlockId, packet_id: PacketId) -> "SentFile":
         if block_id in self.blocks:
             self.blocks[block_id].remove_packet(packet_id=packet_id)
-        if not self.blocks[block_id].packets:
-            self.blocks.pop(block_id)
+            if not self.blocks[block_id].packets:
+                self.blocks.pop(block_id)
+        return self
+
+    def remove_block(self, *, block_id: BlockId) -> "SentFile":
+        self.blocks.pop(block_id, None)
         return self
 
 
 @dataclass
 class SentClient:
     client_address: Address
-    files: dict[FileName, SentFile]
+    files: dict[FileId, SentFile]
 
     def add_file(self, *, file: SentFile) -> "SentClient":
-        self.files[file.file_name] = file
+        self.files[file.file_id] = file
         return self
 
     def remove_packet(self, *, packet_info: PacketInfo) -> "SentClient":
-        if packet_info.file_name in self.files:
-            self.files[packet_info.file_name].remove_packet(
+        if packet_info.file_id in self.files:
+            self.files[packet_info.file_id].remove_packet(
                 block_id=packet_info.block_id, packet_id=packet_info.packet_id
             )
-        if not self.files[packet_info.file_name].blocks:
-            self.files.pop(packet_info.file_name)
+            if not self.files[packet_info.file_id].blocks:
+                self.files.pop(packet_info.file_id)
+        return self
+
+    def remove_block(self, *, packet_info: PacketInfo) -> "SentClient":
+        if packet_info.file_id in self.files:
+            self.files[packet_info.file_id].remove_block(block_id=packet_info.block_id)
+            if not self.files[packet_info.file_id].blocks:
+                self.files.pop(packet_info.file_id)
         return self
 
 
@@ -296,11 +1762,11 @@ class SentCatalog:
         return self
 
     def add_block(
-        self, *, client: Address, file_name: FileName, block: SentBlock
+        self, *, client: Address, file_id: FileId, block: SentBlock
     ) -> "SentCatalog":
-        if client not in self.clients or file_name not in self.clients[client].files:
-            self.add_file(client=client, file=SentFile(file_name=file_name, blocks={}))
-        self.clients[client].files[file_name].add_block(block=block)
+        if client not in self.clients or file_id not in self.clients[client].files:
+            self.add_file(client=client, file=SentFile(file_id=file_id, blocks={}))
+        self.clients[client].files[file_id].add_block(block=block)
         return self
 
     def remove_packet(
@@ -312,20 +1778,95 @@ class SentCatalog:
                 self.clients.pop(client)
         return self
 
-    def get_next_packet(
+    def remove_block(
         self, *, packet_info: PacketInfo, client: Address
-    ) -> Optional[SentPacket]:
+    ) -> "SentCatalog":
+        if client in self.clients:
+            self.clients[client].remove_block(packet_info=packet_info)
+            if not self.clients[client].files:
+                self.clients.pop(client)
+        return self
+
+    def get_block(
+        self, *, packet_info: PacketInfo, client: Address
+    ) -> Optional[SentBlock]:
         try:
             return (
                 self.clients[client]
-                .files[packet_info.file_name]
+                .files[packet_info.file_id]
                 .blocks[packet_info.block_id]
-                .packets[packet_info.packet_id + 1]
             )
         except KeyError:
             return None
 
 
+def encode_frame(request_id: int, payload: bytes) -> bytes:
+    return FRAME_HEADER.pack(request_id, len(payload)) + payload
+
+
+class FrameBuffer:
+    """Splits a tracker connection's byte stream into `(request_id, payload)`
+    frames, each prefixed by its id and length."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes) -> list[tuple[int, bytes]]:
+        self.buffer += data
+        frames = []
+        start = 0
+        while len(self.buffer) - start >= FRAME_HEADER.size:
+            request_id, length = FRAME_HEADER.unpack_from(self.buffer, start)
+            if length > MAX_FRAME_SIZE:
+                raise ValueError(f"Frame of {length} bytes is too large")
+            end = start + FRAME_HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            frames.append((request_id, bytes(self.buffer[end - length : end])))
+            start = end
+        del self.buffer[:start]
+        return frames
+
+
+def dump_json(data: Any) -> str:
+    return JSON_ENCODER.encode(data)
+
+
+def block_digest(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=HASH_SIZE).hexdigest()
+
+
+def split_hashes(hashes: str) -> list[str]:
+    width = HASH_SIZE * 2
+    return [hashes[i : i + width] for i in range(0, len(hashes), width)]
+
+
+def is_relative_name(file_name: FileName) -> bool:
+    """Catalog names are paths relative to a node's storage folder; any other
+    name would have a node write or serve a file outside of it."""
+    parts = PurePosixPath(file_name).parts
+    return bool(parts) and parts[0] != "/" and ".." not in parts
+
+
+def hash_block(path: Path, offset: int, block_size: int) -> str:
+    with open(path, mode="rb") as fp:
+        fp.seek(offset)
+        return block_digest(fp.read(block_size))
+
+
+def count_blocks(size: int, block_size: int) -> int:
+    return -(-size // block_size)
+
+
+def preallocate(fd: int, size: int) -> None:
+    os.ftruncate(fd, size)
+    if size and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError:
+            pass
+
+
 def int_to_bytes(number: int, length: int = 4) -> bytes:
     return number.to_bytes(length, byteorder="little")
 
@@ -334,23 +1875,114 @@ def bytes_to_int(number: bytes) -> int:
     return int.from_bytes(number, byteorder="little")
 
 
-def is_socket_alive(s: socket.socket) -> bool:
-    try:
-        data = s.recv(1, socket.MSG_DONTWAIT | socket.MSG_PEEK)
-        if not data:
-            return False
-    except BlockingIOError:
-        return True
-    except ConnectionResetError:
-        return False
-    except Exception as e:
-        return True
-    return True
+class DnsCache:
+    """Cache of forward and reverse lookups shared by the whole process.
+
+    Answers are kept for `ttl` seconds and failures for `negative_ttl`. Threads
+    asking for a name already being looked up wait for that lookup instead of
+    starting their own.
+    """
+
+    def __init__(
+        self,
+        *,
+        ttl: float = DNS_TTL,
+        negative_ttl: float = DNS_NEGATIVE_TTL,
+    ):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries: dict[tuple[str, str], tuple[float, Any]] = {}
+        self.lookups: dict[tuple[str, str], Future] = {}
+        self.guard = Lock()
+
+    def cached(self, key: tuple[str, str]) -> Optional[str]:
+        """Returns a fresh answer without blocking, raising a fresh failure."""
+        entry = self.entries.get(key)
+        if entry is None or entry[0] <= monotonic():
+            return None
+        if isinstance(entry[1], OSError):
+            raise entry[1]
+        return entry[1]
+
+    def resolve(self, key: tuple[str, str]) -> str:
+        answer = self.cached(key)
+        if answer is not None:
+            return answer
+        with self.guard:
+            lookup = self.lookups.get(key)
+            owner = lookup is None
+            if owner:
+                lookup = self.lookups[key] = Future()
+        if owner:
+            kind, name = key
+            try:
+                if kind == "address":
+                    result = socket.gethostbyname(name)
+                else:
+                    result = socket.gethostbyaddr(name)[0]
+                ttl = self.ttl
+            except OSError as e:
+                result, ttl = e, self.negative_ttl
+            with self.guard:
+                self.entries[key] = (monotonic() + ttl, result)
+                del self.lookups[key]
+            lookup.set_result(result)
+        result = lookup.result()
+        if isinstance(result, OSError):
+            raise result
+        return result
+
+    def host_to_address(self, host: str) -> str:
+        return self.resolve(("address", host))
+
+    def address_to_host(self, address: str) -> str:
+        return self.resolve(("host", address))
+
+    def hosts_to_addresses(
+        self, hosts: Iterable[str], executor: Optional[Executor] = None
+    ) -> dict[str, str]:
+        """Resolves every distinct host once, the ones not cached concurrently.
+        Hosts that fail to resolve are left out."""
+        hosts = set(hosts)
+        addresses = {}
+        missing = []
+        for host in hosts:
+            try:
+                address = self.cached(("address", host))
+            except OSError:
+                continue
+            if address is None:
+                missing.append(host)
+            else:
+                addresses[host] = address
+
+        def lookup(host: str) -> Optional[str]:
+            try:
+                return self.host_to_address(host)
+            except OSError:
+                return None
+
+        if len(missing) == 1:
+            results = [lookup(missing[0])]
+        elif executor is not None:
+            results = list(executor.map(lookup, missing))
+        elif missing:
+            with ThreadPoolExecutor(max_workers=min(len(missing), 16)) as pool:
+                results = list(pool.map(lookup, missing))
+        else:
+            results = []
+        addresses.update(
+            (host, address) for host, address in zip(missing, results) if address
+        )
+        return addresses
+
+
+DNS_CACHE = DnsCache()
 
 
 def dns_host_to_address(host: str) -> str:
-    return socket.gethostbyname(host)
+    return DNS_CACHE.host_to_address(host)
 
 
 def address_to_dns_host(address: str) -> str:
-    return socket.gethostbyaddr(address)[0]
+    return DNS_CACHE.address_to_host(address)
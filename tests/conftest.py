@@ -0,0 +1,74 @@
+import socket
+import threading
+from pathlib import Path
+from typing import Callable
+
+import pytest
+
+from filetransfer.tracker import Tracker
+from filetransfer.utils import Address, FrameBuffer, encode_frame
+
+
+@pytest.fixture
+def start_tracker(tmpdir):
+    """Starts trackers keeping their catalog in tmpdir, stopped after the test."""
+    trackers = []
+
+    def start(**kwargs) -> Tracker:
+        tracker = Tracker(
+            address=Address(host="127.0.0.1", port=0),
+            store_path=Path(tmpdir) / "FS_Data.json",
+            **kwargs,
+        )
+        threading.Thread(target=tracker.start, daemon=True).start()
+        trackers.append(tracker)
+        return tracker
+
+    yield start
+    for tracker in trackers:
+        if tracker.running:
+            tracker.stop()
+
+
+@pytest.fixture
+def load_tracker(tmpdir):
+    """Loads the catalog and journal in tmpdir into a tracker that never starts."""
+
+    def load() -> Tracker:
+        tracker = Tracker(
+            address=Address(host="127.0.0.1", port=0),
+            store_path=Path(tmpdir) / "FS_Data.json",
+        )
+        tracker.server_socket.close()
+        return tracker
+
+    return load
+
+
+@pytest.fixture
+def tracker(start_tracker):
+    return start_tracker()
+
+
+@pytest.fixture
+def connect():
+    """Connects to a tracker and returns a function that sends one request on
+    that connection and waits for its response. Closed after the test."""
+    connections = []
+
+    def connect(tracker: Tracker) -> Callable[[str], str]:
+        connection = socket.create_connection(tracker.server_socket.getsockname())
+        connections.append(connection)
+        frames = FrameBuffer()
+
+        def request(message: str) -> str:
+            connection.sendall(encode_frame(1, message.encode("utf-8")))
+            while not (responses := frames.feed(connection.recv(65536))):
+                pass
+            return responses[0][1].decode("utf-8")
+
+        return request
+
+    yield connect
+    for connection in connections:
+        connection.close()
@@ -0,0 +1,238 @@
+import os
+import socket
+import time
+from pathlib import Path
+
+import pytest
+
+from filetransfer.node import SOCKET_BUFFER_SIZE, Node
+from filetransfer.utils import (
+    HEADER,
+    OP_CANCEL,
+    OP_DATA,
+    OP_UNKNOWN_FILE,
+    Address,
+    BlockRequest,
+    DownloadState,
+    FileNode,
+    PacketInfo,
+    SentPacket,
+    block_digest,
+)
+from utils import Address as NodeAddress
+
+
+@pytest.fixture
+def start_node(tmpdir, tracker):
+    """Starts a node sharing the folder `name` of tmpdir, stopped after the test."""
+    nodes = []
+
+    def start(name: str, **kwargs) -> Node:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+        storage = Path(tmpdir) / name
+        storage.mkdir(exist_ok=True)
+        node = Node(
+            storage_folder=str(storage),
+            server_address=Address(
+                host="127.0.0.1", port=tracker.server_socket.getsockname()[1]
+            ),
+            address=Address(host="127.0.0.1", port=port),
+            **kwargs,
+        )
+        nodes.append(node)
+        return node
+
+    yield start
+    for node in nodes:
+        node.stop()
+
+
+def test_node_skips_unreadable_and_temporary_state(tmpdir, tracker, start_node):
+    storage = Path(tmpdir) / "a"
+    storage.mkdir()
+    (storage / "file.bin.part").write_bytes(b"\0" * 8)
+    (storage / "file.bin.part.state").write_text("")
+    (storage / "other.bin.part.state.tmp").write_text("{}")
+    (storage / "shared.bin").write_bytes(b"x")
+    node = start_node("a")
+    assert node.partial == {}
+    assert tracker.store.list_files() == ["shared.bin"]
+
+
+def test_node_sender_drops_unacknowledged_block(tmpdir, start_node):
+    (Path(tmpdir) / "a").mkdir()
+    (Path(tmpdir) / "a" / "f.bin").write_bytes(b"x" * 3000)
+    node = start_node("a", packet_retries=2)
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as peer:
+        peer.bind(("127.0.0.1", 0))
+        peer.settimeout(2)
+        node.get_peer(NodeAddress(host="127.0.0.1", port=peer.getsockname()[1]))
+        for state in node.peers.values():
+            state.rtt.rto = 0.05
+        request = BlockRequest(
+            file_id=7, block_id=0, block_size=4096, packet_size=1000, file_name="f.bin"
+        )
+        peer.sendto(request.to_bytes(), node.address.get())
+        assert peer.recv(2048)[0] == OP_DATA
+        deadline = time.monotonic() + 3
+        while node.sent_packets.clients and time.monotonic() < deadline:
+            time.sleep(0.05)
+    assert not node.sent_packets.clients
+    assert all(state.in_flight == 0 for state in node.peers.values())
+
+
+def test_node_resends_after_transfer_restart(tmpdir, start_node):
+    (Path(tmpdir) / "a").mkdir()
+    (Path(tmpdir) / "a" / "f.bin").write_bytes(b"x" * 3000)
+    node = start_node("a")
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as peer:
+        peer.bind(("127.0.0.1", 0))
+        peer.settimeout(2)
+        node.get_peer(NodeAddress(host="127.0.0.1", port=peer.getsockname()[1]))
+        for state in node.peers.values():
+            state.rtt.rto = 0.2
+        request = BlockRequest(
+            file_id=7, block_id=0, block_size=4096, packet_size=1000, file_name="f.bin"
+        )
+        peer.sendto(request.to_bytes(), node.address.get())
+        first = peer.recv(2048)
+        node.udp_stop()
+        node.udp_start()
+        while (data := peer.recv(2048)) != first:
+            pass
+    assert SentPacket.from_bytes(data).packet_id == 0
+
+
+def test_node_cancels_data_for_unknown_block(start_node):
+    node = start_node("a")
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as peer:
+        peer.bind(("127.0.0.1", 0))
+        peer.settimeout(2)
+        packet = SentPacket(
+            packet_id=0, data=memoryview(b"abc"), file_id=3, block_id=5
+        )
+        peer.sendto(packet.to_bytes(), node.address.get())
+        reply = peer.recv(2048)
+    assert reply[0] == OP_CANCEL
+    assert PacketInfo.from_bytes(reply) == PacketInfo(file_id=3, block_id=5)
+    assert len(reply) == HEADER.size
+
+
+def test_node_keeps_file_names_per_peer(tmpdir, start_node):
+    (Path(tmpdir) / "a").mkdir()
+    (Path(tmpdir) / "a" / "x.bin").write_bytes(b"x" * 3000)
+    (Path(tmpdir) / "a" / "y.bin").write_bytes(b"y" * 3000)
+    node = start_node("a")
+    peers = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(3)]
+    try:
+        for peer in peers:
+            peer.bind(("127.0.0.1", 0))
+            peer.settimeout(2)
+        for peer, file_name in zip(peers, ("x.bin", "y.bin", None)):
+            request = BlockRequest(
+                file_id=7,
+                block_id=0,
+                block_size=4096,
+                packet_size=1000,
+                file_name=file_name,
+            )
+            peer.sendto(request.to_bytes(), node.address.get())
+        replies = [peer.recv(2048) for peer in peers]
+    finally:
+        for peer in peers:
+            peer.close()
+    assert replies[0][0] == OP_DATA and replies[0].endswith(b"x" * 10)
+    assert replies[1][0] == OP_DATA and replies[1].endswith(b"y" * 10)
+    assert replies[2][0] == OP_UNKNOWN_FILE
+
+
+def test_node_drops_malformed_datagrams(start_node):
+    node = start_node("a")
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as peer:
+        peer.bind(("127.0.0.1", 0))
+        peer.settimeout(2)
+        for data in (
+            b"\x01\x00\x00",
+            BlockRequest(file_id=7, block_id=0, packet_size=0, file_name="x").to_bytes(),
+            BlockRequest(file_id=7, block_id=0).to_bytes()[: HEADER.size + 2],
+            b"\xff" + bytes(HEADER.size),
+        ):
+            peer.sendto(data, node.address.get())
+        peer.sendto(BlockRequest(file_id=7, block_id=0).to_bytes(), node.address.get())
+        reply = peer.recv(2048)
+    assert reply[0] == OP_UNKNOWN_FILE
+    assert not node.file_names
+
+
+def test_node_caps_window_to_receive_buffer(start_node):
+    node = start_node("a")
+    size = node.transfer_socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    assert size >= min(SOCKET_BUFFER_SIZE, 212992)
+    assert node.max_window == size // (2 * (node.packet_size + HEADER.size))
+    peer = node.get_peer(NodeAddress(host="127.0.0.1", port=1))
+    assert peer.congestion.window() <= node.max_window
+    peer.congestion.cwnd = 10**6
+    assert peer.congestion.window() == node.max_window
+
+
+def test_node_downloads_files_in_folders(tmpdir, tracker, start_node):
+    folder = Path(tmpdir) / "a" / "dir" / "sub"
+    folder.mkdir(parents=True)
+    (folder / "x.bin").write_bytes(b"x" * 5000)
+    start_node("a", block_size=2048)
+    assert tracker.store.list_files() == ["dir/sub/x.bin"]
+    tracker.store.add_file_node(
+        file_node=FileNode(host="127.0.0.1", port=1, blocks=[0], size=1),
+        file_name="../escape.bin",
+    )
+    tracker.expiry.touch("127.0.0.1:1", time.monotonic())
+    node = start_node("b", block_size=2048)
+    node.get_files()
+    assert (Path(tmpdir) / "b" / "dir" / "sub" / "x.bin").read_bytes() == b"x" * 5000
+    assert "../escape.bin" not in node.partial
+    assert "dir/sub/x.bin" in node.manifest.entries
+
+
+def test_node_download_resumes_and_fails_over(tmpdir, start_node):
+    block_size = 4096
+    payload = os.urandom(block_size * 30 + 100)
+    for name in ("a", "c"):
+        (Path(tmpdir) / name).mkdir()
+        (Path(tmpdir) / name / "big.bin").write_bytes(payload)
+    requested = {"a": set(), "c": set()}
+    for name in ("a", "c"):
+        seeder = start_node(name, block_size=block_size)
+        handler = seeder.file_request_handler if name == "a" else None
+
+        def record(handler=handler, blocks=requested[name], **kwargs):
+            """`c` swallows every request, like a node that died unannounced."""
+            blocks.add(kwargs["request"].block_id)
+            if handler is not None:
+                handler(**kwargs)
+
+        seeder.file_request_handler = record
+
+    storage = Path(tmpdir) / "b"
+    storage.mkdir()
+    hashes = [
+        block_digest(payload[i : i + block_size])
+        for i in range(0, len(payload), block_size)
+    ]
+    state = DownloadState.new(size=len(payload), block_size=block_size, hashes=hashes)
+    part = bytearray(len(payload))
+    for block in range(5):
+        state.completed.add(block)
+        offset = block * block_size
+        part[offset : offset + block_size] = payload[offset : offset + block_size]
+    (storage / "big.bin.part").write_bytes(part)
+    state.save(path=storage / "big.bin.part.state")
+
+    node = start_node("b", block_size=block_size, block_timeout=0.2)
+    node.get_file(file_name="big.bin")
+    assert (storage / "big.bin").read_bytes() == payload
+    assert not (storage / "big.bin.part.state").exists()
+    assert requested["c"]
+    assert requested["a"] | requested["c"] == set(range(5, 31))
+    assert requested["c"] <= requested["a"]
@@ -1,6 +1,292 @@
+import json
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Optional
+
 from filetransfer.tracker import get_store_path
+from filetransfer.utils import HASH_SIZE, CatalogJournal, FrameBuffer, encode_frame
 
 
 def test_store_path():
     assert get_store_path().exists()
     assert get_store_path().is_file()
+
+
+def test_import_does_not_resolve_host():
+    code = "import socket; socket.gethostbyname = None; import node, tracker"
+    subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=Path(__file__).parents[1] / "filetransfer",
+        check=True,
+    )
+
+
+def test_tracker_pipelined_requests(tmpdir, tracker):
+    connections = [
+        socket.create_connection(tracker.server_socket.getsockname())
+        for _ in range(20)
+    ]
+    node = connections[-1]
+    node.sendall(
+        encode_frame(1, b"1;9091;file1.txt;3;1;;0,1,2")
+        + encode_frame(2, b"2")
+        + encode_frame(3, b"3;file1.txt")
+        + encode_frame(4, b"3;file2.txt")
+    )
+    frames = FrameBuffer()
+    responses = {}
+    while len(responses) < 4:
+        responses.update(frames.feed(node.recv(65536)))
+    assert responses[1].startswith(b"OK")
+    assert responses[2] == b"['file1.txt']"
+    assert b'"blocks":"0-2"' in responses[3]
+    assert responses[4] == b""
+
+    tracker.stop()
+    for connection in connections:
+        connection.close()
+    assert "file1.txt" in (Path(tmpdir) / "FS_Data.json.wal").read_text()
+
+
+def test_tracker_delta_registration(tracker, connect):
+    request = connect(tracker)
+    assert request("5;9091;0\n+;file1.txt;9;4;;0,1\n+;file2.txt;1;4;;0").endswith(" 1")
+    assert request("5;9091;1\n*;file1.txt;2\n-;file2.txt").endswith(" 2")
+    assert tracker.store.list_files() == ["file1.txt"]
+    (file_node,) = tracker.store["file1.txt"].nodes.values()
+    assert list(file_node.blocks) == [0, 1, 2]
+
+    assert request("5;9091;1\n-;file1.txt") == "RESYNC"
+    assert request("5;9091;2\n*;file2.txt;0") == "RESYNC"
+    assert request("5;9091;0\n+;file3.txt;1;4;;0").endswith(" 1")
+    assert tracker.store.list_files() == ["file3.txt"]
+
+    assert request("5;9091;1\n+;a;b.txt;1;4;;0\n+;a;1;4;;0").endswith(" 2")
+    assert request("5;9091;2\n*;a;b.txt;1\n-;a").endswith(" 3")
+    assert tracker.store.list_files() == ["a;b.txt", "file3.txt"]
+    (file_node,) = tracker.store["a;b.txt"].nodes.values()
+    assert list(file_node.blocks) == [0, 1]
+
+
+def test_tracker_journal_replay(tmpdir, start_tracker, connect, load_tracker):
+    store_path = Path(tmpdir) / "FS_Data.json"
+    tracker = start_tracker(snapshot_records=2)
+    request = connect(tracker)
+    request("5;9091;0\n+;file1.txt;9;4;;0,1\n+;file2.txt;1;4;;0")
+    request("5;9091;1\n*;file1.txt;2")
+    request("5;9091;2\n-;file2.txt")
+    while tracker.commit_task is not None:
+        time.sleep(0.01)
+    tracker.stop()
+    assert tracker.snapshot_seq == 2
+    assert "file2.txt" in store_path.read_text()
+    with open(Path(tmpdir) / "FS_Data.json.wal", mode="ab") as fp:
+        fp.write(b'{"seq":4,"host"')
+
+    reloaded = load_tracker()
+    assert reloaded.seq == 3
+    assert reloaded.store.list_files() == ["file1.txt"]
+    (file_node,) = reloaded.store["file1.txt"].nodes.values()
+    assert list(file_node.blocks) == [0, 1, 2]
+    assert (Path(tmpdir) / "FS_Data.json.wal").read_bytes().endswith(b"}\n")
+
+
+def test_tracker_replay_over_newer_snapshot(tmpdir, load_tracker):
+    store_path = Path(tmpdir) / "FS_Data.json"
+    node = "127.0.0.1"
+    live = load_tracker()
+    live.update_node(
+        client_address=node,
+        host=node,
+        node_changes="5;9091;0\n+;file1.txt;9;4;;0\n+;file2.txt;9;4;;0",
+    )
+    live.update_node(
+        client_address=node,
+        host=node,
+        node_changes="5;9091;1\n*;file1.txt;1\n*;file2.txt;1",
+    )
+    live.update_node(
+        client_address=node, host=node, node_changes="5;9091;2\n-;file1.txt"
+    )
+    # A snapshot taken at seq 1 whose file1 shard was written after seq 3.
+    live.store.remove_file_node(file_name="file1.txt", url=f"{node}:9091")
+    store_path.write_text(live.store.to_json().replace('"0-1"', '"0"'))
+    (Path(tmpdir) / "FS_Data.json.wal").write_bytes(
+        CatalogJournal.encode({"snapshot": 1}) + b"".join(live.pending_records[1:])
+    )
+
+    reloaded = load_tracker()
+    assert reloaded.seq == 3
+    assert reloaded.store.list_files() == ["file2.txt"]
+    (file_node,) = reloaded.store["file2.txt"].nodes.values()
+    assert list(file_node.blocks) == [0, 1]
+
+
+def test_tracker_file_ids_survive_restart(tmpdir, load_tracker):
+    tracker = load_tracker()
+    for port, file_name in ((9091, "a.txt"), (9092, "b.txt")):
+        tracker.update_node(
+            client_address="127.0.0.1",
+            host="127.0.0.1",
+            node_changes=f"5;{port};0\n+;{file_name};1;4;;0",
+        )
+    tracker.close_node(url="127.0.0.1:9092")
+    (Path(tmpdir) / "FS_Data.json").write_text(tracker.store.to_json())
+    tracker.pending_records.clear()
+    tracker.update_node(
+        client_address="127.0.0.1",
+        host="127.0.0.1",
+        node_changes="5;9093;0\n+;c.txt;1;4;;0",
+    )
+    (Path(tmpdir) / "FS_Data.json.wal").write_bytes(
+        CatalogJournal.encode({"snapshot": tracker.seq - 1})
+        + b"".join(tracker.pending_records)
+    )
+    assert [tracker.store[name].file_id for name in ("a.txt", "c.txt")] == [0, 2]
+
+    reloaded = load_tracker()
+    assert [reloaded.store[name].file_id for name in ("a.txt", "c.txt")] == [0, 2]
+    assert reloaded.store.next_file_id == 3
+
+
+def test_tracker_keeps_hashes_once(tmpdir, load_tracker):
+    tracker = load_tracker()
+    hashes = "ab" * HASH_SIZE * 3
+    for port in (9091, 9092):
+        tracker.update_node(
+            client_address="127.0.0.1",
+            host="127.0.0.1",
+            node_changes=f"5;{port};0\n+;file1.txt;9;4;{hashes};0-2",
+        )
+    tracker.update_node(
+        client_address="127.0.0.1",
+        host="127.0.0.1",
+        node_changes="5;9091;1\n-;file1.txt",
+    )
+    assert tracker.file_info(file_name="file1.txt").count(hashes) == 1
+    # A snapshot taken at seq 1 but written after every change, so replaying
+    # 9092's registration first drops the file it is the only replica of.
+    (Path(tmpdir) / "FS_Data.json").write_text(tracker.store.to_json())
+    (Path(tmpdir) / "FS_Data.json.wal").write_bytes(
+        CatalogJournal.encode({"snapshot": 1})
+        + b"".join(tracker.pending_records[1:])
+    )
+
+    reloaded = load_tracker()
+    file = reloaded.store["file1.txt"]
+    assert list(file.nodes) == ["127.0.0.1:9092"]
+    assert file.hashes == {(9, 4): ["ab" * HASH_SIZE] * 3}
+
+
+def test_tracker_commit_after_timeout_and_write_error(start_tracker):
+    tracker = start_tracker(request_timeout=0.3)
+    write = tracker.journal.write
+    calls = []
+
+    def flaky_write(data: bytes):
+        calls.append(data)
+        if len(calls) == 1:
+            time.sleep(0.6)
+        elif len(calls) == 2:
+            raise OSError("disk full")
+        write(data)
+
+    tracker.journal.write = flaky_write
+
+    def request(message: str) -> Optional[str]:
+        """Each request on a connection of its own, None once it is closed."""
+        with socket.create_connection(tracker.server_socket.getsockname()) as node:
+            node.sendall(encode_frame(1, message.encode("utf-8")))
+            frames = FrameBuffer()
+            while data := node.recv(65536):
+                if responses := frames.feed(data):
+                    return responses[0][1].decode("utf-8")
+        return None
+
+    def settle():
+        while tracker.commit_task is not None:
+            time.sleep(0.01)
+
+    assert request("5;9091;0\n+;file1.txt;9;4;;0") is None
+    settle()
+    assert request("5;9092;0\n+;file2.txt;9;4;;0") is None
+    settle()
+    assert request("5;9093;0\n+;file3.txt;9;4;;0").startswith("OK")
+    assert len(calls) == 3
+
+
+def test_tracker_node_liveness(start_tracker, connect):
+    tracker = start_tracker(node_ttl=0.5)
+    requests = [connect(tracker), connect(tracker)]
+
+    def request(node: int, message: str) -> str:
+        return requests[node](message)
+
+    assert request(0, "5;9091;0\n+;file1.txt;9;4;;0-2").startswith("OK")
+    assert request(1, "5;9092;0\n+;file1.txt;9;4;;0-2").startswith("OK")
+    assert request(1, "3;file1.txt").index(":9092") < request(1, "3;file1.txt").index(
+        ":9091"
+    )
+    assert request(0, "6;9091") == "OK"
+    assert request(0, "3;file1.txt").index(":9091") < request(0, "3;file1.txt").index(
+        ":9092"
+    )
+
+    assert request(1, "4;9092") == "OK"
+    assert ":9092" not in request(0, "3;file1.txt")
+    assert request(1, "6;9092") == "RESYNC"
+
+    time.sleep(0.8)
+    assert request(1, "3;file1.txt") == ""
+    assert tracker.store.list_files() == []
+    assert request(0, "6;9091") == "RESYNC"
+
+
+def test_tracker_list_pages(tracker, connect):
+    request = connect(tracker)
+    files = [f"dir{i % 3}/file{i:03}.{'txt' if i % 2 else 'bin'}" for i in range(300)]
+    changes = "".join(f"\n+;{name};{i};4;;0" for i, name in enumerate(files))
+    assert request(f"5;9091;0{changes}").startswith("OK")
+
+    listed = []
+    query = {"limit": 40, "glob": "dir1/*.txt"}
+    while True:
+        page = json.loads(request(f"2;{json.dumps(query)}"))
+        assert len(page["files"]) <= 40
+        listed += page["files"]
+        if page["next"] is None:
+            break
+        query["after"] = page["next"]
+    assert listed == sorted(
+        name for name in files if name.startswith("dir1/") and name.endswith(".txt")
+    )
+
+    page = json.loads(request('2;{"limit": 1, "prefix": "dir2/", "details": true}'))
+    assert page == {
+        "files": [{"name": "dir2/file002.bin", "size": 2, "replicas": 1}],
+        "next": "dir2/file002.bin",
+    }
+    assert request("2;{") == "ERROR"
+
+    files_info = json.loads(request("7\ndir0/file000.bin\nnope\ndir1/file001.txt"))
+    assert list(files_info) == ["dir0/file000.bin", "nope", "dir1/file001.txt"]
+    assert files_info["nope"] is None
+    record = files_info["dir1/file001.txt"]
+    assert record["file"]["nodes"].popitem()[1]["size"] == 1
+
+    tags = [files_info["dir0/file000.bin"]["tag"], record["tag"]]
+    query = f"7\ndir0/file000.bin\t{tags[0]}\ndir1/file001.txt\t{tags[1]}\nnope\tx"
+    assert json.loads(request(query)) == {
+        "dir0/file000.bin": {"tag": tags[0]},
+        "dir1/file001.txt": {"tag": tags[1]},
+        "nope": None,
+    }
+    assert request("5;9091;1\n*;dir1/file001.txt;1").endswith(" 2")
+    files_info = json.loads(request(query))
+    assert files_info["dir0/file000.bin"] == {"tag": tags[0]}
+    record = files_info["dir1/file001.txt"]
+    assert record["tag"] != tags[1]
+    assert record["file"]["nodes"].popitem()[1]["blocks"] == "0-1"
@@ -1,15 +1,48 @@
+import socket
 import time
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import pytest
+
+from filetransfer import utils
 from filetransfer.utils import (
+    BLOCK_SIZE,
+    HEADER,
     PACKET_ACK_TIMEOUT,
+    RTO_MIN,
     Address,
+    AimdController,
+    BlockBitmap,
+    BlockHashCache,
+    BlockRanges,
+    BlockRequest,
+    BlockScheduler,
+    CongestionController,
+    DnsCache,
+    DownloadState,
+    ExpiryIndex,
     File,
     FileCatalog,
+    FileInfoCache,
     FileNode,
     FilePeers,
+    FrameBuffer,
+    ManifestEntry,
+    MappedFileCache,
+    NodeManifest,
+    PacketInfo,
+    ReceivedBlock,
+    RetransmitQueue,
+    RttEstimator,
+    SentBlock,
+    SentCatalog,
     SentPacket,
+    SortedNames,
+    TokenBucket,
+    block_digest,
+    encode_frame,
+    split_hashes,
 )
 
 
@@ -115,25 +148,106 @@ def test_file_peers():
     assert fp1 == fp2
 
 
+def test_file_peers_block_size():
+    fn1 = FileNode(host="1.2.3.4", port=1234, blocks=[0, 1], block_size=8)
+    fn2 = FileNode(host="4.3.2.1", port=4321, blocks=[0], block_size=16)
+    fn3 = FileNode(host="1.1.1.1", port=1111, blocks=[2], block_size=8)
+    f = File(name="file1.txt", nodes={})
+    f.add_node(node=fn1).add_node(node=fn2).add_node(node=fn3)
+    fp = FilePeers.from_file(file=f)
+    assert fp.block_size == 8
+    assert fp.info == {
+        0: Address(host="1.2.3.4", port=1234),
+        1: Address(host="1.2.3.4", port=1234),
+        2: Address(host="1.1.1.1", port=1111),
+    }
+
+
+def test_block_request():
+    r1 = BlockRequest(
+        file_id=7, block_id=3, block_size=4096, packet_size=1400, file_name="a;b.txt"
+    )
+    r2 = BlockRequest(file_id=7, block_id=3, block_size=4096, packet_size=1400)
+    assert BlockRequest.from_bytes(r1.to_bytes()) == r1
+    assert BlockRequest.from_bytes(r2.to_bytes()) == r2
+    assert len(r2.to_bytes()) < len(r1.to_bytes())
+
+
+def test_packet_info():
+    info = PacketInfo(file_id=2**40, block_id=5, packet_id=9)
+    assert len(info.to_bytes()) == HEADER.size
+    assert PacketInfo.from_bytes(info.to_bytes()) == info
+
+
+def test_file_catalog_file_ids():
+    fn = FileNode(host="1.2.3.4", port=1234, blocks=[0])
+    fc = FileCatalog({})
+    fc.add_file_node(file_node=fn, file_name="file1.txt")
+    fc.add_file_node(file_node=fn, file_name="file2.txt")
+    fc.add_file_node(file_node=fn, file_name="file1.txt")
+    assert fc["file1.txt"].file_id == 0
+    assert fc["file2.txt"].file_id == 1
+    assert FileCatalog.from_json(fc.to_json()).next_file_id == 2
+
+
 def test_sent_packet():
-    dt1 = datetime.now()
+    t1 = time.monotonic()
     packet = SentPacket(packet_id=0, data=b"test")
-    dt2 = datetime.now()
+    t2 = time.monotonic()
 
     assert packet.packet_id == 0
     assert packet.data == b"test"
-    assert dt1 <= packet.sent_at <= dt2
+    assert t1 <= packet.sent_at <= t2
+    assert packet.deadline == packet.sent_at + PACKET_ACK_TIMEOUT
 
-    assert not packet.should_resend()
-    time.sleep(PACKET_ACK_TIMEOUT)
-    assert packet.should_resend()
+    packet.update(timeout=0.01)
+    assert packet.deadline == packet.sent_at + 0.01
 
-    dt3 = datetime.now()
+    t3 = time.monotonic()
     packet.update()
-    dt4 = datetime.now()
-
-    assert dt2 <= packet.sent_at
-    assert dt3 <= packet.sent_at <= dt4
+    t4 = time.monotonic()
+
+    assert t2 <= packet.sent_at
+    assert t3 <= packet.sent_at <= t4
+
+
+def test_rtt_estimator():
+    rtt = RttEstimator()
+    assert rtt.rto == PACKET_ACK_TIMEOUT
+    rtt.sample(0.5)
+    assert rtt.srtt == 0.5
+    assert rtt.rto == 0.5 + 4 * 0.25
+    for _ in range(50):
+        rtt.sample(0.5)
+    assert 0.5 <= rtt.rto < 0.6
+    sent_at = time.monotonic()
+    rtt.backoff(sent_at=sent_at)
+    assert 1.0 <= rtt.rto < 1.2
+    rtt.backoff(sent_at=sent_at)
+    assert 1.0 <= rtt.rto < 1.2
+    rtt.backoff(sent_at=time.monotonic())
+    assert 2.0 <= rtt.rto < 2.4
+    rtt.sample(0.000_1)
+    assert rtt.rto >= RTO_MIN
+
+
+def test_retransmit_queue():
+    queue = RetransmitQueue()
+    p1 = SentPacket(packet_id=1, data=b"")
+    p2 = SentPacket(packet_id=2, data=b"")
+    p1.update(timeout=2)
+    p2.update(timeout=1)
+    queue.push(client="a", packet=p1)
+    queue.push(client="b", packet=p2)
+    assert queue.next_deadline() == p2.deadline
+    assert queue.pop_expired(p2.sent_at) == []
+    assert queue.pop_expired(p2.deadline) == [("b", p2)]
+
+    p1.update(timeout=3)
+    queue.push(client="a", packet=p1)
+    assert queue.pop_expired(p1.deadline - 0.5) == []
+    assert queue.pop_expired(p1.deadline) == [("a", p1)]
+    assert len(queue) == 0
 
 
 def test_packet_content():
@@ -142,5 +256,570 @@ def test_packet_content():
     p2 = SentPacket(packet_id=2, data=d2)
     p1_bytes = p1.to_bytes()
     p2_bytes = p2.to_bytes()
-    assert len(p1_bytes) == 12
-    assert len(p2_bytes) == 22
+    assert len(p1_bytes) == HEADER.size + 10
+    assert len(p2_bytes) == HEADER.size + 20
+    assert SentPacket.from_bytes(p2_bytes) == p2
+
+
+def test_sent_block_window():
+    block = SentBlock(block_id=0, packets={})
+    for packet_id in range(5):
+        block.add_packet(packet=SentPacket(packet_id=packet_id, data=b"x"))
+
+    assert [p.packet_id for p in block.next_packets(count=3)] == [0, 1, 2]
+    assert block.n_in_flight() == 3
+
+    block.remove_packet(packet_id=1)
+    assert block.n_in_flight() == 2
+    assert [p.packet_id for p in block.next_packets(count=3)] == [3, 4]
+    assert block.next_packets(count=1) == []
+    assert not block.has_unsent()
+
+
+def test_sent_catalog_selective_ack():
+    client = Address(host="1.2.3.4", port=1234)
+    block = SentBlock(block_id=0, packets={})
+    for packet_id in range(3):
+        block.add_packet(packet=SentPacket(packet_id=packet_id, data=b"x"))
+    catalog = SentCatalog({}).add_block(client=client, file_id=0, block=block)
+    info = PacketInfo(file_id=0, block_id=0)
+
+    assert catalog.get_block(packet_info=info, client=client) is block
+    assert len(block.next_packets(count=3)) == 3
+    for packet_id in (2, 0, 1):
+        catalog.remove_packet(
+            packet_info=PacketInfo(file_id=0, block_id=0, packet_id=packet_id),
+            client=client,
+        )
+    assert catalog.get_block(packet_info=info, client=client) is None
+    assert catalog.clients == {}
+
+
+def test_received_block_reorders():
+    block = ReceivedBlock(file_id=0, block_id=0)
+    packets = [SentPacket(packet_id=i, data=bytes([i])) for i in range(4)]
+    assert block.add_packet(packet=packets[1]) == []
+    assert block.add_packet(packet=packets[3]) == []
+    assert block.add_packet(packet=packets[0]) == [b"\x00", b"\x01"]
+    assert block.add_packet(packet=packets[1]) == []
+    assert block.add_packet(packet=packets[2]) == [b"\x02", b"\x03"]
+    assert block.pending == {}
+
+
+def test_aimd_controller():
+    cc = AimdController()
+    for _ in range(10):
+        cc.on_ack()
+    assert cc.window() == 20
+
+    cc.on_loss(sent_at=time.monotonic())
+    assert cc.window() == 10
+    cc.on_loss(sent_at=0.0)
+    assert cc.window() == 10
+
+    for _ in range(10):
+        cc.on_ack()
+    assert cc.window() == 10
+    assert cc.cwnd > 10.9
+
+    cc.max_cwnd = 8
+    assert cc.window() == 8
+    cc.on_ack()
+    assert cc.cwnd == 8
+    with pytest.raises(TypeError):
+        CongestionController()
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=1000, burst=500, tokens=500, updated_at=0.0)
+    assert bucket.wait_time(400, 0.0) == 0
+    bucket.consume(400, 0.0)
+    assert bucket.wait_time(400, 0.0) == 0.3
+    bucket.consume(400, 0.0)
+    assert bucket.tokens == -300
+    assert bucket.wait_time(100, 1.0) == 0
+    assert bucket.tokens == 500
+
+
+def test_sent_block_in_flight_count():
+    block = SentBlock(block_id=0, packets={})
+    for packet_id in range(4):
+        block.add_packet(packet=SentPacket(packet_id=packet_id, data=b"x"))
+    block.next_packets(count=2)
+    assert block.n_in_flight() == 2
+    block.remove_packet(packet_id=1)
+    block.remove_packet(packet_id=1)
+    assert block.n_in_flight() == 1
+    block.next_packets(count=2)
+    assert block.n_in_flight() == 3
+    assert not block.has_unsent()
+
+
+def test_mapped_file_cache(tmpdir):
+    paths = [Path(tmpdir) / f"file{i}.txt" for i in range(3)]
+    for i, path in enumerate(paths):
+        path.write_bytes(bytes([i]) * 10)
+    (Path(tmpdir) / "empty.txt").write_bytes(b"")
+
+    cache = MappedFileCache(capacity=2)
+    view = cache.get(paths[0])
+    assert view[2:4] == b"\x00\x00"
+    assert cache.get(paths[0]) is view
+    cache.get(paths[1])
+    cache.get(paths[2])
+    assert list(cache.maps) == [paths[1], paths[2]]
+    assert view[2:4] == b"\x00\x00"
+
+    paths[2].write_bytes(b"changed")
+    assert cache.get(paths[2]) == b"changed"
+    assert len(cache.get(Path(tmpdir) / "empty.txt")) == 0
+
+
+def test_block_bitmap():
+    bitmap = BlockBitmap(10)
+    assert len(bitmap.to_bytes()) == 2
+    for block in (0, 3, 9, 3):
+        bitmap.add(block)
+    assert len(bitmap) == 3
+    assert 9 in bitmap and 8 not in bitmap
+    assert bitmap.missing() == [1, 2, 4, 5, 6, 7, 8]
+
+    restored = BlockBitmap(10, bitmap.to_bytes())
+    assert len(restored) == 3
+    for block in restored.missing():
+        restored.add(block)
+    assert restored.is_complete()
+
+
+def test_file_peers_size():
+    fn = FileNode(host="1.2.3.4", port=1234, blocks=[0, 1, 2], block_size=4, size=9)
+    fp = FilePeers.from_file(file=File(name="file1.txt", nodes={}).add_node(node=fn))
+    assert fp.size == 9
+    assert fp.n_blocks() == 3
+
+
+def test_download_state_save_load(tmpdir):
+    state = DownloadState.new(size=10 * 4 + 1, block_size=4)
+    assert state.completed.n_blocks == 11
+    state.completed.add(0)
+    state.completed.add(10)
+
+    path = Path(tmpdir) / "file1.txt.part.state"
+    state.save(path=path)
+    loaded = DownloadState.load(path=path)
+
+    assert loaded == state
+    assert loaded.completed.blocks() == [0, 10]
+
+
+def test_block_digest_split_hashes():
+    digests = [block_digest(b"abcd"), block_digest(b"efgh"), block_digest(b"i")]
+    assert len(set(digests)) == 3
+    assert split_hashes("".join(digests)) == digests
+    assert split_hashes("") == []
+
+
+def test_block_hash_cache(tmpdir):
+    path = Path(tmpdir) / "file1.txt"
+    path.write_bytes(b"abcdefghi")
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        cache = BlockHashCache(path=Path(tmpdir) / "hashes.json", executor=executor)
+        assert cache.get(path, 4) == [
+            block_digest(b"abcd"),
+            block_digest(b"efgh"),
+            block_digest(b"i"),
+        ]
+        assert cache.get(path, 8) == [block_digest(b"abcdefgh"), block_digest(b"i")]
+        cache.save()
+
+        reloaded = BlockHashCache(path=Path(tmpdir) / "hashes.json", executor=executor)
+        assert reloaded.entries == cache.entries
+        reloaded.get(path, 8)
+        assert not reloaded.dirty
+        path.write_bytes(b"abcdXXXXi!")
+        assert reloaded.get(path, 4)[1] == block_digest(b"XXXX")
+        path.unlink()
+        assert reloaded.get_many([path, path.with_name("nope")], 4) == [None, None]
+        assert str(path) not in reloaded.entries
+        assert reloaded.dirty
+        reloaded.save()
+        assert not reloaded.dirty
+
+
+def test_file_hashes_json():
+    hashes = [block_digest(b"a"), block_digest(b"b")]
+    file = File(name="file1.txt", nodes={}, file_id=1)
+    file.add_node(
+        node=FileNode(host="1.2.3.4", port=1234, blocks=[0, 1], size=2),
+        hashes=hashes,
+    )
+    file.add_node(
+        node=FileNode(host="4.3.2.1", port=4321, blocks=[1], size=2),
+        hashes=list(hashes),
+    )
+    assert file.to_json().count("".join(hashes)) == 1
+    assert File.from_json(file.to_json(), mode="host") == file
+
+    legacy = file.to_dict()
+    del legacy["hashes"]
+    for node in legacy["nodes"].values():
+        node["hashes"] = "".join(hashes)
+    assert File.from_dict(legacy, mode="host") == file
+
+    file.remove_node(url="1.2.3.4:1234")
+    assert file.hashes == {(2, BLOCK_SIZE): hashes}
+    file.remove_node(url="4.3.2.1:4321")
+    assert file.hashes == {}
+
+
+def test_file_peers_hashes_replicas():
+    hashes = [block_digest(b"a"), block_digest(b"b")]
+    fn1 = FileNode(host="1.2.3.4", port=1234, blocks=[0, 1])
+    fn2 = FileNode(host="4.3.2.1", port=4321, blocks=[1])
+    fn3 = FileNode(host="1.1.1.1", port=1111, blocks=[1])
+    file = File(name="file1.txt", nodes={})
+    file.add_node(node=fn1, hashes=hashes)
+    file.add_node(node=fn2, hashes=hashes)
+    file.add_node(node=fn3, hashes=hashes[::-1])
+    fp = FilePeers.from_file(file=file)
+    assert fp.hashes == hashes
+    assert fp.block_hash(1) == hashes[1]
+    assert fp.block_hash(2) is None
+    assert fp.replicas[0] == [Address(host="1.2.3.4", port=1234)]
+    assert len(fp.replicas[1]) == 3
+
+
+def test_block_scheduler_rarest_first_spreads_load():
+    a1 = Address(host="1.1.1.1", port=1)
+    a2 = Address(host="2.2.2.2", port=2)
+    replicas = {0: [a1, a2], 1: [a1, a2], 2: [a2], 3: [a1, a2]}
+    scheduler = BlockScheduler(replicas=replicas, blocks=[0, 1, 2, 3], peer_limit=2)
+
+    assert scheduler.assign(rates={}, limit=1) == [(2, a2)]
+    assignments = scheduler.assign(rates={}, limit=10)
+    assert assignments == [(0, a1), (1, a1), (3, a2)]
+    assert scheduler.assign(rates={}, limit=10) == []
+    assert len(scheduler) == 4
+
+    scheduler.complete(0, a1)
+    assert scheduler.load(a1) == 1
+    assert len(scheduler) == 3
+
+
+def test_block_scheduler_prefers_fast_peers():
+    slow = Address(host="1.1.1.1", port=1)
+    fast = Address(host="2.2.2.2", port=2)
+    replicas = {block: [slow, fast] for block in range(8)}
+    scheduler = BlockScheduler(replicas=replicas, blocks=list(range(8)), peer_limit=8)
+
+    assignments = scheduler.assign(rates={slow: 100.0, fast: 300.0}, limit=8)
+    assert [address for _, address in assignments].count(fast) == 6
+
+
+def test_block_scheduler_priority():
+    a1 = Address(host="1.1.1.1", port=1)
+    a2 = Address(host="2.2.2.2", port=2)
+    replicas = {(1, 0): [a2], (1, 1): [a1, a2], (0, 0): [a1, a2], (2, 0): [a1]}
+    scheduler = BlockScheduler(
+        replicas=replicas,
+        blocks=list(replicas),
+        peer_limit=4,
+        priority=lambda key: key[0],
+    )
+    assert [key for key, _ in scheduler.assign(rates={}, limit=4)] == [
+        (0, 0),
+        (1, 0),
+        (1, 1),
+        (2, 0),
+    ]
+
+
+def test_block_scheduler_fail():
+    a1 = Address(host="1.1.1.1", port=1)
+    a2 = Address(host="2.2.2.2", port=2)
+    scheduler = BlockScheduler(
+        replicas={0: [a1, a2], 1: [a1]}, blocks=[0, 1], peer_limit=1
+    )
+    assert scheduler.assign(rates={}, limit=2) == [(1, a1), (0, a2)]
+
+    assert scheduler.fail(0, a2)
+    assert scheduler.assign(rates={}, limit=2) == []
+    assert not scheduler.fail(1, a1)
+    assert scheduler.assign(rates={}, limit=2) == [(0, a1)]
+    assert len(scheduler) == 1
+
+
+def test_block_scheduler_endgame():
+    a1 = Address(host="1.1.1.1", port=1)
+    a2 = Address(host="2.2.2.2", port=2)
+    a3 = Address(host="3.3.3.3", port=3)
+    scheduler = BlockScheduler(
+        replicas={0: [a1, a2, a3], 1: [a1, a2]},
+        blocks=[0, 1],
+        peer_limit=1,
+        endgame_blocks=2,
+        endgame_copies=2,
+    )
+    assert scheduler.assign(rates={}, limit=1) == [(1, a1)]
+    assert scheduler.assign(rates={}, limit=10) == [(0, a2), (0, a3)]
+
+    assert scheduler.complete(0, a3) == [a2]
+    assert scheduler.load(a2) == 0
+    assert len(scheduler) == 1
+
+    assert scheduler.fail(1, a1)
+    assert scheduler.assign(rates={}, limit=10) == [(1, a2)]
+
+
+def test_sent_catalog_remove_block():
+    client = Address(host="1.1.1.1", port=1)
+    block = SentBlock(block_id=3, packets={})
+    block.add_packet(packet=SentPacket(packet_id=0, data=memoryview(b"a")))
+    catalog = SentCatalog({}).add_block(client=client, file_id=7, block=block)
+    info = PacketInfo(file_id=7, block_id=3)
+    assert catalog.get_block(packet_info=info, client=client) is block
+
+    catalog.remove_block(packet_info=info, client=client)
+    assert catalog.get_block(packet_info=info, client=client) is None
+    assert catalog.clients == {}
+
+
+def test_frame_buffer():
+    stream = encode_frame(1, b"1;9090;a") + encode_frame(2, b"") + encode_frame(
+        3, b"x" * 100_000
+    )
+    frames = FrameBuffer()
+    assert frames.feed(stream[:5]) == []
+    assert frames.feed(stream[5:20]) == [(1, b"1;9090;a")]
+    received = frames.feed(stream[20:])
+    assert received == [(2, b""), (3, b"x" * 100_000)]
+    assert frames.feed(b"") == []
+
+
+def test_node_manifest_diff(tmpdir):
+    manifest = NodeManifest(
+        version=3,
+        entries={
+            "file1.txt": ManifestEntry(9, 4, [], [0, 1, 2]),
+            "file2.txt": ManifestEntry(9, 4, [], [0]),
+            "file3.txt": ManifestEntry(1, 4, [], [0]),
+        },
+    )
+    current = {
+        "file1.txt": ManifestEntry(9, 4, [], [0, 1, 2]),
+        "file2.txt": ManifestEntry(9, 4, [], [0, 2]),
+        "file4.txt": ManifestEntry(2, 4, ["ab"], [0]),
+    }
+    assert manifest.diff(current) == [
+        "*;file2.txt;2",
+        "+;file4.txt;2;4;ab;0",
+        "-;file3.txt",
+    ]
+    assert NodeManifest().diff({}) == []
+
+    path = Path(tmpdir) / ".manifest.json"
+    manifest.save(path=path)
+    assert NodeManifest.load(path=path) == manifest
+
+    changes = manifest.diff(current)
+    updated = NodeManifest(version=4, entries=current)
+    updated.save_changes(path=path, changes=changes)
+    assert '"version": 3' in path.read_text()
+    with open(path.with_name(".manifest.json.log"), mode="a") as fp:
+        fp.write('{"version": 5, "chan')
+    assert NodeManifest.load(path=path) == updated
+
+    updated.save_changes(path=path, changes=["+;big.txt;1;4;" + "ab" * 500 + ";0"])
+    assert not path.with_name(".manifest.json.log").exists()
+    assert NodeManifest.load(path=path) == updated
+
+
+def test_block_ranges():
+    ranges = BlockRanges.from_blocks([5, 0, 1, 2, 7, 8, 2])
+    assert str(ranges) == "0-2,5,7-8"
+    assert BlockRanges.from_string(str(ranges)) == ranges
+    assert BlockRanges.from_string("0,1,2") == BlockRanges([(0, 3)])
+    assert len(ranges) == 6 and list(ranges) == [0, 1, 2, 5, 7, 8]
+    assert 2 in ranges and 3 not in ranges and 8 in ranges and 9 not in ranges
+
+    assert str(ranges.union(BlockRanges.from_string("3-4,6"))) == "0-8"
+    assert str(ranges.difference(BlockRanges.from_string("1,7-20"))) == "0,2,5"
+    assert BlockRanges.from_string("1-2").issubset(ranges)
+    assert not BlockRanges.from_string("2-3").issubset(ranges)
+
+    whole = BlockRanges([(0, 10**9)])
+    assert str(whole) == "0-999999999"
+    assert len(whole.difference(ranges)) == 10**9 - 6
+
+
+def test_file_node_block_ranges_json():
+    fn = FileNode(host="1.2.3.4", port=1234, blocks=range(100_000), size=100_000)
+    assert fn.to_json().endswith('"blocks":"0-99999"}')
+    assert FileNode.from_json(fn.to_json(), mode="host") == fn
+
+
+def test_file_catalog_json_special_names():
+    fc = FileCatalog({})
+    for file_name in ["a:b.txt", "c,d}.txt", 'e"f\\g.txt', "ção.txt"]:
+        fc.add_file_node(
+            file_node=FileNode(host="pc1", port=9091, blocks=[0, 1], size=3),
+            file_name=file_name,
+        )
+    assert FileCatalog.from_json(fc.to_json()) == fc
+    assert File.from_json(fc["a:b.txt"].to_json(), mode="host") == fc["a:b.txt"]
+
+
+def test_file_catalog_shards_concurrent():
+    fc = FileCatalog({}, n_shards=8)
+
+    def register(node: int):
+        for i in range(200):
+            fc.add_file_node(
+                file_node=FileNode(host=f"pc{node}", port=9091, blocks=[0]),
+                file_name=f"file{i}.txt",
+            )
+            fc.add_file_blocks(
+                file_name=f"file{i}.txt",
+                url=f"pc{node}:9091",
+                blocks=BlockRanges([(1, 3)]),
+            )
+            fc.get_file_nodes(file_name=f"file{i // 2}.txt")
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(register, range(8)))
+    assert fc.list_files() == sorted(f"file{i}.txt" for i in range(200))
+    assert sorted(file.file_id for file in fc.files.values()) == list(range(200))
+    assert all(
+        list(node.blocks) == [0, 1, 2] and len(fc["file7.txt"].nodes) == 8
+        for node in fc.get_file_nodes(file_name="file7.txt")
+    )
+    assert FileCatalog.from_json(fc.to_json()) == fc
+
+
+def test_expiry_index():
+    expiry = ExpiryIndex(ttl=10)
+    expiry.touch("a:1", 0)
+    expiry.touch("b:1", 1)
+    expiry.touch("c:1", 2)
+    expiry.touch("a:1", 5)
+    expiry.discard("c:1")
+    assert expiry.next_deadline() == 10
+    assert expiry.pop_expired(11) == ["b:1"]
+    assert expiry.is_live("a:1", 11) and not expiry.is_live("b:1", 11)
+    assert len(expiry.heap) == 2 and len(expiry) == 1
+    expiry.touch("c:1", 12)
+    assert expiry.pop_expired(15) == ["a:1"]
+    assert expiry.pop_expired(30) == ["c:1"]
+    assert not expiry.heap and not expiry.queued
+
+
+def test_dns_cache(monkeypatch):
+    lookups = []
+
+    def gethostbyname(host: str) -> str:
+        lookups.append(host)
+        if host == "missing":
+            raise socket.gaierror("unknown host")
+        return f"10.0.0.{len(host)}"
+
+    monkeypatch.setattr(socket, "gethostbyname", gethostbyname)
+    cache = DnsCache(ttl=60, negative_ttl=60)
+    assert cache.hosts_to_addresses(["pc1", "pc10", "pc1", "missing"]) == {
+        "pc1": "10.0.0.3",
+        "pc10": "10.0.0.4",
+    }
+    assert cache.host_to_address("pc10") == "10.0.0.4"
+    with pytest.raises(OSError):
+        cache.host_to_address("missing")
+    assert sorted(lookups) == ["missing", "pc1", "pc10"]
+
+    cache.entries[("address", "pc1")] = (time.monotonic(), "10.0.0.3")
+    assert cache.host_to_address("pc1") == "10.0.0.3"
+    assert lookups.count("pc1") == 2
+
+
+def test_file_skips_unresolved_hosts(monkeypatch):
+    def gethostbyname(host: str) -> str:
+        if host == "missing":
+            raise socket.gaierror("unknown host")
+        return "10.0.0.1"
+
+    monkeypatch.setattr(socket, "gethostbyname", gethostbyname)
+    monkeypatch.setattr(utils, "DNS_CACHE", DnsCache(ttl=60, negative_ttl=60))
+    f = File(name="file1.txt", nodes={})
+    f.add_node(node=FileNode(host="pc1", port=1, blocks=[0, 1], size=2))
+    f.add_node(node=FileNode(host="missing", port=2, blocks=[2], size=3))
+    assert FilePeers.from_file(file=f) == FilePeers(
+        info={0: Address(host="10.0.0.1", port=1), 1: Address(host="10.0.0.1", port=1)},
+        size=2,
+    )
+    file = File.from_json(f.to_json(), mode="address")
+    assert list(file.nodes) == ["pc1:1"]
+    assert file.nodes["pc1:1"].host == "10.0.0.1"
+
+
+def test_sorted_names():
+    names = SortedNames([f"f{i:04}" for i in range(0, 1000, 2)], load=8)
+    for i in range(1, 1000, 2):
+        names.add(f"f{i:04}")
+    names.add("f0001")
+    for i in range(0, 1000, 3):
+        names.discard(f"f{i:04}")
+    names.discard("nope")
+    expected = [f"f{i:04}" for i in range(1000) if i % 3]
+    assert list(names) == expected and len(names) == len(expected)
+    assert "f0001" in names and "f0003" not in names and "g" not in names
+    assert max(len(chunk) for chunk in names.chunks) <= 16
+    assert list(names.iter_from("f0003"))[:2] == ["f0004", "f0005"]
+    assert list(names.iter_from("f0004", inclusive=False))[:1] == ["f0005"]
+    assert list(names.iter_from("g")) == []
+
+
+def test_file_catalog_list_page():
+    fc = FileCatalog({})
+    for name in ["a/1.txt", "a/2.bin", "a/3.txt", "b/1.txt", "c.txt"]:
+        fc.add_file_node(
+            file_node=FileNode(host="pc1", port=9091, blocks=[0]), file_name=name
+        )
+    fc.remove_file_node(file_name="a/2.bin", url="pc1:9091")
+    assert fc.list_files() == ["a/1.txt", "a/3.txt", "b/1.txt", "c.txt"]
+    assert fc.list_page(limit=2) == (["a/1.txt", "a/3.txt"], "a/3.txt")
+    assert fc.list_page(limit=2, after="a/3.txt") == (["b/1.txt", "c.txt"], "c.txt")
+    assert fc.list_page(limit=2, after="c.txt") == ([], None)
+    assert fc.list_page(limit=5, prefix="a/") == (["a/1.txt", "a/3.txt"], None)
+    assert fc.list_page(limit=5, pattern="*/1.txt") == (["a/1.txt", "b/1.txt"], None)
+    assert fc.list_page(limit=5, pattern="*.txt", scan_limit=1) == (
+        ["a/1.txt"],
+        "a/1.txt",
+    )
+    assert fc.list_page(limit=5, prefix="b", pattern="a*") == ([], None)
+
+
+def test_file_catalog_versions():
+    fc = FileCatalog({})
+    for file_name in ["f", "g"]:
+        file_node = FileNode(host="pc1", port=9091, blocks=[])
+        fc.add_file_node(file_node=file_node, file_name=file_name)
+    _, version = fc.get_file(file_name="f")
+    assert fc.file_version(file_name="f") == version < fc.file_version(file_name="g")
+    blocks = BlockRanges.from_blocks([0])
+    fc.add_file_blocks(file_name="f", url="pc1:9091", blocks=blocks)
+    assert fc.file_version(file_name="f") > fc.file_version(file_name="g")
+    assert fc.get_file(file_name="f")[1] == fc.file_version(file_name="f")
+    fc.remove_file_node(file_name="f", url="pc1:9091")
+    assert fc.file_version(file_name="f") is None
+
+
+def test_file_info_cache():
+    cache = FileInfoCache(capacity=2, max_age=1)
+    files = [File(name=f"f{i}", nodes={}) for i in range(3)]
+    cache.put("f0", tag="a.1", file=files[0], now=0)
+    cache.put("f1", tag="a.2", file=files[1], now=0)
+    assert cache.get("f0").file is files[0]
+    cache.put("f2", tag="a.3", file=files[2], now=0.5)
+    assert cache.get("f1") is None and len(cache) == 2
+    entry = cache.get("f2")
+    assert cache.is_fresh(entry, 1.4) and not cache.is_fresh(entry, 1.5)
+    cache.discard("f0")
+    cache.discard("nope")
+    assert list(cache.entries) == ["f2"]